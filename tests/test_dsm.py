@@ -0,0 +1,100 @@
+import numpy
+import pytest
+import xarray
+from affine import Affine
+
+from datacube.utils.geometry import CRS, GeoBox
+from wofs.dsm import DSMCache, bake_mosaic, crop, is_mosaic, open_mosaic
+
+
+GRID = Affine(25, 0, 1500000, 0, -25, -3900000)
+
+
+def fake_reader(calls):
+    """dc_read stand-in, recording its calls"""
+    def read(path, gbox, resampling):
+        calls.append((path, gbox, resampling))
+        col, row = ~GRID * (gbox.affine.c, gbox.affine.f)
+        return numpy.add.outer(numpy.arange(gbox.height) + row, 1000.0 * (numpy.arange(gbox.width) + col))
+    return read
+
+
+def test_dsm_cache_serves_contained_windows():
+    calls = []
+    cache = DSMCache()
+    outer = GeoBox(100, 100, GRID, CRS('EPSG:3577'))
+
+    first = cache.read('dsm.tif', outer, 'bilinear', fake_reader(calls))
+    again = cache.read('dsm.tif', outer, 'bilinear', fake_reader(calls))
+    inner = cache.read('dsm.tif', outer[10:30, 20:60], 'bilinear', fake_reader(calls))
+
+    assert again is first
+    assert inner.shape == (20, 40)
+    assert numpy.shares_memory(inner, first)
+    numpy.testing.assert_array_equal(inner, first[10:30, 20:60])
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # other resampling, off the cached window, or off its pixel grid
+    cache.read('dsm.tif', outer, 'cubic', fake_reader(calls))
+    cache.read('dsm.tif', outer[90:110, 0:10], 'bilinear', fake_reader(calls))
+    shifted = GeoBox(10, 10, GRID * Affine.translation(0.5, 0.5), CRS('EPSG:3577'))
+    cache.read('dsm.tif', shifted, 'bilinear', fake_reader(calls))
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert len(calls) == 4
+
+
+def test_dsm_cache_evicts_least_recently_used():
+    calls = []
+    gbox = GeoBox(10, 10, GRID, CRS('EPSG:3577'))
+    window_bytes = fake_reader([])('dsm.tif', gbox, 'bilinear').nbytes
+    cache = DSMCache(max_bytes=2 * window_bytes)
+
+    cache.read('a.tif', gbox, 'bilinear', fake_reader(calls))
+    cache.read('b.tif', gbox, 'bilinear', fake_reader(calls))
+    cache.read('a.tif', gbox, 'bilinear', fake_reader(calls))
+    cache.read('c.tif', gbox, 'bilinear', fake_reader(calls))
+
+    assert len(cache) == 2 and cache.nbytes == 2 * window_bytes
+    assert cache.evictions == 1
+    cache.read('a.tif', gbox, 'bilinear', fake_reader(calls))
+    cache.read('b.tif', gbox, 'bilinear', fake_reader(calls))
+    assert [call[0] for call in calls] == ['a.tif', 'b.tif', 'c.tif', 'b.tif']
+
+
+def test_mosaic_windows(tmp_path):
+    calls = []
+    gbox = GeoBox(100, 80, GRID, CRS('EPSG:3577'))
+
+    def reader(block, resampling):
+        return fake_reader(calls)('dsm.tif', block, resampling)
+
+    mosaic = bake_mosaic(tmp_path / 'mosaic', gbox, reader, block_size=32)
+    assert len(calls) == 12
+    assert is_mosaic(tmp_path / 'mosaic') and not is_mosaic(tmp_path)
+
+    mosaic = open_mosaic(str(tmp_path / 'mosaic'))
+    window = mosaic.read(gbox[10:30, 20:60])
+    assert numpy.shares_memory(window, mosaic.elevation)
+    numpy.testing.assert_array_equal(window, reader(gbox[10:30, 20:60], 'cubic'))
+
+    # beyond the mosaic is no data
+    edge = mosaic.load(gbox.buffered(50, 50)[0:20, 0:20]).elevation.values
+    assert (edge[:2] == -1000).all() and (edge[:, :2] == -1000).all()
+    numpy.testing.assert_array_equal(edge[2:, 2:], mosaic.elevation[:18, :18])
+
+    with pytest.raises(ValueError):
+        mosaic.read(GeoBox(10, 10, GRID * Affine.translation(0.5, 0.5), CRS('EPSG:3577')))
+
+
+def test_crop_is_a_view_of_the_window():
+    outer = GeoBox(100, 80, GRID, CRS('EPSG:3577'))
+    data = xarray.Dataset({'elevation': (('y', 'x'), fake_reader([])('dsm.tif', outer, 'cubic'))},
+                          coords={dim: coord.values for dim, coord in outer.coordinates.items()})
+
+    window = crop(data, outer, outer[5:-5, 7:-7])
+
+    assert window.elevation.shape == (70, 86)
+    assert numpy.shares_memory(window.elevation.values, data.elevation.values)
+    numpy.testing.assert_array_equal(window.x.values, outer[5:-5, 7:-7].coordinates['x'].values)
+    with pytest.raises(ValueError):
+        crop(data, outer, outer[-10:90, 0:10])
@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+from affine import Affine
+from datacube.utils.geometry import CRS, GeoBox, box
+
+from wofs.estimate import Estimate
+
+ALBERS = CRS('EPSG:3577')
+
+
+def make_task(cell, valid_fraction, padding):
+    left, top = 100000 * cell[0], 100000 * (cell[1] + 1)
+    geobox = GeoBox(4000, 4000, Affine(25, 0, left, 0, -25, top), ALBERS)
+    pq = GeoBox(4006, 4006, Affine(25, 0, left - 75, 0, -25, top + 75), ALBERS)
+    dsm = GeoBox(4000 + 2 * padding, 4000 + 2 * padding,
+                 Affine(25, 0, left - 25 * padding, 0, -25, top + 25 * padding), ALBERS)
+    valid_region = box(left, top - 100000 * valid_fraction, left + 100000, top, ALBERS)
+    # a single source dataset, with the valid region as its footprint
+    sources = SimpleNamespace(values=[(SimpleNamespace(extent=valid_region),)])
+    return dict(source_tile=SimpleNamespace(geobox=geobox, sources=sources),
+                pq_tile=SimpleNamespace(geobox=pq, sources=sources),
+                dsm_tile=SimpleNamespace(geobox=dsm),
+                tile_index=(cell[0], cell[1], None),
+                valid_region=valid_region)
+
+
+def test_estimate_tallies_pixels_bytes_and_cell_costs():
+    tally = Estimate(output_bytes=2)
+    tally.add(make_task((15, -40), 1, 0))
+    tally.add(make_task((15, -40), 0.5, 0))
+    tally.add(make_task((16, -40), 1, 1000))
+
+    pixels = 4000 * 4000
+    assert tally.tasks == 3
+    assert tally.valid_pixels == 2.5 * pixels
+    # the half-covered tile loads only its window (with a halo of 4 pixels, and 3 more of the pq)
+    assert tally.input_bytes == (2 * (pixels * 6 * 2 + 4006 ** 2 * 2) + 2004 * 4000 * 6 * 2 + 2010 * 4006 * 2
+                                 + (2 * pixels + 6000 ** 2) * 4)
+    assert tally.output_total == 3 * pixels * 2
+    assert tally.cell_costs[(15, -40)] == 1.5 * pixels
+    assert tally.cell_costs[(16, -40)] == 6000 ** 2
+    assert abs(tally.cpu_hours(3600) - tally.weighted_pixels / 1e6) < 1e-9
+
+    counts, _ = tally.histogram(bins=2)
+    assert list(counts) == [1, 1]
+    assert tally.report()[0] == 'Tasks: 3 in 2 cells'
+
+
+def test_estimate_counts_whole_tiles_unless_cropped():
+    tally = Estimate(crop=False)
+    tally.add(make_task((15, -40), 0.5, 0))
+
+    assert tally.input_bytes == 4000 * 4000 * 6 * 2 + 4006 ** 2 * 2 + 4000 * 4000 * 4
@@ -0,0 +1,73 @@
+import uuid
+
+import numpy
+import xarray
+from affine import Affine
+from datacube.utils.geometry import CRS, GeoBox, box, unary_intersection, unary_union
+
+from wofs.footprints import Footprints
+
+ALBERS = CRS('EPSG:3577')
+
+
+class FakeDataset:
+    def __init__(self, left, bottom, right, top):
+        self.id = uuid.uuid4()
+        self.extent = box(left, bottom, right, top, 'EPSG:4326')
+
+
+class FakeTile:
+    def __init__(self, *datasets):
+        self.sources = xarray.DataArray(numpy.array([None], dtype=object), dims=['time'])
+        self.sources.values[0] = datasets
+
+
+def original_valid_region(geobox, *tiles):
+    extents = [unary_union([dataset.extent.to_crs(geobox.crs) for dataset in tile.sources.item()]) for tile in tiles]
+    return unary_intersection([geobox.extent] + extents)
+
+
+def test_valid_region_matches_unfused_intersection():
+    geobox = GeoBox(4000, 4000, Affine(25, 0, 1500000, 0, -25, -3900000), ALBERS)
+    dsm = FakeTile(FakeDataset(148, -37, 149, -35), FakeDataset(149, -37, 150, -35), FakeDataset(120, -20, 121, -19))
+    scenes = [FakeTile(FakeDataset(148.5, -36.5, 150, -35)),
+              FakeTile(FakeDataset(140, -30, 141, -29)),
+              FakeTile(FakeDataset(146, -38, 151, -34))]
+    footprints = Footprints(ALBERS)
+
+    for scene in scenes:
+        region = footprints.valid_region(geobox, [scene, scene, dsm], keys=[None, None, 'dsm'])
+        expected = original_valid_region(geobox, scene, scene, dsm)
+        assert region.is_empty == expected.is_empty
+        assert abs(region.area - expected.area) < 1e-6 * geobox.extent.area
+
+    # each extent reprojected once, however often the tiles recur
+    assert footprints.reprojected == 3 + len(scenes)
+
+
+def test_extents_are_bounded():
+    footprints = Footprints(ALBERS, max_extents=2)
+    first, second, third = (FakeDataset(148 + offset, -36, 149 + offset, -35) for offset in range(3))
+
+    footprints.extent(first)
+    footprints.extent(second)
+    footprints.extent(first)
+    # the least recently used (second) is dropped
+    footprints.extent(third)
+    footprints.extent(first)
+    assert footprints.reprojected == 3
+    footprints.extent(second)
+    assert footprints.reprojected == 4
+
+
+def test_fused_footprints_are_bounded():
+    footprints = Footprints(ALBERS, max_fused=2)
+    first, second, third = (FakeTile(FakeDataset(148 + offset, -36, 149 + offset, -35)) for offset in range(3))
+
+    kept = footprints.fused(first, key='first')
+    dropped = footprints.fused(second, key='second')
+    footprints.fused(first, key='first')
+    # the least recently used (second) is dropped
+    footprints.fused(third, key='third')
+    assert footprints.fused(first, key='first') is kept
+    assert footprints.fused(second, key='second') is not dropped
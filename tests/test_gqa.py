@@ -0,0 +1,85 @@
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+from datacube.model import Range
+
+from wofs import gqa
+
+Row = namedtuple('Row', ['time'])
+
+
+def t(seconds):
+    return np.datetime64('2020-01-01T00:00:00', 'ns') + np.timedelta64(seconds, 's')
+
+
+# adjacent scenes of a path overlap their neighbours by a few seconds
+SCENES = [(t(0), t(25)), (t(22), t(47)), (t(44), t(69)), (t(600), t(625))]
+
+
+def test_acquired_in_ranges_and_on_their_ends():
+    assert gqa.acquired_in(t(0), SCENES) and gqa.acquired_in(t(625), SCENES)
+    assert gqa.acquired_in(t(600), SCENES)
+    assert gqa.acquired_in(t(69), SCENES)
+    assert not gqa.acquired_in(t(70), SCENES) and not gqa.acquired_in(t(-1), SCENES)
+    assert not gqa.acquired_in(t(626), SCENES)
+
+
+def test_acquired_in_overlapping_scenes():
+    # within the overlap of two scenes, and within the earlier of two overlapping scenes only
+    assert gqa.acquired_in(t(23), SCENES) and gqa.acquired_in(t(45), SCENES)
+    assert gqa.acquired_in(t(21), SCENES) and gqa.acquired_in(t(46), SCENES)
+
+
+def test_acquired_tiles_counts_the_excluded():
+    tiles = {(15, -40, t(10)), (16, -40, t(10)), (15, -40, t(300)), (15, -40, t(47))}
+
+    excluded = gqa.acquired_tiles(tiles, SCENES)
+
+    assert excluded == {(15, -40, t(10)), (16, -40, t(10)), (15, -40, t(47))}
+    assert gqa.acquired_tiles(tiles, []) == set()
+
+
+class FakeIndex:
+    """Level 1 scenes (time, GQA), searched as the database would: a range of GQA never matches a null."""
+
+    supports_spatial_indexes = False
+
+    def __init__(self, scenes, product='ls8_level1_scene', fields=('time', 'gqa_iterative_mean_xy')):
+        self.scenes = scenes
+        self.product = product
+        self.fields = fields
+        self.products = self.datasets = self
+
+    def search(self, **query):
+        return []
+
+    def get_field_names(self, product=None):
+        return set(self.fields)
+
+    def search_returning(self, field_names, **query):
+        if query['product'] != self.product:
+            raise ValueError(f"No such product: {query['product']}")
+        if 'gqa_iterative_mean_xy' not in self.fields:
+            raise ValueError('Unknown field gqa_iterative_mean_xy')
+        limits = query['gqa_iterative_mean_xy']
+        for time, gqa_value in self.scenes:
+            if gqa_value is not None and limits.begin <= gqa_value and (limits.end is None or gqa_value < limits.end):
+                yield Row(Range(*time))
+
+
+def test_poor_gqa_times_are_those_of_the_limit_or_worse():
+    scenes = [(SCENES[0], 0.5), (SCENES[1], 1.0), (SCENES[2], None), (SCENES[3], 3.2)]
+    index = FakeIndex([(tuple(time.astype('datetime64[us]').astype(datetime) for time in scene), value)
+                       for scene, value in scenes])
+
+    # the scene without a GQA is kept
+    assert gqa.poor_gqa_times(index, 'ls8_level1_scene', None, {}, 1) == [SCENES[1], SCENES[3]]
+
+
+def test_poor_gqa_times_without_the_product_or_the_gqa_field_filter_nothing():
+    scenes = [((datetime(2020, 1, 1), datetime(2020, 1, 1, 0, 0, 25)), 3.2)]
+
+    assert gqa.poor_gqa_times(FakeIndex(scenes), 'ls7_level1_scene', None, {}, 1) == []
+    assert gqa.poor_gqa_times(FakeIndex(scenes, fields=('time',)), 'ls8_level1_scene', None, {}, 1) == []
+    assert gqa.poor_gqa_times(FakeIndex(scenes), 'ls8_level1_scene', None, {}, 1) != []
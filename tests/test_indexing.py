@@ -0,0 +1,78 @@
+import threading
+import uuid
+from contextlib import contextmanager
+
+from wofs.indexing import BatchIndexer, close_all
+
+
+class FakeDataset:
+    def __init__(self, valid=True):
+        self.id = uuid.uuid4()
+        self.valid = valid
+
+
+class FakeIndex:
+    """In-memory index, committing the datasets added in each transaction together."""
+
+    def __init__(self):
+        self.committed = []
+        self.transactions = []
+        self._pending = threading.local()
+        self.datasets = self
+
+    @contextmanager
+    def transaction(self):
+        self._pending.added = []
+        try:
+            yield
+            self.transactions.append(len(self._pending.added))
+            self.committed.extend(self._pending.added)
+        finally:
+            self._pending.added = None
+
+    def add(self, dataset, with_lineage=True, sources_policy=None):
+        if not dataset.valid:
+            raise ValueError('invalid dataset')
+        added = getattr(self._pending, 'added', None)
+        if added is None:
+            self.committed.append(dataset.id)
+        else:
+            added.append(dataset.id)
+
+
+def test_datasets_are_added_in_batches():
+    index = FakeIndex()
+    datasets = [FakeDataset() for _ in range(7)]
+
+    with BatchIndexer(index, batch_size=3, flush_interval=60) as indexer:
+        indexer.add(datasets)
+
+    assert index.committed == [dataset.id for dataset in datasets]
+    assert index.transactions == [3, 3, 1]
+    assert indexer.added == 7 and not indexer.failed
+
+
+def test_failures_are_reported_per_dataset():
+    index = FakeIndex()
+    good, bad = FakeDataset(), FakeDataset(valid=False)
+    reports = []
+
+    with BatchIndexer(index, batch_size=10) as indexer:
+        indexer.add([good, bad], done=reports.append)
+        indexer.add([FakeDataset()], done=reports.append)
+
+    assert good.id in index.committed and bad.id not in index.committed and len(index.committed) == 2
+    assert list(reports[0]) == [bad.id] and isinstance(reports[0][bad.id], ValueError)
+    assert reports[1] == {}
+    assert list(indexer.failed) == [bad.id]
+
+
+def test_close_all_indexes_queued_datasets():
+    index = FakeIndex()
+    datasets = [FakeDataset() for _ in range(3)]
+    indexer = BatchIndexer(index, batch_size=10, flush_interval=60)
+    indexer.add(datasets)
+
+    close_all(timeout=10)
+
+    assert index.committed == [dataset.id for dataset in datasets]
@@ -0,0 +1,92 @@
+import json
+import threading
+
+from wofs import journal
+
+
+def make_task(tmp_path, x, y=-40):
+    return {'tile_index': (x, y, '2020-01-0%dT00:00:00' % (x % 9 + 1)),
+            'file_path': str(tmp_path / f'wofs_{x}_{y}.nc')}
+
+
+def write_output(task):
+    with open(task['file_path'], 'wb') as fout:
+        fout.write(task['file_path'].encode())
+
+
+def test_completed_tasks_are_skipped_on_restart(tmp_path):
+    path = journal.journal_path(tmp_path / 'tasks.bin')
+    tasks = [make_task(tmp_path, x) for x in range(4)]
+
+    with journal.Journal(path) as first_run:
+        for task in first_run.track(first_run.pending(tasks[:2])):
+            write_output(task)
+            first_run.record(task, task['file_path'], indexed=True)
+        # a torn write of the run being killed
+        first_run._file.write('{"key": "1_-40_20')
+
+    with journal.Journal(path) as second_run:
+        assert [second_run.is_complete(task) for task in tasks] == [True, True, False, False]
+        assert list(second_run.pending(tasks)) == tasks[2:]
+        entry = second_run.completed[journal.task_key(tasks[0])]
+        assert entry['size'] == len(tasks[0]['file_path'].encode())
+        assert entry == dict(entry, **journal.file_stamp(tasks[0]['file_path']))
+
+
+def test_unindexed_missing_or_truncated_outputs_are_not_complete(tmp_path):
+    path = journal.journal_path(tmp_path / 'tasks.bin')
+    unindexed, missing, truncated = make_task(tmp_path, 1), make_task(tmp_path, 2), make_task(tmp_path, 3)
+
+    with journal.Journal(path) as run:
+        for task in (unindexed, missing, truncated):
+            write_output(task)
+        run.record(unindexed, unindexed['file_path'], indexed=False)
+        run.record(missing, missing['file_path'], indexed=True)
+        run.record(truncated, truncated['file_path'], indexed=True)
+    (tmp_path / 'wofs_2_-40.nc').unlink()
+    with open(truncated['file_path'], 'r+b') as fout:
+        fout.truncate(3)
+
+    assert not journal.Journal(path).is_complete(unindexed)
+    assert journal.Journal(path, require_indexed=False).is_complete(unindexed)
+    assert not journal.Journal(path).is_complete(missing)
+    assert not journal.Journal(path).is_complete(truncated)
+
+
+def test_parts_are_merged_and_interrupted_tasks_recorded(tmp_path):
+    path = journal.journal_path(tmp_path / 'tasks.bin')
+    done, interrupted = make_task(tmp_path, 1), make_task(tmp_path, 2)
+
+    ranks = [journal.Journal(path, part=rank) for rank in range(2)]
+    write_output(done)
+    ranks[0].record(done, done['file_path'], indexed=True)
+    next(ranks[1].track([interrupted]))
+    journal.interrupt_all()
+    for rank in ranks:
+        rank.close()
+
+    restarted = journal.Journal(path)
+    assert restarted.is_complete(done) and not restarted.is_complete(interrupted)
+    [entry] = [json.loads(line) for line in open(f'{path}.1')]
+    assert entry['status'] == 'interrupted' and entry['key'] == journal.task_key(interrupted)
+
+
+def test_concurrent_records_keep_whole_lines(tmp_path):
+    path = journal.journal_path(tmp_path / 'tasks.bin')
+    tasks = [make_task(tmp_path, x) for x in range(40)]
+    for task in tasks:
+        write_output(task)
+
+    with journal.Journal(path) as run:
+        list(run.track(tasks))
+        threads = [threading.Thread(target=lambda share: [run.record(task, task['file_path'], indexed=True)
+                                                          for task in share],
+                                    args=(tasks[start::4],)) for start in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not run.in_flight
+
+    entries = [json.loads(line) for line in open(path)]
+    assert sorted(entry['key'] for entry in entries) == sorted(journal.task_key(task) for task in tasks)
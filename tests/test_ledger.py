@@ -0,0 +1,39 @@
+from wofs.ledger import Ledger, existing_paths, ledger_path, task_file_fingerprint
+
+
+def test_existing_paths_are_matched_against_directory_listings(tmp_path):
+    for cell in ('15_-40', '16_-40'):
+        (tmp_path / cell).mkdir()
+    (tmp_path / '15_-40' / 'a.nc').touch()
+    (tmp_path / '16_-40' / 'b.nc').touch()
+    paths = [tmp_path / '15_-40' / 'a.nc', tmp_path / '15_-40' / 'b.nc',
+             tmp_path / '16_-40' / 'b.nc', tmp_path / '17_-40' / 'a.nc']
+
+    assert existing_paths(paths, workers=2) == [True, False, True, False]
+
+
+def test_ledger_round_trip_and_pending(tmp_path):
+    outputs = Ledger.from_flags([True, False, False, True])
+    outputs.save(tmp_path / 'tasks.bin.ledger')
+    loaded = Ledger.load(tmp_path / 'tasks.bin.ledger')
+
+    assert (loaded.existing, loaded.missing) == ([0, 3], [1, 2])
+    assert len(loaded) == 4
+    assert list(loaded.pending(['a', 'b', 'c', 'd'])) == ['b', 'c']
+
+
+def test_ledger_only_matches_its_task_file(tmp_path):
+    task_file = tmp_path / 'tasks.bin'
+    task_file.write_bytes(b'tasks' * 100000)
+    outputs = Ledger.from_flags([True, False], task_file_fingerprint(task_file))
+    outputs.save(ledger_path(task_file))
+
+    loaded = Ledger.load(ledger_path(task_file))
+    assert loaded.matches(task_file)
+    # a shard of the task file, from its second task
+    assert list(loaded.pending(['b'], start=1)) == ['b']
+
+    # regenerated, with as many tasks
+    task_file.write_bytes(b'tasks' * 99999 + b'other')
+    assert not loaded.matches(task_file)
+    assert not Ledger([0], [1]).matches(task_file)
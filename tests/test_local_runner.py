@@ -0,0 +1,60 @@
+import os
+import time
+
+from wofs.local_runner import TaskFailed, TaskTimedOut, run_tasks
+
+
+def square_or_fail(task):
+    if task == 4:
+        raise ValueError('no fours')
+    return task * task, os.getpid()
+
+
+def test_run_tasks_results_failures_and_recycling():
+    results = {task: (result, error) for task, result, error in
+               run_tasks(range(9), square_or_fail, workers=2, max_in_flight=3, tasks_per_worker=2)}
+
+    assert sorted(results) == list(range(9))
+    assert isinstance(results[4][1], TaskFailed) and 'no fours' in str(results[4][1])
+    assert all(results[task][0][0] == task * task for task in results if task != 4)
+
+    # 8 successful tasks, each worker process recycled after 2
+    pids = {result[1] for result, error in results.values() if error is None}
+    assert len(pids) >= 4
+
+
+def nap(task):
+    time.sleep(60 if task == 'hang' else 0.6)
+    return task
+
+
+def test_queued_tasks_are_timed_from_their_start():
+    # four tasks of 0.6s queued on one worker take 2.4s, but none runs for 1s
+    results = list(run_tasks(range(4), nap, workers=1, max_in_flight=4, task_timeout=1))
+
+    assert sorted(task for task, result, error in results if error is None) == [0, 1, 2, 3]
+
+
+def test_timed_out_task_is_killed():
+    started = time.monotonic()
+    results = {task: error for task, result, error in
+               run_tasks(['hang', 1, 2], nap, workers=1, max_in_flight=3, task_timeout=1)}
+
+    assert isinstance(results['hang'], TaskTimedOut)
+    # the worker running it was replaced, and ran the other tasks
+    assert results[1] is None and results[2] is None
+    assert time.monotonic() - started < 30
+
+
+def exit_on_one(task):
+    if task == 1:
+        os._exit(1)
+    return task
+
+
+def test_dead_worker_fails_its_task_without_a_timeout():
+    results = {task: (result, error) for task, result, error in run_tasks(range(3), exit_on_one, workers=1)}
+
+    assert isinstance(results[1][1], TaskFailed) and 'exit code 1' in str(results[1][1])
+    # the worker was replaced, and ran the other tasks
+    assert results[0] == (0, None) and results[2] == (2, None)
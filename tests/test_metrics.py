@@ -0,0 +1,48 @@
+import threading
+import tracemalloc
+
+import numpy
+
+from wofs import metrics
+
+
+def allocate(started, release):
+    with metrics.measure('allocate'):
+        data = numpy.ones(2 ** 20)
+        started.wait()
+        release.wait()
+        del data
+
+
+def test_memory_is_only_traced_when_enabled():
+    metrics.reset()
+    with metrics.measure('untraced'):
+        assert not tracemalloc.is_tracing()
+        numpy.ones(1000)
+    assert 'peak_bytes' not in metrics.snapshot()['untraced']
+
+
+def test_concurrent_stages_keep_their_peaks():
+    metrics.reset()
+    metrics.trace_memory()
+    try:
+        started, release = threading.Barrier(3), threading.Event()
+        threads = [threading.Thread(target=allocate, args=(started, release)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        # a stage starting and stopping meanwhile neither stops tracing nor resets the peak
+        with metrics.measure('short'):
+            pass
+        assert tracemalloc.is_tracing()
+        release.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        metrics.trace_memory(False)
+
+    assert not tracemalloc.is_tracing()
+    stats = metrics.snapshot()
+    assert stats['allocate']['calls'] == 2
+    assert stats['allocate']['peak_bytes'] >= 8 * 2 ** 20
+    assert stats['short']['peak_bytes'] >= 0
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import numpy
+import pytest
+
+from wofs.pipeline import run_pipeline
+
+
+def test_pipeline_results_and_failures():
+    def load(task):
+        if task == 3:
+            raise IOError('unreadable')
+        return numpy.full(10, task)
+
+    def compute(task, inputs):
+        if task == 5:
+            raise ValueError('bad data')
+        return inputs * 2
+
+    written = []
+
+    def write(task, output):
+        written.append(task)
+        return int(output.sum())
+
+    results = {task: (result, error) for task, result, error in
+               run_pipeline(range(8), load, compute, write, prefetch=2)}
+
+    assert sorted(results) == list(range(8))
+    assert written == [0, 1, 2, 4, 6, 7]
+    assert results[4] == (80, None)
+    assert isinstance(results[3][1], IOError)
+    assert isinstance(results[5][1], ValueError)
+
+
+@pytest.mark.parametrize('max_bytes, most_in_flight', [(None, 4), (250, 2)])
+def test_pipeline_memory_cap(max_bytes, most_in_flight):
+    in_flight = set()
+    peak = []
+    loaded = threading.Condition()
+
+    def load(task):
+        with loaded:
+            in_flight.add(task)
+            peak.append(len(in_flight))
+            loaded.notify_all()
+        return numpy.zeros(100, dtype=numpy.uint8)
+
+    def compute(task, inputs):
+        # hold the first task until the loader has run as far ahead as it can, and no further
+        with loaded:
+            if task == 0:
+                assert loaded.wait_for(lambda: len(in_flight) >= most_in_flight, timeout=10)
+                assert not loaded.wait_for(lambda: len(in_flight) > most_in_flight, timeout=0.2)
+        return inputs
+
+    def write(task, output):
+        with loaded:
+            in_flight.discard(task)
+
+    list(run_pipeline(range(10), load, compute, write, prefetch=2, max_bytes=max_bytes))
+
+    # uncapped: one computing, two queued for compute, and one waiting to queue
+    if max_bytes is not None:
+        assert max(peak) == most_in_flight
+
+
+def test_pipeline_loads_and_writes_never_overlap():
+    active = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def io(name):
+        with lock:
+            active.append(name)
+            if len(active) > 1:
+                overlaps.append(tuple(active))
+        time.sleep(0.005)
+        with lock:
+            active.remove(name)
+
+    def load(task):
+        io('load')
+        return numpy.full(10, task)
+
+    def write(task, output):
+        io('write')
+
+    results = list(run_pipeline(range(30), load, lambda task, inputs: inputs, write, prefetch=3))
+
+    assert len(results) == 30 and all(error is None for _, _, error in results)
+    assert not overlaps
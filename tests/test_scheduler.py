@@ -0,0 +1,70 @@
+from pathlib import Path
+
+from wofs import scheduler
+
+
+class ScriptedChannel:
+    """Coordinator channel where workers take turns asking, recording what each was handed."""
+
+    def __init__(self, workers):
+        self.turns = list(range(workers)) * 100
+        self.handed = []
+
+    def receive(self):
+        return self.turns.pop(0), {'tasks': 0, 'busy': 0.0, 'elapsed': 1.0}
+
+    def send(self, worker, batch):
+        self.handed.append((worker, batch))
+
+
+def test_coordinate_hands_out_costliest_first():
+    channel = ScriptedChannel(workers=2)
+
+    reports = scheduler.coordinate(range(10), channel, workers=2, batch_size=2, cost=lambda task: task % 4)
+
+    handed = [task for _, batch in channel.handed for task in batch]
+    assert sorted(handed) == list(range(10))
+    assert [task % 4 for task in handed] == sorted((task % 4 for task in range(10)), reverse=True)
+    # batches shrink towards the end, and each worker is finally handed nothing
+    assert len(channel.handed[0][1]) == 2 and len(channel.handed[-3][1]) == 1
+    assert [batch for _, batch in channel.handed[-2:]] == [[], []]
+    assert sorted(reports) == [0, 1]
+
+
+def touch(path):
+    Path(path).touch()
+
+
+def test_run_local_processes_every_task(tmp_path):
+    tasks = [str(tmp_path / f'task_{number}') for number in range(12)]
+
+    reports = scheduler.run_local(tasks, touch, workers=3, batch_size=2)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(Path(task).name for task in tasks)
+    assert sorted(reports) == [0, 1, 2]
+    assert sum(report['tasks'] for report in reports.values()) == 12
+
+
+def test_coordinate_reads_tasks_a_lookahead_at_a_time():
+    read = []
+
+    def tasks():
+        for task in range(20):
+            read.append(task)
+            yield task
+
+    channel = ScriptedChannel(workers=1)
+    original_send = channel.send
+
+    def send(worker, batch):
+        # never more than the look-ahead read beyond what was handed out
+        assert len(read) - sum(len(handed) for _, handed in channel.handed) <= 4 + len(batch)
+        original_send(worker, batch)
+
+    channel.send = send
+    scheduler.coordinate(tasks(), channel, workers=1, cost=lambda task: task % 3, lookahead=4)
+
+    handed = [task for _, batch in channel.handed for task in batch]
+    assert sorted(handed) == list(range(20))
+    # the costliest of the first four first
+    assert handed[0] == 2
@@ -0,0 +1,89 @@
+import os
+from types import SimpleNamespace
+
+import numpy
+import xarray
+from datacube import Datacube
+from datacube.api.grid_workflow import GridWorkflow, Tile
+from datacube.api.query import query_group_by
+from datacube.testutils import gen_tiff_dataset
+
+from wofs import shm
+from wofs.local_runner import run_tasks
+
+
+def double_in_place(item):
+    shared, output = item
+    dataset = shm.attach_dataset(shared)
+    if dataset.attrs.get('crash'):
+        os._exit(1)
+    shm.attach(output)[...] = dataset.band.values * 2
+    return os.getpid()
+
+
+def test_shared_memory_hand_off():
+    dataset = xarray.Dataset({'band': (('y', 'x'), numpy.arange(12, dtype=numpy.int16).reshape(3, 4))},
+                             coords={'y': [0, 1, 2], 'x': [0, 1, 2, 3]})
+
+    with shm.SharedArrayPool(run_id='handoff') as pool:
+        shared = shm.share_dataset(pool, dataset)
+        _, output = pool.allocate((3, 4), numpy.int16)
+
+        [(_, pid, error)] = run_tasks([(shared, output)], double_in_place, workers=1)
+
+        assert error is None and pid != os.getpid()
+        numpy.testing.assert_array_equal(pool.view(output), dataset.band.values * 2)
+
+        # released segments are reused
+        pool.release(output, *shm.dataset_references(shared))
+        _, again = pool.allocate((4, 3), numpy.int16)
+        assert again.name in {output.name} | {ref.name for ref in shm.dataset_references(shared)}
+
+    assert not [name for name in os.listdir(shm.SHM_DIR) if name.startswith('wofs_handoff_')]
+
+
+def test_worker_crash_leaves_no_segments():
+    dataset = xarray.Dataset({'band': (('x',), numpy.ones(4))}, attrs={'crash': 1})
+
+    with shm.SharedArrayPool(run_id='crash') as pool:
+        item = (shm.share_dataset(pool, dataset), pool.allocate((4,), numpy.float64)[1])
+        [(_, _, error)] = run_tasks([item], double_in_place, workers=1)
+        assert error is not None
+
+    assert not [name for name in os.listdir(shm.SHM_DIR) if name.startswith('wofs_crash_')]
+
+
+def test_tiles_load_straight_into_shared_memory(tmp_path):
+    rng = numpy.random.default_rng(0)
+    bands = [SimpleNamespace(name=name, values=rng.integers(0, 4000, (40, 50)).astype(numpy.int16), nodata=-999)
+             for name in ('red', 'nir')]
+    dataset, geobox = gen_tiff_dataset(bands, tmp_path, crs='EPSG:3577', resolution=(25, -25),
+                                       offset=(1500000, -3900000))
+    tile = Tile(Datacube.group_datasets([dataset], query_group_by('time')), geobox)
+    # a window of the tile, partly outside the data
+    window = Tile(tile.sources, geobox[slice(10, 60), slice(20, 50)])
+
+    with shm.SharedArrayPool(run_id='load') as pool:
+        references = shm.tile_arrays(pool, tile, ['red', 'nir'])
+        shared = shm.load_tile(window, references)
+        loaded = shm.attach_dataset(shared)
+
+        expected = GridWorkflow.load(window, measurements=['red', 'nir'])
+        for name in ('red', 'nir'):
+            numpy.testing.assert_array_equal(loaded[name].values, expected[name].values)
+            assert loaded[name].nodata == -999
+            # in place, in the segments allocated
+            assert shared['data_vars'][name][1].name == references[name].name
+        assert list(loaded.x.values) == list(expected.x.values)
+        assert list(loaded.time.values) == list(expected.time.values)
+
+
+def test_remove_stale_segments(tmp_path):
+    (tmp_path / 'wofs_0123abcd_abc').touch()
+    (tmp_path / 'wofs_0123abcdef_abc').touch()
+    (tmp_path / 'wofs_4567_abc').touch()
+
+    shm.remove_stale_segments('0123abcd', tmp_path)
+
+    # only the segments of that run
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['wofs_0123abcdef_abc', 'wofs_4567_abc']
@@ -0,0 +1,141 @@
+import numpy
+import pytest
+import xarray
+from affine import Affine
+from datacube.api.grid_workflow import Tile
+from datacube.utils.geometry import CRS, GeoBox, polygon
+
+from wofs import source_window
+from wofs.constants import MASKED_CLOUD, NO_DATA
+
+ALBERS = CRS('EPSG:3577')
+LEFT, TOP = 1500000, -3900000
+TILE = GeoBox(160, 160, Affine(25, 0, LEFT, 0, -25, TOP), ALBERS)
+# padded for the PQ dilation, and buffered for terrain shadows
+PQ = GeoBox(166, 166, Affine(25, 0, LEFT - 75, 0, -25, TOP + 75), ALBERS)
+DSM = GeoBox(240, 240, Affine(25, 0, LEFT - 1000, 0, -25, TOP + 1000), ALBERS)
+BANDS = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']
+TIME = numpy.array(['2010-06-01T00:30'], dtype='datetime64[ns]')
+
+
+class FakeDataset:
+    def __init__(self, extent):
+        self.extent = extent
+
+
+def swath_edge(right_top, right_bottom):
+    """Footprint of a scene whose swath edge crosses the tile, from x offsets (metres) at its top and bottom"""
+    return polygon([(LEFT - 1000, TOP + 1000), (LEFT + right_top, TOP + 1000),
+                    (LEFT + right_bottom, TOP - 5000), (LEFT - 1000, TOP - 5000), (LEFT - 1000, TOP + 1000)], ALBERS)
+
+
+def sources(*datasets):
+    values = numpy.empty(1, dtype=object)
+    values[0] = tuple(datasets)
+    return xarray.DataArray(values, dims=['time'], coords={'time': TIME})
+
+
+def coords(geobox):
+    return {'time': TIME, **{dim: coord.values for dim, coord in geobox.coordinates.items()}}
+
+
+def make_inputs(data_right_top, data_right_bottom, seed=0):
+    """Source bands with data left of a swath edge, PQ with scattered clouds, and hilly DSM"""
+    rng = numpy.random.default_rng(seed)
+    x, y = numpy.meshgrid(TILE.coordinates['x'].values, TILE.coordinates['y'].values)
+    edge = LEFT + data_right_bottom + (y - TOP + 5000) / 6000 * (data_right_top - data_right_bottom)
+    inside = x <= edge
+    source = xarray.Dataset({band: (('time', 'y', 'x'),
+                                    numpy.where(inside, rng.integers(0, 4000, inside.shape), -999)[None]
+                                    .astype(numpy.int16), {'nodata': -999})
+                             for band in BANDS}, coords=coords(TILE), attrs={'crs': ALBERS})
+
+    pqa = numpy.full(PQ.shape, 0x3FFF, dtype=numpy.int16)
+    pqa[rng.random(PQ.shape) < 0.01] &= ~0x0C00
+    pqa[rng.random(PQ.shape) < 0.01] &= ~0x3000
+    # a cloud in the padding above the tile, dilated into it
+    pqa[1, 23] &= ~0x0C00
+    pq = xarray.Dataset({'pqa': (('time', 'y', 'x'), pqa[None], {'nodata': 0})}, coords=coords(PQ),
+                        attrs={'crs': ALBERS})
+
+    rows, cols = numpy.mgrid[0:DSM.height, 0:DSM.width]
+    elevation = 300 * (1 + numpy.sin(cols / 17.0) * numpy.cos(rows / 23.0))
+    dsm = xarray.Dataset({'elevation': (('y', 'x'), elevation.astype(numpy.float32))},
+                         coords={dim: coord.values for dim, coord in DSM.coordinates.items()},
+                         attrs={'crs': ALBERS})
+    return source, pq, dsm
+
+
+class FakeLoader:
+    """Loads the windows of whole in-memory tiles, recording the shape of each load"""
+
+    def __init__(self, task, source, pq):
+        self.data = {id(task['source_tile'].sources): (TILE, source), id(task['pq_tile'].sources): (PQ, pq)}
+        self.loaded = []
+
+    def __call__(self, tile, measurements=None):
+        whole_geobox, whole = self.data[id(tile.sources)]
+        col = round((tile.geobox.affine.c - whole_geobox.affine.c) / 25)
+        row = round((whole_geobox.affine.f - tile.geobox.affine.f) / 25)
+        self.loaded.append(tile.geobox.shape)
+        return whole.isel(y=slice(row, row + tile.geobox.height), x=slice(col, col + tile.geobox.width))
+
+
+def make_task(footprint):
+    return {'source_tile': Tile(sources(FakeDataset(footprint)), TILE),
+            'pq_tile': Tile(sources(FakeDataset(footprint)), PQ),
+            'valid_region': footprint.intersection(TILE.extent),
+            'file_path': 'wofs.nc'}
+
+
+@pytest.mark.parametrize('edge', [(2000, 1200), (1200, 2600)])
+def test_cropped_computation_matches_whole_tile(edge):
+    task = make_task(swath_edge(*edge))
+    source, pq, dsm = make_inputs(*edge)
+    results, loads = {}, {}
+    for crop in (True, False):
+        loads[crop] = FakeLoader(task, source, pq)
+        windowed_source, windowed_pq, window = source_window.load_inputs(task, loads[crop], BANDS, crop=crop)
+        assert (window is not None) == crop
+        results[crop] = source_window.compute_tile(windowed_source, windowed_pq, dsm, TILE)
+
+    cropped, whole = results[True], results[False]
+    # only the window was loaded, and the pq with the halo of the dilation
+    rows, cols = source_window.computation_window(task)
+    assert cols.stop < TILE.width
+    assert loads[True].loaded == [(rows.stop - rows.start, cols.stop - cols.start),
+                                  (rows.stop - rows.start + 6, cols.stop - cols.start + 6)]
+    assert loads[False].loaded == [TILE.shape, PQ.shape]
+    assert cropped.dtype == whole.dtype == numpy.int16
+    numpy.testing.assert_array_equal(cropped.values, whole.values)
+    assert list(cropped.x.values) == list(whole.x.values) and list(cropped.y.values) == list(whole.y.values)
+    # the cloud in the padding of the pq tile reaches into the window, and there is no data beyond it
+    assert whole.values[0, 20] & MASKED_CLOUD
+    assert (whole.values[:, cols.stop:] == NO_DATA).all()
+
+
+def test_pq_window_has_the_dilation_halo():
+    task = make_task(swath_edge(2000, 1200))
+    rows, cols = source_window.computation_window(task)
+
+    pq_rows, pq_cols = source_window.pq_window(task, (rows, cols))
+
+    # the pq tile is padded by 3 pixels, and the window has 3 more
+    assert (pq_cols.start, pq_cols.stop) == (cols.start, cols.stop + 6)
+    assert (pq_rows.start, pq_rows.stop) == (0, PQ.height)
+
+
+def test_data_beyond_the_footprint_loads_the_whole_tile():
+    # the footprint in the metadata falls short of the data
+    task = make_task(swath_edge(1000, 600))
+    source, pq, _ = make_inputs(2000, 1200)
+    load = FakeLoader(task, source, pq)
+
+    loaded_source, loaded_pq, window = source_window.load_inputs(task, load, BANDS)
+
+    assert window is None
+    assert loaded_source.blue.shape[1:] == TILE.shape and loaded_pq.pqa.shape[1:] == PQ.shape
+    # the window first, then the whole tiles
+    assert load.loaded[1:] == [TILE.shape, PQ.shape]
+    assert source_window.data_on_window_edge(loaded_source.isel(x=slice(0, 44)), (slice(0, 160), slice(0, 44)),
+                                             TILE.shape)
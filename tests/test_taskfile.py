@@ -0,0 +1,145 @@
+import pickle
+import uuid
+from functools import partial
+
+import numpy
+import pytest
+import xarray
+from affine import Affine
+from datacube.api.grid_workflow import Tile
+from datacube.testutils import mk_sample_dataset
+from datacube.ui import task_app
+from datacube.utils.geometry import CRS, GeoBox
+
+from wofs import taskfile
+
+
+def make_tasks(count):
+    return [{'tile_index': (number, -40, number), 'file_path': f'wofs_{number}.nc'} for number in range(count)]
+
+
+def test_indexed_task_file(tmp_path):
+    path = tmp_path / 'tasks.bin'
+    tasks = make_tasks(10)
+
+    assert taskfile.save_tasks({'product': 'wofs'}, iter(tasks), path) == 10
+
+    indexed = taskfile.TaskFile(path)
+    assert indexed.version == taskfile.VERSION
+    assert indexed.config == {'product': 'wofs'}
+    assert len(indexed) == 10
+    assert indexed[7] == tasks[7] and indexed[-1] == tasks[-1]
+    assert list(indexed.read(3, 5)) == tasks[3:5]
+    with pytest.raises(IndexError):
+        indexed[10]
+
+    shards = [list(indexed.shard(shard, 3)) for shard in range(3)]
+    assert [len(shard) for shard in shards] == [3, 3, 4]
+    assert [task for shard in shards for task in shard] == tasks
+
+    config, loaded = taskfile.load_tasks(path)
+    assert config == {'product': 'wofs'} and list(loaded) == tasks
+
+
+def test_no_tasks_leaves_no_file(tmp_path):
+    assert taskfile.save_tasks({}, [], tmp_path / 'tasks.bin') == 0
+    assert not list(tmp_path.iterdir())
+
+
+def test_older_task_files_still_load(tmp_path):
+    path = tmp_path / 'tasks.bin'
+    tasks = make_tasks(5)
+    task_app.save_tasks({'product': 'wofs'}, tasks, str(path))
+
+    older = taskfile.TaskFile(path)
+    assert older.version == 0 and len(older) == 5
+    assert older[2] == tasks[2]
+    assert list(older.shard(1, 2)) == tasks[2:]
+    assert list(taskfile.load_shard(path, 0, 2)[1]) == tasks[:2]
+
+
+class FakeIndex:
+    def __init__(self, datasets):
+        self.by_id = {str(dataset.id): dataset for dataset in datasets}
+        self.fetched = []
+        self.datasets = self
+
+    def get(self, dataset_id, include_sources=False):
+        self.fetched.append(dataset_id)
+        return self.by_id[dataset_id]
+
+
+def make_dataset(product='nbart'):
+    dataset_id = str(uuid.uuid4())
+    dataset = mk_sample_dataset([{'name': 'red', 'path': 'red.tif'}], uri=f'file:///data/{dataset_id}.yaml',
+                                product_name=product, id=dataset_id)
+    # as fetched with its lineage
+    dataset.metadata_doc['lineage'] = {'source_datasets': {'level1': {'id': str(uuid.uuid4()), 'x': 'x' * 10000}}}
+    return dataset
+
+
+def make_tile(datasets):
+    sources = numpy.empty(1, dtype=object)
+    sources[0] = tuple(datasets)
+    sources = xarray.DataArray(sources, dims=['time'], coords=[numpy.array(['2020-01-01'], dtype='datetime64[ns]')])
+    sources.time.attrs['units'] = 'seconds since 1970-01-01 00:00:00'
+    return Tile(sources, GeoBox(4000, 4000, Affine(25, 0, 1500000, 0, -25, -3900000), CRS('EPSG:3577')))
+
+
+def test_compact_tasks_are_rehydrated_from_the_task_file(tmp_path):
+    dsm = [make_dataset('dsm'), make_dataset('dsm')]
+    nbart = [make_dataset() for _ in range(3)]
+    tasks = [{'source_tile': make_tile([dataset]), 'dsm_tile': make_tile(dsm), 'file_path': f'wofs_{number}.nc'}
+             for number, dataset in enumerate(nbart)]
+
+    compact = [taskfile.compact_task(task) for task in tasks]
+    assert len(pickle.dumps(compact)) * 10 < len(pickle.dumps(tasks))
+    assert compact[0]['dsm_tile'].geobox == tasks[0]['dsm_tile'].geobox
+
+    index = FakeIndex(dsm + nbart)
+    taskfile.save_tasks({}, compact, tmp_path / 'tasks.bin', datasets=partial(taskfile.fetch_datasets, index))
+    # each dataset, shared by the tasks or not, is fetched (with its lineage) and saved once
+    assert sorted(index.fetched) == sorted(str(dataset.id) for dataset in dsm + nbart)
+
+    saved = taskfile.TaskFile(tmp_path / 'tasks.bin')
+    assert [task['dsm_tile'].ids + task['source_tile'].ids for task in saved.read(1, 3)] == \
+        [task['dsm_tile'].ids + task['source_tile'].ids for task in compact[1:]]
+    rehydrated = taskfile.rehydrate_tasks(saved.datasets, saved)
+
+    for task, again in zip(tasks, rehydrated):
+        assert again['file_path'] == task['file_path']
+        for name in ('source_tile', 'dsm_tile'):
+            assert again[name].geobox == task[name].geobox
+            assert [dataset.id for dataset in again[name].sources.values[0]] == \
+                [dataset.id for dataset in task[name].sources.values[0]]
+            assert again[name].sources.time.equals(task[name].sources.time)
+            assert again[name].sources.time.attrs == task[name].sources.time.attrs
+        dataset, original = again['source_tile'].sources.values[0][0], task['source_tile'].sources.values[0][0]
+        assert dataset.metadata_doc == original.metadata_doc and dataset.uris == original.uris
+        assert dataset.type.name == 'nbart' and again['dsm_tile'].product.name == 'dsm'
+
+    with pytest.raises(KeyError):
+        saved.datasets([uuid.uuid4()])
+
+
+def test_datasets_are_fetched_once_when_saving_and_never_when_rehydrating(tmp_path):
+    # the tasks of two cells, sharing their DSM datasets, and scenes spanning both cells
+    dsm = [make_dataset('dsm') for _ in range(4)]
+    scenes = [make_dataset() for _ in range(10)]
+    tasks = [{'source_tile': make_tile([scene]), 'dsm_tile': make_tile(dsm[cell * 2:cell * 2 + 2]),
+              'file_path': f'wofs_{cell}_{number}.nc'}
+             for cell in range(2) for number, scene in enumerate(scenes)]
+
+    index = FakeIndex(dsm + scenes)
+    taskfile.save_tasks({}, (taskfile.compact_task(task) for task in tasks), tmp_path / 'tasks.bin',
+                        datasets=partial(taskfile.fetch_datasets, index))
+    assert sorted(index.fetched) == sorted(str(dataset.id) for dataset in dsm + scenes)
+
+    # any number of batches, on any number of workers, costs no queries
+    index.fetched.clear()
+    for shard in range(3):
+        saved = taskfile.TaskFile(tmp_path / 'tasks.bin')
+        tasks = list(saved.shard(shard, 3))
+        for start in range(0, len(tasks), 4):
+            assert len(taskfile.rehydrate_tasks(saved.datasets, tasks[start:start + 4])) == len(tasks[start:start + 4])
+    assert index.fetched == []
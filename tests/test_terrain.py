@@ -2,13 +2,27 @@
 Test some of the terrain masking functions
 """
 
+from types import SimpleNamespace
+
+import numpy
 import pytest
 import hypothesis
+import xarray
+from affine import Affine
 from hypothesis import given
 from hypothesis import strategies as st
 
-from datacube.utils.geometry import CRS
-from wofs.terrain import vector_to_crs
+from datacube import Datacube
+from datacube.api.grid_workflow import Tile
+from datacube.api.query import query_group_by
+from datacube.testutils import gen_tiff_dataset
+from datacube.utils.geometry import CRS, GeoBox
+from pandas import to_datetime
+from wofs import metrics
+from wofs.filters import terrain_filter, terrain_filter_stack
+from wofs.terrain import (vector_to_crs, solar_vector, shadow_padding, relief, shadows_and_slope, _cast_shadows,
+                          padding_trim, sun_altitude, tile_relief,
+                          LIT, SHADED, MAX_RELIEF_M, MIN_SUN_ALTITUDE_DEG, MAX_TERRAIN_PADDING, TERRAIN_MODES)
 
 # Use slightly less than the projected boundary from
 # https://spatialreference.org/ref/epsg/gda94-australian-albers/
@@ -37,3 +51,167 @@ def test_vector_to_crs(orig_point, orig_vect):
 
     assert orig_point == pytest.approx(new_point, abs=1e-6)
     assert orig_vect == pytest.approx(new_vect, abs=1e-6)
+
+
+def test_shadow_padding():
+    # worst case matches the fixed padding used for task generation
+    assert MAX_TERRAIN_PADDING == 6850
+    assert shadow_padding(MAX_RELIEF_M, MIN_SUN_ALTITUDE_DEG, 25, max_padding=MAX_TERRAIN_PADDING) == 6850
+
+    # flat country only needs the halo beyond the (fuzz) shadow
+    flat = shadow_padding(0, 60, 25)
+    assert flat % 25 == 0
+    assert flat < 500
+
+    # more relief or a lower sun never needs less padding
+    assert shadow_padding(500, 30, 25) <= shadow_padding(1000, 30, 25) <= shadow_padding(1000, 20, 25)
+
+    # sun below the horizon
+    assert shadow_padding(100, -5, 25, max_padding=6850) == 6850
+
+
+@pytest.mark.parametrize('max_padding', [MAX_TERRAIN_PADDING, 6860])
+def test_padding_trim_keeps_the_shadow_padding(max_padding):
+    geobox = GeoBox(4000, 4000, Affine(25, 0, 1500000, 0, -25, -3900000), CRS('EPSG:3577'))
+    center = geobox.affine * (2000, 2000)
+    times = [numpy.datetime64('2010-01-01T00:00') + numpy.timedelta64(days, 'D') + numpy.timedelta64(hours, 'h')
+             for days in range(0, 365, 30) for hours in (-2, 0, 2, 5)]
+    trims = []
+    for relief_m in (0, 50, 300, 1000, MAX_RELIEF_M):
+        for time in times:
+            trim = padding_trim(geobox, relief_m, time, max_padding=max_padding)
+            needed = shadow_padding(relief_m, sun_altitude(center, time, geobox.crs), 25, max_padding=max_padding)
+            # never less than the shadows need, and within a pixel of it
+            assert trim >= 0
+            assert needed <= max_padding - trim * 25 < needed + 25
+            trims.append(trim)
+    assert max(trims) > 0
+
+
+def test_tile_relief_reads_every_pixel(tmp_path):
+    rows, cols = numpy.mgrid[0:200, 0:150]
+    elevation = (300 * (1 + numpy.sin(cols / 17.0) * numpy.cos(rows / 23.0))).astype(numpy.float32)
+    # a peak, and a trough, that a coarse read of the extremes would miss
+    elevation[101, 77] = 900
+    elevation[13, 140] = -20
+    elevation[:5, :5] = -1000
+    dataset, geobox = gen_tiff_dataset([SimpleNamespace(name='elevation', values=elevation, nodata=-1000)],
+                                       tmp_path, crs='EPSG:3577', resolution=(25, -25),
+                                       offset=(1500000, -3900000))
+    tile = Tile(Datacube.group_datasets([dataset], query_group_by('time')), geobox)
+
+    # in several strips
+    assert tile_relief(tile, rows=64) == relief(elevation) == 920
+
+
+def test_relief_ignores_no_data():
+    elevation = numpy.array([[-1000, 10], [25, 40]], dtype=numpy.float32)
+    assert relief(elevation, no_data=-1000) == 30
+    assert relief(numpy.full((2, 2), -1000), no_data=-1000) == 0
+
+
+def synthetic_dsm(size=240, amplitude=300.0, noise=2.0, gap=True, seed=0):
+    """Rolling hills (with a patch of no data) on the Albers grid"""
+    geobox = GeoBox(size, size, Affine(25, 0, 1500000, 0, -25, -3900000), CRS('EPSG:3577'))
+    rows, cols = numpy.mgrid[0:size, 0:size]
+    jitter = numpy.random.default_rng(seed).normal(0, noise, rows.shape)
+    elevation = amplitude * (1 + numpy.sin(cols / 17.0) * numpy.cos(rows / 23.0)) + jitter
+    if gap:
+        elevation[10:20, 40:70] = -1000
+    coords = {dim: coord.values for dim, coord in geobox.coordinates.items()}
+    return xarray.Dataset({'elevation': (('y', 'x'), elevation.astype(numpy.float32))},
+                          coords=coords, attrs={'crs': geobox.crs})
+
+
+@pytest.mark.parametrize('time', ['2010-06-01T00:00', '2010-12-01T04:00'])
+def test_lean_terrain_matches_standard(time):
+    dsm = synthetic_dsm()
+
+    shadows, slope, sia = shadows_and_slope(dsm, numpy.datetime64(time))
+    metrics.reset()
+    metrics.trace_memory()
+    try:
+        lean_shadows, lean_slope, lean_sia = shadows_and_slope(dsm, numpy.datetime64(time), mode='lean')
+    finally:
+        metrics.trace_memory(False)
+
+    assert lean_shadows.dtype == numpy.uint8
+    assert lean_slope.dtype == lean_sia.dtype == numpy.float32
+    # terrain_filter only distinguishes LIT, SHADED and neither
+    numpy.testing.assert_array_equal(shadows.values == LIT, lean_shadows.values == LIT)
+    numpy.testing.assert_array_equal(shadows.values == SHADED, lean_shadows.values == SHADED)
+    numpy.testing.assert_allclose(lean_slope, slope, atol=1e-3)
+    numpy.testing.assert_allclose(lean_sia, sia, atol=1e-3)
+
+    assert metrics.snapshot()['terrain']['peak_bytes'] > 0
+
+
+@pytest.mark.parametrize('mode', TERRAIN_MODES)
+def test_flat_terrain_skips_ray_tracing(mode):
+    dsm = synthetic_dsm(amplitude=20.0, noise=0.1, gap=False)
+    time = numpy.datetime64('2010-12-01T02:00')
+
+    metrics.reset()
+    shadows, _, _ = shadows_and_slope(dsm, time, mode=mode)
+
+    stats = metrics.snapshot()['terrain']
+    assert stats['shadows_skipped'] == 1
+    assert 'shadows_traced' not in stats
+
+    solar_vec = solar_vector((1500000, -3900000), to_datetime(time), dsm.crs)
+    traced = _cast_shadows(dsm.elevation.values, solar_vec, 25, -1000, lean=(mode != 'standard'))
+    numpy.testing.assert_array_equal(shadows.values, traced)
+    assert (shadows.values == LIT).all()
+
+
+@pytest.mark.parametrize('time', ['2010-06-01T00:00', '2010-12-01T04:00', '2010-09-01T06:30'])
+@pytest.mark.parametrize('seed', [0, 1])
+def test_multires_terrain_matches_lean_and_standard(time, seed):
+    dsm = synthetic_dsm(size=320, seed=seed)
+
+    shadows, _, _ = shadows_and_slope(dsm, numpy.datetime64(time))
+    lean_shadows, _, _ = shadows_and_slope(dsm, numpy.datetime64(time), mode='lean')
+    metrics.reset()
+    multires_shadows, _, _ = shadows_and_slope(dsm, numpy.datetime64(time), mode='multires')
+
+    assert multires_shadows.dtype == numpy.uint8
+    numpy.testing.assert_array_equal(multires_shadows.values, lean_shadows.values)
+    numpy.testing.assert_array_equal(shadows.values == LIT, multires_shadows.values == LIT)
+    numpy.testing.assert_array_equal(shadows.values == SHADED, multires_shadows.values == SHADED)
+    stats = metrics.snapshot()['terrain']
+    assert stats['multires_traced_pixels'] <= stats['multires_pixels']
+
+
+def test_multires_terrain_only_traces_where_shadows_reach():
+    # gentle terrain, but for one steep hill
+    dsm = synthetic_dsm(size=320, amplitude=5.0, noise=0.0, gap=False)
+    rows, cols = numpy.mgrid[0:320, 0:320]
+    dsm.elevation.values += (400 * numpy.exp(-((rows - 160) ** 2 + (cols - 160) ** 2) / 200.0)).astype(numpy.float32)
+    time = numpy.datetime64('2010-06-01T00:00')
+
+    lean_shadows, _, _ = shadows_and_slope(dsm, time, mode='lean')
+    metrics.reset()
+    multires_shadows, _, _ = shadows_and_slope(dsm, time, mode='multires')
+
+    numpy.testing.assert_array_equal(multires_shadows.values, lean_shadows.values)
+    assert (lean_shadows.values == SHADED).any()
+    stats = metrics.snapshot()['terrain']
+    assert stats['multires_traced_pixels'] < stats['multires_pixels'] / 2
+
+
+@pytest.mark.parametrize('mode', ['standard', 'lean'])
+def test_terrain_filter_stack_matches_terrain_filter(mode):
+    dsm = synthetic_dsm()
+    times = numpy.array(['2010-06-01T00:00', '2010-12-01T04:00'], dtype='datetime64[ns]')
+    trims = [8, 0]
+    # EO grid within the DSM buffer
+    nbar = xarray.Dataset({'blue': (('time', 'y', 'x'), numpy.zeros((2, 200, 200), dtype=numpy.int16))},
+                          coords={'time': times, 'y': dsm.y.values[20:220], 'x': dsm.x.values[20:220]})
+
+    stack = terrain_filter_stack(dsm, nbar, mode=mode, trims=trims)
+
+    assert stack.dims == ('time', 'y', 'x')
+    for index, trim in enumerate(trims):
+        time_dsm = dsm.isel(y=slice(trim, dsm.y.size - trim), x=slice(trim, dsm.x.size - trim))
+        expected = terrain_filter(time_dsm, nbar.isel(time=index), mode=mode)
+        numpy.testing.assert_array_equal(stack.isel(time=index).values, expected.values)
@@ -1,9 +1,15 @@
 from pathlib import Path
 
+import numpy as np
+import pytest
 import xarray as xr
 import yaml
+from affine import Affine
+from datacube.utils.geometry import CRS, GeoBox, assign_crs
 from datacube.virtual import construct
 
+from wofs import terrain
+from wofs.dsm import bake_mosaic, open_mosaic
 from wofs.virtualproduct import WOfSClassifier
 
 
@@ -26,6 +32,86 @@ def test_virtualproduct():
     assert sample.equals(wofl)
 
 
+@pytest.mark.parametrize('worker_pool', ['thread', 'process'])
+def test_virtualproduct_workers(worker_pool):
+    sr_data = xr.open_dataset(Path(__file__).parent / 'sample_c3_sr.nc', mask_and_scale=False)
+    sr_data = sr_data.rename({'oa_fmask': 'fmask'})
+    sr_data.attrs['crs'] = 'EPSG:32754'
+    del sr_data.coords['band']
+    for dv in sr_data.data_vars.values():
+        dv.attrs['nodata'] = dv.attrs['nodatavals']
+
+    # several (different) time slices
+    stack = xr.concat([sr_data.assign_coords(time=sr_data.time + np.timedelta64(days, 'D')) // (days + 1)
+                       for days in range(5)], dim='time', combine_attrs='override')
+    for name, dv in stack.data_vars.items():
+        dv.attrs = sr_data[name].attrs
+
+    serial = WOfSClassifier().compute(stack)
+    parallel = WOfSClassifier(workers=3, worker_pool=worker_pool).compute(stack)
+
+    assert list(parallel.time.values) == list(stack.time.values)
+    assert serial.equals(parallel)
+
+
+def synthetic_ard(times=5, size=120):
+    """Random ARD time slices on the Albers grid"""
+    geobox = GeoBox(size, size, Affine(25, 0, 1500000, 0, -25, -3900000), CRS('EPSG:3577'))
+    rng = np.random.default_rng(0)
+    coords = {dim: coord.values for dim, coord in geobox.coordinates.items()}
+    coords['time'] = np.datetime64('2010-06-01T00:30', 'ns') + np.arange(times) * np.timedelta64(40, 'D')
+    bands = {name: (('time', 'y', 'x'), rng.integers(0, 4000, (times, size, size)).astype(np.int16), {'nodata': -999})
+             for name in ['nbart_blue', 'nbart_green', 'nbart_red', 'nbart_nir', 'nbart_swir_1', 'nbart_swir_2']}
+    bands['fmask'] = (('time', 'y', 'x'), rng.integers(0, 6, (times, size, size)).astype(np.uint8), {'nodata': 0})
+    data = assign_crs(xr.Dataset(bands, coords=coords), 'EPSG:3577')
+    data.attrs['crs'] = 'EPSG:3577'
+    return data
+
+
+def hills(gbox, resampling):
+    rows, cols = np.mgrid[0:gbox.height, 0:gbox.width]
+    return (300 * (1 + np.sin(cols / 17.0) * np.cos(rows / 23.0))).astype(np.float32)
+
+
+@pytest.mark.parametrize('worker_pool', ['thread', 'process'])
+def test_virtualproduct_workers_split_terrain(tmp_path, worker_pool):
+    bake_mosaic(tmp_path, GeoBox(400, 400, Affine(25, 0, 1495000, 0, -25, -3895000), CRS('EPSG:3577')), hills)
+    data = synthetic_ard()
+
+    serial = WOfSClassifier(dsm_path=tmp_path, terrain_buffer=1000).compute(data)
+    parallel = WOfSClassifier(dsm_path=tmp_path, terrain_buffer=1000, workers=3,
+                              worker_pool=worker_pool).compute(data)
+
+    # terrain shadows were cast
+    assert (serial.water.values & 8).any()
+    assert serial.equals(parallel)
+
+    with pytest.raises(ValueError):
+        WOfSClassifier(workers=0)
+
+
+def test_virtualproduct_adaptive_terrain_buffer(tmp_path):
+    mosaic = GeoBox(800, 800, Affine(25, 0, 1490000, 0, -25, -3890000), CRS('EPSG:3577'))
+    bake_mosaic(tmp_path, mosaic, hills)
+    data = synthetic_ard()
+    classifier = WOfSClassifier(dsm_path=tmp_path, terrain_buffer='adaptive')
+
+    buffers = classifier._terrain_buffers(data)
+
+    # what the shadows need, for the relief within reach of the tile and the sun of each time slice
+    neighbourhood = data.geobox.buffered(terrain.MAX_TERRAIN_PADDING, terrain.MAX_TERRAIN_PADDING)
+    relief = terrain.relief(open_mosaic(tmp_path).read(neighbourhood))
+    center = data.geobox.affine * (data.geobox.width / 2, data.geobox.height / 2)
+    for buffer, time in zip(buffers, data.time.values):
+        needed = terrain.shadow_padding(relief, terrain.sun_altitude(center, time, data.geobox.crs), 25)
+        assert buffer == min(needed, terrain.MAX_TERRAIN_PADDING) and buffer % 25 == 0
+    assert len(set(buffers)) > 1 and max(buffers) < terrain.MAX_TERRAIN_PADDING
+
+    wofl = classifier.compute(data)
+    assert list(wofl.time.values) == list(data.time.values)
+    assert (wofl.water.values & 8).any()
+
+
 def foo():
     # measurements: [green, red, nir, swir1, swir2]
     virtual_product_defn = yaml.safe_load('''
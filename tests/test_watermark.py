@@ -0,0 +1,50 @@
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+from datacube.model import Range
+
+from wofs.watermark import Watermark, time_windows
+
+Row = namedtuple('Row', ['id', 'indexed_time', 'time'])
+START = datetime(2020, 6, 1, tzinfo=timezone.utc)
+
+
+def row(dataset_id, indexed_minutes, acquired_day):
+    acquired = datetime(2020, 1, 1) + timedelta(days=acquired_day)
+    return Row(dataset_id, START + timedelta(minutes=indexed_minutes),
+               Range(acquired, acquired + timedelta(seconds=20)))
+
+
+def test_only_datasets_since_the_watermark_are_new(tmp_path):
+    first_scan = [row('a', 0, 1), row('b', 50, 2), row('c', 100, 3)]
+    path = tmp_path / 'watermark.json'
+
+    new, advanced = Watermark.load(path).consider(iter(first_scan))
+    assert new is None
+    advanced.save(path)
+
+    mark = Watermark.load(path)
+    assert mark.indexed_time == START + timedelta(minutes=100)
+    assert mark.considered == {'b', 'c'}
+    # a late commit within the overlap, and a new dataset
+    second_scan = first_scan + [row('d', 90, 40), row('e', 200, 41)]
+    new, advanced = mark.consider(iter(second_scan))
+    assert [row.id for row in new] == ['d', 'e']
+
+    advanced.save(path)
+    assert Watermark.load(path).consider(iter(second_scan))[0] == []
+
+
+def test_watermark_keeps_its_time_range(tmp_path):
+    path = tmp_path / 'watermark.json'
+    year = Range(datetime(2020, 1, 1), datetime(2021, 1, 1))
+
+    Watermark.load(path, time_range=year).consider([row('a', 0, 1)])[1].save(path)
+
+    assert Watermark.load(path).time_range == year
+
+
+def test_time_windows_merge_nearby_acquisitions():
+    windows = time_windows([row('a', 0, 10), row('b', 0, 10), row('c', 0, 11), row('d', 0, 30)])
+
+    assert [(window.begin.day, window.end.day) for window in windows] == [(11, 12), (31, 31)]
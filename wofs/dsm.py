@@ -0,0 +1,270 @@
+"""
+Reading the Digital Surface Model (DSM) used for terrain masking.
+
+DSM windows are cached in process (see DSMCache), since repeated queries over the same
+tile (e.g. per-tile fetch loops of the virtual product) read the same DSM window again.
+
+A DSM can also be baked once into a local memory-mapped mosaic on the processing grid
+(see bake_mosaic), from which any geobox on that grid is a zero-copy slice (see DSMMosaic).
+"""
+import json
+import logging
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+
+import numpy
+import xarray
+from affine import Affine
+from datacube.utils.geometry import CRS, GeoBox
+
+from wofs import metrics
+
+_LOG = logging.getLogger(__name__)
+
+# Default size of the process-wide DSM cache
+DSM_CACHE_BYTES = 1024 ** 3
+
+# Files of a baked DSM mosaic directory
+MOSAIC_METADATA = 'mosaic.json'
+MOSAIC_ELEVATION = 'elevation.npy'
+MOSAIC_VERSION = 1
+# Rows and columns of DSM read (and resampled) at a time while baking
+MOSAIC_BLOCK_SIZE = 4000
+
+
+class DSMCache:
+    """
+    Bounded LRU cache of DSM reads, keyed by (dsm_path, geobox, resampling).
+
+    A cached window also serves any smaller geobox on the same pixel grid within it,
+    as a (read only) view of the cached array. Least recently used windows are evicted
+    once the cached arrays exceed `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=DSM_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def read(self, dsm_path, gbox, resampling, reader):
+        """
+        DSM window of a geobox, using `reader(dsm_path, gbox=gbox, resampling=resampling)`
+        (e.g. dc_read) on a cache miss.
+        """
+        key = _cache_key(dsm_path, gbox, resampling)
+        with self._lock:
+            window = self._lookup(key, gbox)
+            if window is not None:
+                self.hits += 1
+                metrics.count('dsm_cache', 'hits')
+                return window
+            self.misses += 1
+            metrics.count('dsm_cache', 'misses')
+
+        array = reader(dsm_path, gbox=gbox, resampling=resampling)
+        array.flags.writeable = False
+
+        with self._lock:
+            self._store(key, gbox, array)
+        return array
+
+    def clear(self):
+        """Forget all cached windows (the counters are kept)."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def _lookup(self, key, gbox):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        path, resampling = key[0], key[-1]
+        for other_key, (other_gbox, array) in self._entries.items():
+            if other_key[0] != path or other_key[-1] != resampling:
+                continue
+            window = _contained_window(other_gbox, gbox)
+            if window is not None:
+                self._entries.move_to_end(other_key)
+                return array[window]
+        return None
+
+    def _store(self, key, gbox, array):
+        if array.nbytes > self.max_bytes:
+            _LOG.debug('DSM window of %d bytes exceeds the cache size, not cached', array.nbytes)
+            return
+        if key in self._entries:
+            return
+
+        self._entries[key] = (gbox, array)
+        self._nbytes += array.nbytes
+        while self._nbytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+            self.evictions += 1
+            metrics.count('dsm_cache', 'evictions')
+
+
+def _cache_key(dsm_path, gbox, resampling):
+    return (str(dsm_path), str(gbox.crs), tuple(gbox.affine)[:6], gbox.shape, resampling)
+
+
+def _grid_offset(outer, inner, tolerance=1e-6):
+    """
+    Pixel (row, col) of `outer` (a geobox) at the corner of `inner`, if both are on the same pixel grid, else None
+    """
+    if outer.crs != inner.crs or tuple(outer.affine)[:2] + tuple(outer.affine)[3:5] \
+            != tuple(inner.affine)[:2] + tuple(inner.affine)[3:5]:
+        return None
+
+    col, row = ~outer.affine * (inner.affine.c, inner.affine.f)
+    if abs(col - round(col)) > tolerance or abs(row - round(row)) > tolerance:
+        return None
+    return int(round(row)), int(round(col))
+
+
+def _contained_window(outer, inner):
+    """
+    Slices of `outer` (a geobox) that cover `inner`, if it lies within on the same pixel grid, else None
+    """
+    offset = _grid_offset(outer, inner)
+    if offset is None:
+        return None
+    row, col = offset
+
+    height, width = inner.shape
+    if row < 0 or col < 0 or row + height > outer.shape[0] or col + width > outer.shape[1]:
+        return None
+    return slice(row, row + height), slice(col, col + width)
+
+
+def crop(data, outer, gbox):
+    """
+    Window on `gbox` of DSM data (an xarray object) loaded over the geobox `outer`, as a view.
+    """
+    window = _contained_window(outer, gbox)
+    if window is None:
+        raise ValueError('Geobox is not within the DSM data, on its pixel grid')
+    return data.isel(y=window[0], x=window[1])
+
+
+def bake_mosaic(directory, gbox, reader, resampling='cubic', no_data=-1000, block_size=MOSAIC_BLOCK_SIZE):
+    """
+    Write the DSM over a geobox to a memory-mapped mosaic directory.
+
+    The DSM is read in blocks with `reader(gbox, resampling)` (e.g. wrapping dc_read),
+    so only one block is in memory at a time.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / MOSAIC_METADATA).unlink(missing_ok=True)
+
+    elevation = numpy.lib.format.open_memmap(directory / MOSAIC_ELEVATION, mode='w+',
+                                             dtype=numpy.float32, shape=gbox.shape)
+    blocks = math.ceil(gbox.shape[0] / block_size) * math.ceil(gbox.shape[1] / block_size)
+    for number, (rows, cols) in enumerate(_block_slices(gbox.shape, block_size), start=1):
+        elevation[rows, cols] = reader(gbox[rows, cols], resampling)
+        _LOG.info('Baked DSM block %d of %d', number, blocks)
+    elevation.flush()
+    del elevation
+
+    metadata = {
+        'version': MOSAIC_VERSION,
+        'crs': str(gbox.crs),
+        'affine': list(gbox.affine)[:6],
+        'shape': list(gbox.shape),
+        'resampling': resampling,
+        'no_data': no_data,
+    }
+    # written last, so an interrupted bake is not mistaken for a mosaic
+    with open(directory / MOSAIC_METADATA, 'w') as fout:
+        json.dump(metadata, fout, indent=2)
+    return DSMMosaic(directory)
+
+
+class DSMMosaic:
+    """
+    A baked DSM mosaic (see bake_mosaic), memory-mapped read only.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        with open(self.directory / MOSAIC_METADATA) as fin:
+            metadata = json.load(fin)
+        if metadata['version'] != MOSAIC_VERSION:
+            raise ValueError(f'Unsupported DSM mosaic version {metadata["version"]} in {directory}')
+
+        self.geobox = GeoBox(metadata['shape'][1], metadata['shape'][0],
+                             Affine(*metadata['affine']), CRS(metadata['crs']))
+        self.resampling = metadata['resampling']
+        self.no_data = metadata['no_data']
+        self.elevation = numpy.load(self.directory / MOSAIC_ELEVATION, mmap_mode='r')
+
+    def read(self, gbox):
+        """
+        DSM window of a geobox on the grid of the mosaic.
+
+        A view of the memory map, unless the geobox extends beyond the mosaic (in which case
+        the window is copied, with no data outside).
+        """
+        offset = _grid_offset(self.geobox, gbox)
+        if offset is None:
+            raise ValueError(f'Geobox is not on the grid of the DSM mosaic {self.directory}')
+
+        window = _contained_window(self.geobox, gbox)
+        if window is not None:
+            return self.elevation[window]
+
+        row, col = offset
+        height, width = gbox.shape
+        array = numpy.full(gbox.shape, self.no_data, dtype=self.elevation.dtype)
+        src_rows = slice(max(row, 0), min(row + height, self.geobox.shape[0]))
+        src_cols = slice(max(col, 0), min(col + width, self.geobox.shape[1]))
+        if src_rows.start < src_rows.stop and src_cols.start < src_cols.stop:
+            array[src_rows.start - row:src_rows.stop - row,
+                  src_cols.start - col:src_cols.stop - col] = self.elevation[src_rows, src_cols]
+        return array
+
+    def load(self, gbox):
+        """DSM window of a geobox as a Dataset (with an 'elevation' variable), as the terrain code expects."""
+        return xarray.Dataset(
+            data_vars={'elevation': (('y', 'x'), self.read(gbox))},
+            coords={dim: coord.values for dim, coord in gbox.coordinates.items()},
+            attrs={'crs': gbox.crs}
+        )
+
+
+def is_mosaic(dsm_path):
+    """Whether a DSM path is a baked mosaic directory (rather than e.g. a raster URI)."""
+    return (Path(str(dsm_path)) / MOSAIC_METADATA).is_file()
+
+
+@lru_cache(maxsize=8)
+def open_mosaic(directory):
+    """Open a baked mosaic (once per process)."""
+    return DSMMosaic(directory)
+
+
+def _block_slices(shape, block_size):
+    for row in range(0, shape[0], block_size):
+        for col in range(0, shape[1], block_size):
+            yield slice(row, min(row + block_size, shape[0])), slice(col, min(col + block_size, shape[1]))
+
+
+# Shared by every WOfSClassifier of this process
+dsm_cache = DSMCache()
@@ -0,0 +1,106 @@
+"""
+Estimate of the cost and footprint of a task generation run, without writing a task file.
+
+Each generated task is tallied (see Estimate.add) from its geoboxes and source footprints:
+the valid data pixels, the bytes of its inputs (the source bands and padded PQ of its computation
+window, see source_window.load_inputs, and the DSM tile) and of its output, and its relative
+cost (see scheduler.task_cost, in weighted pixels). The cost is turned into CPU-hours by a
+calibration factor: the CPU seconds per million weighted pixels of a past run, i.e. its CPU
+time divided by the weighted megapixels estimated for its tasks.
+"""
+from collections import defaultdict
+
+import numpy
+
+from wofs import source_window
+from wofs.scheduler import task_cost
+
+# Bytes per pixel of the inputs loaded by a task (6 int16 bands, uint16 PQ, float32 DSM)
+SOURCE_BANDS = 6
+SOURCE_BYTES = 2
+PQ_BYTES = 2
+DSM_BYTES = 4
+
+# CPU seconds per million weighted pixels, unless calibrated from a past run
+CPU_SECONDS_PER_MEGAPIXEL = 4.0
+
+HISTOGRAM_BINS = 10
+
+
+class Estimate:
+    """
+    Running totals of the tasks of a generation run, and the cost of each cell.
+
+    Args:
+        output_bytes: bytes per pixel of the output measurement
+        crop: whether tasks load only their computation window (the `crop_to_source_footprint` option)
+    """
+
+    def __init__(self, output_bytes=2, crop=True):
+        self.output_bytes = output_bytes
+        self.crop = crop
+        self.tasks = 0
+        self.valid_pixels = 0
+        self.input_bytes = 0
+        self.output_total = 0
+        self.cell_costs = defaultdict(float)  # cell index -> weighted pixels
+
+    def add(self, task):
+        source = task['source_tile'].geobox
+        pixel_area = abs(source.affine.a * source.affine.e)
+        valid_region = task.get('valid_region')
+        self.tasks += 1
+        self.valid_pixels += (valid_region.area if valid_region is not None else source.extent.area) / pixel_area
+        self.input_bytes += self._window_bytes(task)
+        if task.get('dsm_tile') is not None:
+            self.input_bytes += _pixels(task['dsm_tile'].geobox) * DSM_BYTES
+        self.output_total += _pixels(source) * self.output_bytes
+        self.cell_costs[tuple(task['tile_index'][:2])] += task_cost(task) / pixel_area
+
+    def _window_bytes(self, task):
+        """Bytes of the source bands and PQ loaded by a task"""
+        source, pq = task['source_tile'].geobox, task['pq_tile'].geobox
+        window = source_window.computation_window(task) if self.crop else None
+        if window is not None:
+            source, pq = source[window], pq[source_window.pq_window(task, window)]
+        return _pixels(source) * SOURCE_BANDS * SOURCE_BYTES + _pixels(pq) * PQ_BYTES
+
+    @property
+    def weighted_pixels(self):
+        return sum(self.cell_costs.values())
+
+    def cpu_hours(self, cpu_seconds_per_megapixel=CPU_SECONDS_PER_MEGAPIXEL):
+        return self.weighted_pixels / 1e6 * cpu_seconds_per_megapixel / 3600
+
+    def histogram(self, bins=HISTOGRAM_BINS):
+        """Counts of cells by cost (weighted megapixels), and the edges of the bins."""
+        if not self.cell_costs:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0)
+        return numpy.histogram(numpy.array(list(self.cell_costs.values())) / 1e6, bins=bins)
+
+    def report(self, cpu_seconds_per_megapixel=CPU_SECONDS_PER_MEGAPIXEL):
+        """Lines summarising the estimate."""
+        lines = [f'Tasks: {self.tasks} in {len(self.cell_costs)} cells',
+                 f'Valid pixels: {self.valid_pixels:,.0f}',
+                 f'Input bytes: {_gigabytes(self.input_bytes)}',
+                 f'Output bytes: {_gigabytes(self.output_total)}',
+                 f'Weighted megapixels: {self.weighted_pixels / 1e6:,.1f}',
+                 f'CPU-hours: {self.cpu_hours(cpu_seconds_per_megapixel):,.2f} '
+                 f'(at {cpu_seconds_per_megapixel} CPU seconds per weighted megapixel)']
+        counts, edges = self.histogram()
+        if len(counts):
+            costs = list(self.cell_costs.values())
+            lines.append(f'Cost per cell (weighted megapixels), max/mean {max(costs) / numpy.mean(costs):.2f}:')
+            width = max(counts)
+            for count, low, high in zip(counts, edges[:-1], edges[1:]):
+                bar = '#' * int(round(40 * count / width))
+                lines.append(f'  {low:10.1f} - {high:10.1f} {count:6d} {bar}')
+        return lines
+
+
+def _pixels(geobox):
+    return geobox.width * geobox.height
+
+
+def _gigabytes(nbytes):
+    return f'{nbytes / 1e9:,.1f} GB'
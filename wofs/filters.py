@@ -102,7 +102,7 @@ def c2_filter(pq):
     return masking
 
 
-def terrain_filter(dsm, nbar, no_data=-1000, ignore_dsm_no_data=False):
+def terrain_filter(dsm, nbar, no_data=-1000, ignore_dsm_no_data=False, mode='standard'):
     """Terrain shadow masking, slope masking, solar incidence angle masking.
 
     Args:
@@ -110,10 +110,11 @@ def terrain_filter(dsm, nbar, no_data=-1000, ignore_dsm_no_data=False):
         nbar: a Dataset that can be used to get a time
         no_data: NoDATA value from the DSM, defaults to -1000
         ignore_dsm_no_data: If True, don't flag nodata areas as shadow
+        mode: terrain engine mode (see terrain.shadows_and_slope)
     """
 
     shadows, slope, sia = terrain.shadows_and_slope(
-        dsm, nbar.blue.time.values, no_data=no_data
+        dsm, nbar.blue.time.values, no_data=no_data, mode=mode
     )
 
     # Alex Leith 2021: Assuming that the intention is that nodata
@@ -134,11 +135,64 @@ def terrain_filter(dsm, nbar, no_data=-1000, ignore_dsm_no_data=False):
         | np.uint8(constants.MASKED_LOW_SOLAR_ANGLE) * low_sia
     )
 
+    if dsm.elevation.shape != nbar.blue.shape[-2:]:
+        # DSM was buffered (to catch shadows cast from outside the tile), return to the EO grid
+        return xarray.DataArray(
+            _crop_to(result, dsm, nbar), coords=[nbar.y, nbar.x]
+        )
+
     return xarray.DataArray(
         result, coords=[dsm.y, dsm.x]
     )  # note, assumes (y,x) axis ordering
 
 
+def terrain_filter_stack(dsm, nbar, no_data=-1000, ignore_dsm_no_data=False, mode='standard', trims=None):
+    """Terrain masking (as terrain_filter) for every time of a stack, as a (time, y, x) array.
+
+    Slopes (and the other DSM derivatives that do not depend on the sun) are computed once,
+    see terrain.shadows_and_slope_series.
+
+    Args:
+        dsm: An XArray Dataset
+        nbar: a Dataset with a (time, y, x) band named 'blue'
+        no_data: NoDATA value from the DSM, defaults to -1000
+        ignore_dsm_no_data: If True, don't flag nodata areas as shadow
+        mode: terrain engine mode (see terrain.shadows_and_slope)
+        trims: pixels to remove from each edge of the DSM before casting the shadows of each time
+    """
+    times = nbar.blue.time.values
+    result = np.empty((len(times),) + nbar.blue.shape[-2:], dtype=np.uint8)
+
+    series = terrain.shadows_and_slope_series(dsm, times, no_data=no_data, mode=mode, trims=trims)
+    steep = None
+    for flags, (shadows, slope, sia) in zip(result, series):
+        if steep is None:
+            steep = np.uint8(constants.MASKED_HIGH_SLOPE) * _crop_to(slope > constants.SLOPE_THRESHOLD_DEGREES,
+                                                                      dsm, nbar)
+
+        if ignore_dsm_no_data:
+            shadowy = dilate(shadows.values == terrain.SHADED)
+        else:
+            shadowy = dilate(shadows.values != terrain.LIT)
+
+        low_sia = _crop_to(sia, dsm, nbar) < constants.LOW_SOLAR_INCIDENCE_THRESHOLD_DEGREES
+
+        np.multiply(np.uint8(constants.MASKED_TERRAIN_SHADOW), _crop_to(shadowy, shadows, nbar), out=flags)
+        flags |= steep
+        flags |= np.uint8(constants.MASKED_LOW_SOLAR_ANGLE) * low_sia
+
+    return xarray.DataArray(
+        result, coords=[nbar.time, nbar.y, nbar.x]
+    )
+
+
+def _crop_to(array, buffered, like):
+    """Slice a (y,x) array on the grid of `buffered` to the (contained) grid of `like`."""
+    row = int(np.abs(buffered.y.values - like.y.values[0]).argmin())
+    col = int(np.abs(buffered.x.values - like.x.values[0]).argmin())
+    return array[row:row + like.y.size, col:col + like.x.size]
+
+
 def eo_filter(source):
     """
     Find where there is no data
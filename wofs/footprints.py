@@ -0,0 +1,111 @@
+"""
+Footprints of source tiles, for finding the valid data region of each task during generation.
+
+Task generation intersects the extents of the datasets of every tile of every task. The same
+datasets recur: the DSM datasets of a cell in every scene of that cell, and scenes spanning
+several cells in each of them. So extents are reprojected once per dataset (by id), the fused
+footprint of a tile can be kept per key (e.g. the DSM tile of a cell), and bounding boxes
+settle the intersections that are trivially empty or full without any geometry operations.
+The reprojected extents of the least recently used datasets, and the least recently used fused
+footprints, are dropped beyond a bound (see MAX_EXTENTS and MAX_FUSED), so a generation run over
+all of time does not keep every one of them.
+
+Overlaps are tested against the bounding box of each dataset of a tile in turn: a tile has only a
+few datasets, fewer than would make a spatial index (e.g. an STRtree) pay for its building.
+"""
+from collections import OrderedDict
+
+import shapely.geometry
+from datacube.utils.geometry import Geometry, unary_union
+
+# Reprojected dataset extents, and fused footprints, kept by default
+MAX_EXTENTS = 100000
+MAX_FUSED = 10000
+
+
+class Footprints:
+    """
+    Dataset extents reprojected to a CRS, and fused tile footprints, memoized.
+
+    Args:
+        crs: CRS of the footprints (that of the output tile geoboxes)
+        max_extents: most reprojected dataset extents kept (least recently used dropped first)
+        max_fused: most fused footprints kept (least recently used dropped first)
+    """
+
+    def __init__(self, crs, max_extents=MAX_EXTENTS, max_fused=MAX_FUSED):
+        self.crs = crs
+        self.max_extents = max_extents
+        self.max_fused = max_fused
+        self.reprojected = 0
+        self._extents = OrderedDict()  # dataset id -> extent
+        self._fused = OrderedDict()  # key -> footprint
+
+    def extent(self, dataset):
+        """Extent of a dataset, reprojected once (while it is among the most recently used)."""
+        extent = self._extents.get(dataset.id)
+        if extent is not None:
+            self._extents.move_to_end(dataset.id)
+            return extent
+        extent = self._extents[dataset.id] = dataset.extent.to_crs(self.crs)
+        self.reprojected += 1
+        while len(self._extents) > self.max_extents:
+            self._extents.popitem(last=False)
+        return extent
+
+    def fused(self, tile, bounds=None, key=None):
+        """
+        Union of the extents of the datasets of a (single time) tile, cached by `key` if given.
+
+        Datasets whose bounding boxes miss `bounds` (e.g. the tile geobox extent) are left out.
+        """
+        footprint = self._fused.get(key) if key is not None else None
+        if footprint is not None:
+            self._fused.move_to_end(key)
+            return footprint
+        extents = [self.extent(dataset) for dataset in tile.sources.item()]
+        if bounds is not None:
+            extents = [extent for extent in extents if not _disjoint(extent.boundingbox, bounds.boundingbox)]
+        footprint = unary_union(extents) if extents else _empty(self.crs)
+        if key is not None:
+            self._fused[key] = footprint
+            while len(self._fused) > self.max_fused:
+                self._fused.popitem(last=False)
+        return footprint
+
+    def valid_region(self, geobox, tiles, keys=None):
+        """
+        Region of a geobox where the datasets of all tiles are available.
+
+        Args:
+            keys: cache key of the fused footprint of each tile (see fused), or None
+        """
+        keys = keys if keys is not None else [None] * len(tiles)
+        region = geobox.extent
+        for tile, key in zip(tiles, keys):
+            region = _intersection(region, self.fused(tile, bounds=geobox.extent, key=key))
+            if region.is_empty:
+                break
+        return region
+
+
+def _intersection(region, footprint):
+    if footprint.is_empty or _disjoint(region.boundingbox, footprint.boundingbox):
+        return _empty(region.crs)
+    if _contains(footprint.boundingbox, region.boundingbox) and footprint.contains(region):
+        return region
+    return region.intersection(footprint)
+
+
+def _disjoint(a, b):
+    # strictly, as touching extents intersect (in a line)
+    return a.right < b.left or b.right < a.left or a.top < b.bottom or b.top < a.bottom
+
+
+def _contains(outer, inner):
+    return outer.left <= inner.left and outer.bottom <= inner.bottom \
+        and inner.right <= outer.right and inner.top <= outer.top
+
+
+def _empty(crs):
+    return Geometry(shapely.geometry.Polygon(), crs)
@@ -0,0 +1,63 @@
+"""
+Level 1 scenes of poor geometric accuracy (GQA), whose tiles task generation leaves out.
+
+The scenes of a time window failing the GQA limit are found with one search on the indexed
+GQA and time fields, returning no documents (see poor_gqa_times). A tile is left out if its
+time falls within the acquisition time of any of them (see acquired_tiles).
+"""
+import logging
+from bisect import bisect_right
+from datetime import timezone
+
+import numpy as np
+from datacube.api.query import Query
+from datacube.model import Range
+
+_LOG = logging.getLogger(__name__)
+
+# Level 1 scenes whose GQA iterative mean residual (in pixels) is this or worse are not processed
+MAX_ITERATIVE_MEAN_XY = 1
+
+
+def poor_gqa_times(index, source_product, window, extent, gqa_limit):
+    """
+    Acquisition time ranges of the level 1 scenes of poor geometric accuracy, as sorted datetime64
+    (begin, end) pairs.
+
+    The search is on the indexed GQA and time fields, returning no documents: the scenes of the
+    window whose GQA is `gqa_limit` or worse. Scenes without a GQA are kept.
+
+    If the level 1 product, or its GQA field, is not indexed, nothing is filtered (an empty list).
+    """
+    time = {'time': window} if window is not None else {}
+    try:
+        poor = dict(Query(index=index, product=source_product, **time, **extent).search_terms,
+                    gqa_iterative_mean_xy=Range(gqa_limit, None))
+        rows = list(index.datasets.search_returning(('time',), **poor))
+    except ValueError as error:
+        _LOG.warning('Not filtering %r scenes by GQA: %s', source_product, error)
+        return []
+    return sorted((as_datetime64(row.time.begin), as_datetime64(row.time.end)) for row in rows)
+
+
+def acquired_in(time, time_ranges):
+    """
+    Whether a (datetime64) time falls in any of the sorted (begin, end) time ranges, ends included.
+
+    The scenes of a sensor are acquired one after another, so a range only overlaps its neighbours:
+    only the last two ranges beginning by `time` can hold it.
+    """
+    position = bisect_right(time_ranges, (time, np.datetime64('NaT')))
+    return any(begin <= time <= end for begin, end in time_ranges[max(position - 2, 0):position])
+
+
+def acquired_tiles(tile_indexes, time_ranges):
+    """The tile indexes (x, y, time) whose times fall in any of the sorted time ranges (see acquired_in)."""
+    return {tile_index for tile_index in tile_indexes if acquired_in(tile_index[2], time_ranges)}
+
+
+def as_datetime64(value):
+    """A (timezone aware, or UTC) datetime as a UTC datetime64."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, 'ns')
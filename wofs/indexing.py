@@ -0,0 +1,179 @@
+"""
+Batched, asynchronous indexing of new datasets.
+
+Datasets are queued (see BatchIndexer.add) and added to the index by a background thread,
+in batches of one transaction each, so tasks do not wait on a database round trip per
+dataset. If a batch fails, its datasets are retried one at a time, so each failure is
+reported against its own dataset.
+"""
+import logging
+import queue
+import threading
+import time
+import weakref
+from contextlib import nullcontext
+
+from datacube.index import MissingRecordError
+
+_LOG = logging.getLogger(__name__)
+
+# Datasets added per transaction by default
+BATCH_SIZE = 50
+# Seconds a partial batch waits for more datasets before it is added
+FLUSH_INTERVAL = 5.0
+
+_STOP = object()
+
+# Indexers of this process, flushed on SIGTERM (see close_all)
+_OPEN_INDEXERS = weakref.WeakSet()
+
+
+class BatchIndexer:
+    """
+    Add datasets to an index in batches, on a background thread.
+
+    Use as a context manager (or call close) to flush every queued dataset at shutdown.
+
+    Args:
+        index: datacube Index (or anything with `datasets.add`, and optionally `transaction`)
+        batch_size: most datasets added per transaction
+        flush_interval: seconds a partial batch waits for more datasets
+    """
+
+    def __init__(self, index, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.index = index
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.added = 0
+        self.failed = {}  # dataset id -> exception
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='wofs-indexer', daemon=True)
+        self._thread.start()
+        _OPEN_INDEXERS.add(self)
+
+    def __call__(self, datasets):
+        """Queue datasets (as the process_func of a task runner)."""
+        self.add(datasets)
+
+    def add(self, datasets, done=None):
+        """
+        Queue datasets to be indexed.
+
+        Args:
+            done: if given, called (on the indexing thread) as `done(errors)` once all of
+                the datasets were added or failed, with errors a dict of dataset id to exception
+        """
+        datasets = list(datasets)
+        if not datasets:
+            if done is not None:
+                done({})
+            return
+        group = _Group(len(datasets), done)
+        for dataset in datasets:
+            self._queue.put((dataset, group))
+
+    def close(self, timeout=None):
+        """Index every queued dataset (waiting at most `timeout` seconds), and stop the background thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                _LOG.warning('Gave up indexing about %d queued datasets', self._queue.qsize())
+        _LOG.info('Indexed %d datasets, %d failed', self.added, len(self.failed))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch:
+                self._index_batch(batch)
+
+    def _index_batch(self, batch):
+        try:
+            with self._transaction():
+                for dataset, _ in batch:
+                    self._add(dataset)
+            errors = {}
+        except Exception:  # pylint: disable=broad-except
+            if len(batch) > 1:
+                _LOG.warning('Failed to add a batch of %d datasets, adding them one at a time', len(batch))
+            errors = self._add_each(batch)
+
+        for dataset, group in batch:
+            error = errors.get(dataset.id)
+            if error is None:
+                self.added += 1
+                _LOG.info('Dataset %s added: %r', dataset.id, dataset)
+            else:
+                self.failed[dataset.id] = error
+                _LOG.error('Failed to add %r dataset: Error (%s)', dataset, error)
+            group.finished(dataset.id, error)
+
+    def _add_each(self, batch):
+        errors = {}
+        for dataset, _ in batch:
+            try:
+                self._add(dataset)
+            except (ValueError, MissingRecordError) as error:
+                errors[dataset.id] = error
+            except Exception as error:  # pylint: disable=broad-except
+                _LOG.exception('Unexpected error adding dataset %s', dataset.id)
+                errors[dataset.id] = error
+        return errors
+
+    def _add(self, dataset):
+        self.index.datasets.add(dataset,
+                                with_lineage=False,
+                                sources_policy='skip')
+
+    def _transaction(self):
+        transaction = getattr(self.index, 'transaction', None)
+        if transaction is None:
+            return nullcontext()
+        return transaction()
+
+
+def close_all(timeout=None):
+    """Index the datasets queued by every indexer of this process, within `timeout` seconds (e.g. on SIGTERM)."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for indexer in list(_OPEN_INDEXERS):
+        indexer.close(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+
+class _Group:
+    """The datasets of one `add`, reported together once all are done."""
+
+    def __init__(self, count, done):
+        self.remaining = count
+        self.errors = {}
+        self.done = done
+
+    def finished(self, dataset_id, error):
+        if error is not None:
+            self.errors[dataset_id] = error
+        self.remaining -= 1
+        if self.remaining == 0 and self.done is not None:
+            try:
+                self.done(self.errors)
+            except Exception:  # pylint: disable=broad-except
+                _LOG.exception('Failed to report indexed datasets')
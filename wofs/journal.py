@@ -0,0 +1,173 @@
+"""
+Completion journal of task-file runs, so a run that was killed (e.g. at walltime) resumes
+where it left off rather than redoing finished tiles.
+
+The journal is an append-only file of JSON lines next to the task file, one per completed
+task (its key, output path, output size and modification time, and whether it was indexed),
+each fsync'd before the task counts as done. The output is not read back to checksum it: a
+restart counts a task as complete only if its output is still there, with the size recorded.
+
+Concurrent writers (e.g. MPI ranks) each append to their own part (`<journal>.<part>`), and
+all parts are read on restart. Within a process, tasks may be recorded from other threads
+(e.g. the indexing thread, see wofs.indexing).
+"""
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from pathlib import Path
+
+import numpy as np
+
+_LOG = logging.getLogger(__name__)
+
+JOURNAL_SUFFIX = '.journal'
+
+# Journals of this process, flushed on SIGTERM (see interrupt_all)
+_OPEN_JOURNALS = weakref.WeakSet()
+
+
+def journal_path(task_file):
+    """Default journal of a task file."""
+    return Path(str(task_file) + JOURNAL_SUFFIX)
+
+
+def task_key(task):
+    """Key of a task: its tile index (x, y, time)."""
+    x, y, time_ = task['tile_index']
+    return f'{x}_{y}_{np.datetime_as_string(np.datetime64(time_, "ns"))}'
+
+
+def file_stamp(path):
+    """Size (bytes) and modification time (ns) of a file, from one stat."""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class Journal:
+    """
+    Completed tasks of a task file, loaded into memory (for O(1) lookups) and appended to.
+
+    Args:
+        path: journal file (see journal_path)
+        part: name of the part this process appends to (e.g. the MPI rank), if not the journal itself
+        require_indexed: only count tasks as complete once their output was indexed
+    """
+
+    def __init__(self, path, part=None, require_indexed=True):
+        self.path = Path(path)
+        self.require_indexed = require_indexed
+        self.completed = {}
+        self.in_flight = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+        for existing in [self.path] + sorted(self.path.parent.glob(self.path.name + '.*')):
+            if existing.is_file():
+                self._load(existing)
+
+        write_path = self.path if part is None else Path(f'{self.path}.{part}')
+        self._file = open(write_path, 'a')
+        _OPEN_JOURNALS.add(self)
+
+    def _load(self, path):
+        with open(path) as fin:
+            for line in fin:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn write of an interrupted run
+                    continue
+                if entry.get('status') == 'complete':
+                    self.completed[entry['key']] = entry
+
+    def is_complete(self, task):
+        """Whether a task finished (and was indexed, if required) in an earlier run."""
+        entry = self.completed.get(task_key(task))
+        if entry is None or (self.require_indexed and not entry['indexed']):
+            return False
+        try:
+            size = os.stat(entry['path']).st_size
+        except FileNotFoundError:
+            return False
+        # entries of older journals have a checksum instead
+        return entry.get('size', size) == size
+
+    def pending(self, tasks):
+        """The tasks not yet complete."""
+        skipped = 0
+        for task in tasks:
+            if self.is_complete(task):
+                skipped += 1
+                continue
+            yield task
+        if skipped:
+            _LOG.info('Skipped %d tasks completed in earlier runs (see %s)', skipped, self.path)
+
+    def track(self, tasks):
+        """The tasks, each noted as in flight as it is taken (recorded as interrupted on SIGTERM)."""
+        for task in tasks:
+            with self._lock:
+                self.in_flight[task_key(task)] = str(task['file_path'])
+            yield task
+
+    def record(self, task, output_path, indexed):
+        """Durably record a completed task."""
+        key = task_key(task)
+        entry = {'key': key,
+                 'status': 'complete',
+                 'path': str(output_path),
+                 **file_stamp(output_path),
+                 'indexed': bool(indexed),
+                 'time': time.time()}
+        with self._lock:
+            self._append(entry)
+            self.completed[key] = entry
+            self.in_flight.pop(key, None)
+
+    def forget(self, task):
+        """No longer count a (failed) task as in flight."""
+        with self._lock:
+            self.in_flight.pop(task_key(task), None)
+
+    def interrupt(self):
+        """Record the in-flight tasks as interrupted, and flush (e.g. on SIGTERM)."""
+        if os.getpid() != self._pid:
+            # e.g. a forked worker, which does not own the journal
+            return
+        with self._lock:
+            if self._file.closed:
+                return
+            for key, path in list(self.in_flight.items()):
+                self._append({'key': key, 'status': 'interrupted', 'path': path, 'time': time.time()})
+            _LOG.warning('Journal %s: %d tasks complete, %d interrupted', self.path, len(self.completed),
+                         len(self.in_flight))
+            self.in_flight.clear()
+
+    def close(self):
+        if os.getpid() != self._pid:
+            return
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _append(self, entry):
+        # with the lock held
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+def interrupt_all():
+    """Flush every open journal of this process, recording its in-flight tasks as interrupted."""
+    for journal in list(_OPEN_JOURNALS):
+        journal.interrupt()
@@ -0,0 +1,111 @@
+"""
+Existing outputs of a task file, and a ledger of them so `run` can skip those tasks.
+
+On a parallel filesystem, stat'ing hundreds of thousands of output paths one at a time takes
+very long. Outputs are grouped by directory (a cell each), and each directory is listed once,
+several at a time (see existing_paths), with the paths matched against the listings in memory.
+
+The ledger records the ordinals (in the task file) of the tasks whose outputs exist, and of
+those missing, as JSON next to the task file (see ledger_path), with a fingerprint of the task
+file (see task_file_fingerprint) so it is not applied to another (e.g. a regenerated) one.
+"""
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+_LOG = logging.getLogger(__name__)
+
+LEDGER_SUFFIX = '.ledger'
+# Directories listed at once
+LIST_WORKERS = 16
+# Bytes at either end of a task file (its header and config, and its index) in its fingerprint
+FINGERPRINT_BYTES = 2 ** 16
+
+
+def ledger_path(task_file):
+    """Default ledger of a task file."""
+    return Path(str(task_file) + LEDGER_SUFFIX)
+
+
+def task_file_fingerprint(task_file):
+    """Size of a task file, and SHA-256 of its first and last FINGERPRINT_BYTES."""
+    size = os.path.getsize(task_file)
+    digest = hashlib.sha256()
+    with open(task_file, 'rb') as fin:
+        digest.update(fin.read(FINGERPRINT_BYTES))
+        fin.seek(max(size - FINGERPRINT_BYTES, 0))
+        digest.update(fin.read(FINGERPRINT_BYTES))
+    return {'size': size, 'sha256': digest.hexdigest()}
+
+
+def existing_paths(paths, workers=LIST_WORKERS):
+    """Whether each path exists, listing each of their directories once (`workers` at a time)."""
+    paths = [Path(path) for path in paths]
+    directories = sorted({path.parent for path in paths})
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(directories)))) as pool:
+        listings = dict(zip(directories, pool.map(_list_directory, directories)))
+    _LOG.info('Listed %d directories of %d paths', len(directories), len(paths))
+    return [path.name in listings[path.parent] for path in paths]
+
+
+def _list_directory(directory):
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return frozenset()
+
+
+class Ledger:
+    """
+    Ordinals of the tasks of a task file with existing outputs, and of those missing.
+
+    Args:
+        fingerprint: of the task file (see task_file_fingerprint)
+    """
+
+    def __init__(self, existing, missing, fingerprint=None):
+        self.existing = sorted(existing)
+        self.missing = sorted(missing)
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_flags(cls, exists, fingerprint=None):
+        """The ledger of whether the output of each task (in order) exists."""
+        exists = list(exists)
+        return cls([ordinal for ordinal, flag in enumerate(exists) if flag],
+                   [ordinal for ordinal, flag in enumerate(exists) if not flag], fingerprint)
+
+    def __len__(self):
+        return len(self.existing) + len(self.missing)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fin:
+            doc = json.load(fin)
+        return cls(doc['existing'], doc['missing'], doc.get('task_file'))
+
+    def save(self, path):
+        path = Path(path)
+        partial_path = path.with_name(path.name + '.partial')
+        with open(partial_path, 'w') as fout:
+            json.dump({'task_file': self.fingerprint, 'existing': self.existing, 'missing': self.missing}, fout)
+        os.replace(partial_path, path)
+
+    def matches(self, task_file):
+        """Whether this is the ledger of a task file (as it is now)."""
+        return self.fingerprint is not None and self.fingerprint == task_file_fingerprint(task_file)
+
+    def pending(self, tasks, start=0):
+        """The tasks (of the task file, in order from ordinal `start`) whose outputs did not exist."""
+        existing = set(self.existing)
+        skipped = 0
+        for ordinal, task in enumerate(tasks, start):
+            if ordinal in existing:
+                skipped += 1
+                continue
+            yield task
+        _LOG.info('Skipped %d tasks with existing outputs (see the ledger)', skipped)
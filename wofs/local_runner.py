@@ -0,0 +1,188 @@
+"""
+Running tasks on a pool of local processes, for multi-core servers and containers without PBS or MPI.
+
+Tasks are dispatched with a bound on how many are in flight (so a huge task file is not
+queued all at once), workers are replaced after a number of tasks (containing any memory
+creep), and results come back to the calling process (e.g. to be indexed from one place).
+
+Each worker process takes one task at a time over its own pipe, and is watched through its
+process sentinel, so a worker that dies (e.g. killed for running out of memory) fails its task
+and is replaced, and one that runs out of time is killed without affecting the others.
+"""
+import collections
+import logging
+import multiprocessing
+import signal
+import time
+import traceback
+from multiprocessing.connection import wait
+
+_LOG = logging.getLogger(__name__)
+
+
+class TaskFailed(Exception):
+    """A task raised in a worker process (carrying the formatted worker traceback), or its worker died."""
+
+
+class TaskTimedOut(TaskFailed):
+    """A task did not finish in time (its worker was killed)."""
+
+
+# Seconds between checks for tasks that have run out of time
+POLL_INTERVAL = 0.5
+# Seconds a worker is given to exit once asked to, before it is killed
+STOP_TIMEOUT = 5
+
+
+def run_tasks(tasks, task_func, workers, max_in_flight=None, tasks_per_worker=None, task_timeout=None,
+              context=None):
+    """
+    Run `task_func(task)` for each task on a pool of `workers` processes.
+
+    Yields (task, result, error) as tasks finish (not in task order), where error is a
+    TaskFailed if the task raised or its worker died (and it is then replaced).
+
+    Args:
+        max_in_flight: most tasks taken from `tasks` but not yet finished (default twice the workers)
+        tasks_per_worker: tasks after which a worker process is replaced (default never)
+        task_timeout: seconds after a worker starts a task after which the worker is killed and the
+            task reported as failed (TaskTimedOut)
+        context: multiprocessing context (or start method name) of the workers
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    if context is None or isinstance(context, str):
+        context = multiprocessing.get_context(context)
+
+    pool = [_Worker(context, task_func) for _ in range(workers)]
+    waiting = collections.deque()
+    tasks = iter(tasks)
+    number = 0
+    exhausted = False
+    try:
+        while True:
+            busy = [worker for worker in pool if worker.task is not None]
+            while not exhausted and len(waiting) + len(busy) < max(max_in_flight, 1):
+                try:
+                    waiting.append((number, next(tasks)))
+                except StopIteration:
+                    exhausted = True
+                    break
+                number += 1
+            for index, worker in enumerate(pool):
+                if not waiting:
+                    break
+                if worker.task is None:
+                    if not worker.process.is_alive() or (tasks_per_worker is not None
+                                                         and worker.completed >= tasks_per_worker):
+                        worker.stop()
+                        pool[index] = worker = _Worker(context, task_func)
+                    worker.start(*waiting.popleft())
+
+            busy = [worker for worker in pool if worker.task is not None]
+            if not busy:
+                break
+
+            ready = wait([worker.connection for worker in busy] + [worker.process.sentinel for worker in busy],
+                         timeout=POLL_INTERVAL if task_timeout is not None else None)
+            for index, worker in enumerate(pool):
+                if worker.task is None:
+                    continue
+                if worker.connection in ready or worker.process.sentinel in ready:
+                    outcome = worker.receive()
+                    if outcome is None:
+                        task_number, task = worker.task
+                        _LOG.error('Worker %d died (exit code %s) running task %d', worker.process.pid,
+                                   worker.process.exitcode, task_number)
+                        pool[index] = _Worker(context, task_func)
+                        yield task, None, TaskFailed(f'Worker died (exit code {worker.process.exitcode})')
+                    else:
+                        yield outcome
+                elif task_timeout is not None and time.monotonic() - worker.started > task_timeout:
+                    task_number, task = worker.task
+                    _LOG.error('Task %d did not finish within %ss, killing worker %d', task_number, task_timeout,
+                               worker.process.pid)
+                    worker.kill()
+                    pool[index] = _Worker(context, task_func)
+                    yield task, None, TaskTimedOut(f'No result within {task_timeout}s')
+    finally:
+        for worker in pool:
+            if worker.task is None:
+                worker.stop()
+            else:
+                worker.kill()
+
+
+class _Worker:
+    """A worker process, and the task (number and task) it is running, if any."""
+
+    def __init__(self, context, task_func):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_work, args=(child, task_func), name='wofs-worker', daemon=True)
+        self.process.start()
+        child.close()
+        self.task = None
+        self.started = None
+        self.completed = 0
+
+    def start(self, number, task):
+        self.task = number, task
+        try:
+            self.connection.send((number, task))
+        except (BrokenPipeError, OSError):
+            # died meanwhile, which its sentinel reports
+            pass
+        self.started = time.monotonic()
+
+    def receive(self):
+        """(task, result, error) of the task it was running, or None if the worker died."""
+        try:
+            _, result, error = self.connection.recv()
+        except (EOFError, OSError):
+            self.process.join()
+            self.connection.close()
+            return None
+        _, task = self.task
+        self.task = None
+        self.completed += 1
+        return task, result, error
+
+    def stop(self):
+        """Ask the (idle) worker to exit, killing it if it does not."""
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.kill()
+        self.connection.close()
+
+    def kill(self):
+        """Kill the worker, returning once it is gone (so it no longer touches any task data)."""
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def _work(connection, task_func):
+    """Worker process: run the tasks received, sending back (number, result, error) rather than raising."""
+    # interrupts are handled by the parent, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            item = connection.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        number, task = item
+        try:
+            outcome = number, task_func(task), None
+        except Exception as error:  # pylint: disable=broad-except
+            outcome = number, None, TaskFailed(f'{error!r}\n{traceback.format_exc()}')
+        try:
+            connection.send(outcome)
+        except Exception as error:  # pylint: disable=broad-except
+            # e.g. the result could not be pickled
+            connection.send((number, None, TaskFailed(repr(error))))
@@ -0,0 +1,103 @@
+"""
+Per-stage counters for profiling WOfS processing.
+
+Stages accumulate named counts (e.g. calls, seconds, peak_bytes) within this process,
+and can be inspected with `snapshot` (e.g. logged at the end of a run).
+
+Peak memory is only measured once enabled (see trace_memory), as tracing slows every
+allocation. It is measured with tracemalloc (which numpy reports its allocations to), so is
+process wide: concurrent stages in other threads are included. Tracing runs while any
+measured stage does, and its peak is only reset when no other stage is being measured.
+"""
+import logging
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+_LOG = logging.getLogger(__name__)
+
+_LOCK = threading.Lock()
+_STAGES = defaultdict(lambda: defaultdict(float))
+_TRACE_MEMORY = False
+# Stages being measured with tracing, and whether tracing was started for them (under _LOCK)
+_TRACING = {'stages': 0, 'started': False}
+
+
+def trace_memory(enabled=True):
+    """Measure the peak memory of every stage (off by default)."""
+    global _TRACE_MEMORY  # pylint: disable=global-statement
+    _TRACE_MEMORY = enabled
+
+
+def count(stage, name, value=1):
+    """Add to a named count of a stage."""
+    with _LOCK:
+        _STAGES[stage][name] += value
+
+
+@contextmanager
+def measure(stage):
+    """
+    Count a call of a stage, and its wall time (and its peak memory, if traced, see trace_memory).
+
+    Yields a dict, which receives the 'seconds' (and 'peak_bytes') of this call on exit.
+    """
+    trace = _TRACE_MEMORY
+    if trace:
+        baseline = _start_tracing()
+
+    record = {}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        if trace:
+            record['peak_bytes'] = _stop_tracing(baseline)
+            _LOG.debug('%s: %.2fs, peak memory %.1f MiB', stage, record['seconds'], record['peak_bytes'] / 2 ** 20)
+
+        with _LOCK:
+            stats = _STAGES[stage]
+            stats['calls'] += 1
+            stats['seconds'] += record['seconds']
+            if trace:
+                stats['peak_bytes'] = max(stats['peak_bytes'], record['peak_bytes'])
+
+
+def _start_tracing():
+    """Trace allocations for a stage, returning the traced memory at its start."""
+    with _LOCK:
+        if _TRACING['stages'] == 0:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _TRACING['started'] = True
+            elif hasattr(tracemalloc, 'reset_peak'):  # python 3.9+
+                # only while no other stage is measured, lest their peaks be lost
+                tracemalloc.reset_peak()
+        _TRACING['stages'] += 1
+        return tracemalloc.get_traced_memory()[0]
+
+
+def _stop_tracing(baseline):
+    """The peak memory of a stage above its baseline, stopping tracing once no stage is measured."""
+    with _LOCK:
+        peak = max(tracemalloc.get_traced_memory()[1] - baseline, 0)
+        _TRACING['stages'] -= 1
+        if _TRACING['stages'] == 0 and _TRACING['started']:
+            tracemalloc.stop()
+            _TRACING['started'] = False
+        return peak
+
+
+def snapshot():
+    """Copy of the counts of every stage, as {stage: {name: value}}."""
+    with _LOCK:
+        return {stage: dict(stats) for stage, stats in _STAGES.items()}
+
+
+def reset():
+    """Forget all counts."""
+    with _LOCK:
+        _STAGES.clear()
@@ -0,0 +1,174 @@
+"""
+Pipelined task execution: overlap loading, computing and writing of consecutive tasks.
+
+One thread prefetches the inputs of the next tasks, the calling thread computes, and
+another thread writes the outputs, connected by bounded queues. So while one task waits on
+the filesystem, another is being computed. Loads and writes take turns (see run_pipeline).
+"""
+import logging
+import queue
+import threading
+
+from wofs import metrics
+
+_LOG = logging.getLogger(__name__)
+
+# Tasks whose outputs may wait to be written
+WRITE_QUEUE_DEPTH = 1
+
+_DONE = object()
+
+
+class MemoryBudget:
+    """
+    Bytes of task data in flight, waited on to stay below a cap (None for no cap).
+
+    A task is always admitted when nothing else is in flight, so an oversized task still runs.
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.largest = 0
+        self._condition = threading.Condition()
+
+    def wait_for_room(self, stop):
+        """Wait until a task as large as the largest seen so far fits (or `stop` is set)."""
+        if self.max_bytes is None:
+            return
+        with self._condition:
+            while not stop.is_set() and self.used and self.used + self.largest > self.max_bytes:
+                self._condition.wait(timeout=1)
+
+    def acquire(self, nbytes):
+        with self._condition:
+            self.used += nbytes
+            self.largest = max(self.largest, nbytes)
+
+    def release(self, nbytes):
+        with self._condition:
+            self.used -= nbytes
+            self._condition.notify_all()
+
+
+def data_nbytes(data):
+    """Approximate bytes of loaded task data (a dict, list or tuple of arrays or xarray objects)."""
+    if isinstance(data, dict):
+        return sum(data_nbytes(item) for item in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(data_nbytes(item) for item in data)
+    return getattr(data, 'nbytes', 0)
+
+
+def run_pipeline(tasks, load, compute, write, prefetch=2, max_bytes=None, io_lock=None):
+    """
+    Run each task as `write(task, compute(task, load(task)))`, overlapping the stages of consecutive tasks.
+
+    Yields (task, result, error) for each task as its output is written (or it fails),
+    where result is the return value of write, and error is the exception raised by any stage.
+
+    Args:
+        prefetch: number of tasks whose inputs are loaded ahead of the computation
+        max_bytes: cap on the bytes of loaded inputs in flight (see MemoryBudget)
+        io_lock: held while loading and while writing (a new lock by default), as the I/O
+            libraries are not thread safe (e.g. HDF5, which both NetCDF reads and writes go through)
+
+    So only the computation overlaps the I/O of other tasks.
+    """
+    stop = threading.Event()
+    budget = MemoryBudget(max_bytes)
+    loaded = queue.Queue(maxsize=max(prefetch, 1))
+    computed = queue.Queue(maxsize=WRITE_QUEUE_DEPTH)
+    finished = queue.Queue()
+    io_lock = io_lock or threading.Lock()
+
+    def put(target, item):
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def loader():
+        try:
+            for task in tasks:
+                budget.wait_for_room(stop)
+                if stop.is_set():
+                    return
+                try:
+                    with io_lock, metrics.measure('pipeline_load'):
+                        inputs = load(task)
+                except Exception as error:  # pylint: disable=broad-except
+                    finished.put((task, None, error))
+                    continue
+                nbytes = data_nbytes(inputs)
+                budget.acquire(nbytes)
+                put(loaded, (task, inputs, nbytes))
+        except Exception:  # pylint: disable=broad-except
+            _LOG.exception('Unable to read further tasks')
+        finally:
+            put(loaded, _DONE)
+
+    def writer():
+        while True:
+            item = computed.get()
+            if item is _DONE:
+                break
+            task, output, nbytes = item
+            try:
+                with io_lock, metrics.measure('pipeline_write'):
+                    finished.put((task, write(task, output), None))
+            except Exception as error:  # pylint: disable=broad-except
+                finished.put((task, None, error))
+            finally:
+                budget.release(nbytes)
+        finished.put(_DONE)
+
+    threads = [threading.Thread(target=loader, name='wofs-load', daemon=True),
+               threading.Thread(target=writer, name='wofs-write', daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = loaded.get()
+            if item is _DONE:
+                break
+            task, inputs, nbytes = item
+            try:
+                with metrics.measure('pipeline_compute'):
+                    output = compute(task, inputs)
+            except Exception as error:  # pylint: disable=broad-except
+                budget.release(nbytes)
+                finished.put((task, None, error))
+            else:
+                del inputs
+                put(computed, (task, output, nbytes))
+                del output
+            yield from _drain(finished)
+
+        put(computed, _DONE)
+        while True:
+            item = finished.get()
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
+
+def _drain(finished):
+    """Items already in the queue (leaving the end marker)."""
+    while True:
+        try:
+            item = finished.get_nowait()
+        except queue.Empty:
+            return
+        if item is _DONE:
+            finished.put(_DONE)
+            return
+        yield item
+
@@ -0,0 +1,242 @@
+"""
+Dynamic scheduling of tasks across workers (MPI ranks, or local processes).
+
+A coordinator hands out tasks in small batches as workers ask for them, so a worker that
+draws slow (e.g. mountainous) tasks simply asks less often, rather than being left with a
+fixed share of the task file. Costlier tasks (see task_cost) are handed out first, so
+long tasks do not start last; the coordinator reads the task file as a stream, ordering
+only a bounded look-ahead of tasks (see LOOKAHEAD) by cost. Only the coordinator reads
+the task file.
+
+Workers report their busy time with each request, and the coordinator logs the
+utilization of every worker at the end.
+"""
+import heapq
+import logging
+import multiprocessing
+import queue
+import time
+from itertools import count
+
+_LOG = logging.getLogger(__name__)
+
+REQUEST_TAG = 1
+WORK_TAG = 2
+
+# Tasks read ahead of those handed out, to hand out the costliest of them first
+LOOKAHEAD = 1024
+
+
+def task_cost(task):
+    """
+    Relative cost estimate of a WOfS task: its valid data area, weighted by its terrain padding.
+
+    The DSM tile is padded according to the relief around the tile (see terrain.shadow_padding),
+    so its size relative to the source tile stands in for the cost of the terrain masking.
+    """
+    source = task['source_tile'].geobox
+    valid_region = task.get('valid_region')
+    area = valid_region.area if valid_region is not None else source.extent.area
+    dsm = task.get('dsm_tile')
+    if dsm is None:
+        return area
+    return area * (dsm.geobox.width * dsm.geobox.height) / (source.width * source.height)
+
+
+def batch_cost(batch):
+    """Relative cost estimate of a batch of WOfS tasks (see task_cost)."""
+    return sum(task_cost(task) for task in batch)
+
+
+def coordinate(tasks, channel, workers, batch_size=1, cost=None, lookahead=LOOKAHEAD):
+    """
+    Hand out tasks to `workers` workers as they ask (see assigned_tasks), until all have stopped.
+
+    With a `cost`, the costliest of the next `lookahead` tasks is handed out first.
+
+    :return: the final report of each worker, {worker: {'tasks', 'busy', 'elapsed'}}
+    """
+    pending = _Lookahead(tasks, cost, lookahead)
+    total = 0
+    reports = {}
+    active = workers
+
+    while active:
+        worker, report = channel.receive()
+        if worker is None:
+            # a worker died without asking again
+            active -= 1
+            continue
+        reports[worker] = report
+        # smaller batches towards the end (once all tasks are read), so workers finish together
+        remaining = len(pending)
+        size = batch_size if not pending.exhausted else max(1, min(batch_size, remaining // (2 * workers)))
+        batch = pending.take(size)
+        total += len(batch)
+        channel.send(worker, batch)
+        if not batch:
+            active -= 1
+
+    _log_utilization(reports, total)
+    return reports
+
+
+class _Lookahead:
+    """The next tasks of a stream, read `size` ahead, and taken costliest first."""
+
+    def __init__(self, tasks, cost, size):
+        self.tasks = iter(tasks)
+        self.cost = cost
+        self.size = max(1, size)
+        self.exhausted = False
+        self._heap = []
+        self._order = count()
+
+    def __len__(self):
+        self._fill()
+        return len(self._heap)
+
+    def take(self, number):
+        taken = []
+        while len(taken) < number and len(self):
+            taken.append(heapq.heappop(self._heap)[2])
+        return taken
+
+    def _fill(self):
+        while not self.exhausted and len(self._heap) < self.size:
+            try:
+                task = next(self.tasks)
+            except StopIteration:
+                self.exhausted = True
+                break
+            # ties (and without a cost, every task) in stream order
+            priority = -self.cost(task) if self.cost is not None else 0
+            heapq.heappush(self._heap, (priority, next(self._order), task))
+
+
+def assigned_tasks(channel):
+    """
+    Tasks handed to this worker by the coordinator, asking for more as they are used up.
+
+    The time between yielding a task and being asked for the next counts as busy.
+    """
+    started = time.monotonic()
+    busy = 0.0
+    done = 0
+    while True:
+        channel.request({'tasks': done, 'busy': busy, 'elapsed': time.monotonic() - started})
+        batch = channel.receive()
+        if not batch:
+            return
+        for task in batch:
+            task_started = time.monotonic()
+            yield task
+            busy += time.monotonic() - task_started
+            done += 1
+
+
+def _log_utilization(reports, total):
+    _LOG.info('Scheduled %d tasks over %d workers', total, len(reports))
+    for worker, report in sorted(reports.items()):
+        utilization = report['busy'] / report['elapsed'] if report['elapsed'] else 0.0
+        _LOG.info('Worker %s: %d tasks, busy %.0fs of %.0fs (%.0f%%)',
+                  worker, report['tasks'], report['busy'], report['elapsed'], 100 * utilization)
+
+
+class MPICoordinatorChannel:
+    """Coordinator end of the scheduling messages between MPI ranks."""
+
+    def __init__(self, comm):
+        self.comm = comm
+
+    def receive(self):
+        from mpi4py import MPI
+        status = MPI.Status()
+        report = self.comm.recv(source=MPI.ANY_SOURCE, tag=REQUEST_TAG, status=status)
+        return status.Get_source(), report
+
+    def send(self, worker, batch):
+        self.comm.send(batch, dest=worker, tag=WORK_TAG)
+
+
+class MPIWorkerChannel:
+    """Worker end of the scheduling messages between MPI ranks (the coordinator is rank 0)."""
+
+    def __init__(self, comm, coordinator=0):
+        self.comm = comm
+        self.coordinator = coordinator
+
+    def request(self, report):
+        self.comm.send(report, dest=self.coordinator, tag=REQUEST_TAG)
+
+    def receive(self):
+        return self.comm.recv(source=self.coordinator, tag=WORK_TAG)
+
+
+class _LocalCoordinatorChannel:
+    def __init__(self, requests, replies, processes):
+        self.requests = requests
+        self.replies = replies
+        self.processes = processes
+        self.dead = set()
+
+    def receive(self):
+        while True:
+            try:
+                return self.requests.get(timeout=1)
+            except queue.Empty:
+                for worker, process in enumerate(self.processes):
+                    if worker not in self.dead and not process.is_alive() and process.exitcode != 0:
+                        _LOG.error('Worker %d exited with %s', worker, process.exitcode)
+                        self.dead.add(worker)
+                        return None, None
+
+    def send(self, worker, batch):
+        self.replies[worker].put(batch)
+
+
+class _LocalWorkerChannel:
+    def __init__(self, worker, requests, reply):
+        self.worker = worker
+        self.requests = requests
+        self.reply = reply
+
+    def request(self, report):
+        self.requests.put((self.worker, report))
+
+    def receive(self):
+        return self.reply.get()
+
+
+def run_local(tasks, task_func, workers, batch_size=1, cost=None, context=None):
+    """
+    Schedule tasks dynamically over local worker processes running `task_func(task)`.
+
+    The local counterpart of coordinating MPI ranks (e.g. for testing without MPI).
+    Task failures are logged (and the worker carries on).
+
+    :return: the final report of each worker, as for coordinate
+    """
+    if context is None or isinstance(context, str):
+        context = multiprocessing.get_context(context)
+    requests = context.Queue()
+    replies = [context.Queue() for _ in range(workers)]
+    processes = [context.Process(target=_local_worker, args=(task_func, worker, requests, replies[worker]),
+                                 daemon=True)
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        return coordinate(tasks, _LocalCoordinatorChannel(requests, replies, processes), workers,
+                          batch_size=batch_size, cost=cost)
+    finally:
+        for process in processes:
+            process.join(timeout=5)
+
+
+def _local_worker(task_func, worker, requests, reply):
+    for task in assigned_tasks(_LocalWorkerChannel(worker, requests, reply)):
+        try:
+            task_func(task)
+        except Exception:  # pylint: disable=broad-except
+            _LOG.exception('Unable to process %s', task)
@@ -0,0 +1,239 @@
+"""
+Handing arrays between processes through shared memory, rather than by pickling them.
+
+The parent process owns every segment (see SharedArrayPool): it allocates and unlinks them.
+Workers only attach, e.g. to load task inputs straight into them (see load_tile) or to compute
+from them (see attach_dataset), so a crashed worker leaks nothing. Segments are named after
+the run of the owning pool, so any left by a parent that was killed outright are removed by the
+next pool of the same run (see remove_stale_segments), wherever (e.g. in whichever container) it ran.
+"""
+import logging
+import sys
+import threading
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+
+import numpy
+import xarray
+from datacube.drivers import new_datasource
+from datacube.storage import BandInfo, reproject_and_fuse
+
+_LOG = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = 'wofs'
+# Where POSIX shared memory segments are listed (Linux)
+SHM_DIR = Path('/dev/shm')
+# Free segments kept for reuse by default
+POOL_FREE_BYTES = 4 * 1024 ** 3
+
+_UNTRACKED_LOCK = threading.Lock()
+
+
+class SharedArray:
+    """
+    Picklable reference to an array in a shared memory segment.
+    """
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype).str
+
+    @property
+    def nbytes(self):
+        return int(numpy.prod(self.shape)) * numpy.dtype(self.dtype).itemsize
+
+    def __repr__(self):
+        return f'SharedArray({self.name!r}, {self.shape}, {self.dtype!r})'
+
+
+class SharedArrayPool:
+    """
+    Shared memory segments owned by this process, reused once released.
+
+    Use as a context manager (or call close) to unlink every segment.
+
+    Args:
+        run_id: names the segments of the pool (hex, default unique), e.g. after the task
+            file of a run, so a rerun removes those its predecessor left behind
+    """
+
+    def __init__(self, max_free_bytes=POOL_FREE_BYTES, run_id=None):
+        self.max_free_bytes = max_free_bytes
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self._prefix = _segment_prefix(self.run_id)
+        self._segments = {}  # name -> SharedMemory, allocated or free
+        self._free = []  # names of released segments
+        self._lock = threading.Lock()
+        remove_stale_segments(self.run_id)
+
+    def allocate(self, shape, dtype):
+        """A new (uninitialised) shared array, and its SharedArray reference."""
+        reference = SharedArray(None, shape, dtype)
+        size = max(reference.nbytes, 1)
+        with self._lock:
+            reusable = [name for name in self._free if self._segments[name].size >= size]
+            if reusable:
+                name = min(reusable, key=lambda name: self._segments[name].size)
+                self._free.remove(name)
+                segment = self._segments[name]
+            else:
+                segment = shared_memory.SharedMemory(name=self._prefix + uuid.uuid4().hex[:12],
+                                                      create=True, size=size)
+                self._segments[segment.name] = segment
+        reference.name = segment.name
+        return _as_array(segment, reference), reference
+
+    def share(self, array):
+        """Copy an array into shared memory, returning its SharedArray reference."""
+        shared, reference = self.allocate(array.shape, array.dtype)
+        shared[...] = array
+        return reference
+
+    def view(self, reference):
+        """The array of a reference allocated from this pool."""
+        return _as_array(self._segments[reference.name], reference)
+
+    def release(self, *references):
+        """Return segments to the pool (their arrays must no longer be used)."""
+        with self._lock:
+            for reference in references:
+                if reference.name in self._segments and reference.name not in self._free:
+                    self._free.append(reference.name)
+            while self._free and sum(self._segments[name].size for name in self._free) > self.max_free_bytes:
+                self._unlink(self._free.pop(0))
+
+    def close(self):
+        """Unlink every segment of the pool."""
+        with self._lock:
+            for name in list(self._segments):
+                self._unlink(name)
+            self._free.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _unlink(self, name):
+        segment = self._segments.pop(name)
+        try:
+            segment.close()
+        except BufferError:
+            # still viewed by an array of this process, the mapping goes with it
+            pass
+        segment.unlink()
+
+
+def attach(reference):
+    """
+    Zero-copy array of a SharedArray (in any process), kept open as long as the array is referenced.
+    """
+    if sys.version_info >= (3, 13):
+        segment = shared_memory.SharedMemory(name=reference.name, track=False)
+    else:
+        # only the owning pool unlinks, so keep the segment from the resource tracker
+        # (which would otherwise unlink it when a spawned worker exits)
+        with _UNTRACKED_LOCK:
+            register = resource_tracker.register
+            resource_tracker.register = _no_register
+            try:
+                segment = shared_memory.SharedMemory(name=reference.name)
+            finally:
+                resource_tracker.register = register
+    return _as_array(segment, reference)
+
+
+def _no_register(name, rtype):
+    pass
+
+
+def share_dataset(pool, dataset):
+    """
+    Picklable form of an xarray Dataset, with the data variables copied into shared memory.
+
+    Coordinates and attributes are pickled as usual (they are small).
+    """
+    data_vars = {name: (variable.dims, pool.share(variable.values), variable.attrs)
+                 for name, variable in dataset.data_vars.items()}
+    return {'data_vars': data_vars, 'coords': dataset.coords.to_dataset(), 'attrs': dataset.attrs}
+
+
+def attach_dataset(shared):
+    """The xarray Dataset of a shared dataset (see share_dataset and load_tile), with zero-copy data variables."""
+    data_vars = {name: (dims, attach(reference), attrs)
+                 for name, (dims, reference, attrs) in shared['data_vars'].items()}
+    return xarray.Dataset(data_vars, coords=shared['coords'].coords, attrs=shared['attrs'])
+
+
+def tile_arrays(pool, tile, measurements=None):
+    """Shared arrays (SharedArray references by measurement name) to load a datacube Tile into (see load_tile)."""
+    return {name: pool.allocate(tile.shape, measurement.dtype)[1]
+            for name, measurement in tile.product.lookup_measurements(measurements).items()}
+
+
+def load_tile(tile, references, resampling='nearest'):
+    """
+    Load a datacube Tile (like GridWorkflow.load) straight into shared arrays, e.g. in a worker.
+
+    Args:
+        references: SharedArray per measurement to load, at least as large as the tile (see tile_arrays)
+
+    :return: the shared dataset (see attach_dataset) of the tile
+    """
+    measurements = tile.product.lookup_measurements(list(references))
+    data_vars = {}
+    for name, measurement in measurements.items():
+        reference = SharedArray(references[name].name, tile.shape, measurement.dtype)
+        if reference.nbytes > references[name].nbytes:
+            raise ValueError(f'{tile.shape} of {name} does not fit {references[name]}')
+        array = attach(reference)
+        for index, datasets in numpy.ndenumerate(tile.sources.values):
+            reproject_and_fuse([new_datasource(BandInfo(dataset, name)) for dataset in datasets], array[index],
+                               tile.geobox, array.dtype.type(measurement.nodata), resampling)
+        data_vars[name] = (tile.dims, reference, measurement.dataarray_attrs())
+    coords = xarray.Dataset(coords={**{dim: tile.sources[dim].values for dim in tile.sources.dims},
+                                    **{dim: coord.values for dim, coord in tile.geobox.coordinates.items()}})
+    return {'data_vars': data_vars, 'coords': coords, 'attrs': {'crs': tile.geobox.crs}}
+
+
+def dataset_references(shared):
+    """The SharedArray references of a shared dataset (e.g. to release them)."""
+    return [reference for _, reference, _ in shared['data_vars'].values()]
+
+
+def remove_stale_segments(run_id, shm_dir=SHM_DIR):
+    """
+    Unlink the segments of a run left behind by a pool owner that was killed outright.
+
+    Only call before the run's pool allocates anything: whether the owner of a segment
+    still lives cannot be told across containers (or pid namespaces).
+    """
+    if not shm_dir.is_dir():
+        return
+    for path in shm_dir.glob(_segment_prefix(run_id) + '*'):
+        _LOG.warning('Removing shared memory %s left by an earlier run', path.name)
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+
+def _segment_prefix(run_id):
+    return f'{SEGMENT_PREFIX}_{run_id}_'
+
+
+def _as_array(segment, reference):
+    array = numpy.ndarray(reference.shape, dtype=reference.dtype, buffer=segment.buf).view(_SegmentArray)
+    # keep the segment open (its buffer mapped) while the array, or any view of it, lives
+    array.segment = segment
+    return array
+
+
+class _SegmentArray(numpy.ndarray):
+    """ndarray on a shared memory segment, holding a reference to the segment."""
+
+    segment = None
@@ -0,0 +1,120 @@
+"""
+Loading and computing only the window of a tile with source data.
+
+A scene covers part of most of the tiles it touches (e.g. at the edge of its swath), and
+outside the footprint of its datasets every band is nodata, so the output is NO_DATA. Tasks
+load the source bands and PQ of the bounding box of that footprint, plus a halo (see
+computation_window), and the result is filled out to the whole tile (see compute_tile).
+
+The PQ window has a further halo for the dilation of clouds and their shadows (see
+pq_window), and the DSM is still loaded whole, as the terrain shadows depend on its extent.
+If the source data turns out to reach the edge of the window (i.e. the footprint in the
+metadata is too small), the whole tile is loaded instead (see load_inputs).
+"""
+import logging
+import math
+
+import numpy as np
+from datacube.api.grid_workflow import Tile
+from datacube.utils.geometry import unary_union
+
+from wofs import wofls
+from wofs.constants import NO_DATA
+
+_LOG = logging.getLogger(__name__)
+
+# Pixels around the source footprint of a task also loaded and computed
+HALO = 4
+# Radius (pixels) of the cloud and cloud shadow dilation (see filters.dilate)
+DILATION_RADIUS = 3
+
+
+def computation_window(task):
+    """
+    Pixel window (row and column slices) of the source tile of a task that needs loading and computing,
+    or None for the whole tile.
+
+    The window is the bounding box of the footprint of the source datasets (which contains the valid
+    data region), plus a halo.
+    """
+    source_tile = task['source_tile']
+    geobox = source_tile.geobox
+    if task.get('valid_region') is None:
+        return None
+    footprint = unary_union([dataset.extent.to_crs(geobox.crs)
+                             for datasets in source_tile.sources.values for dataset in datasets])
+    window = pixel_window(geobox, footprint.boundingbox, HALO)
+    rows, cols = window
+    if rows.stop - rows.start <= 0 or cols.stop - cols.start <= 0:
+        return None
+    if (rows.stop - rows.start, cols.stop - cols.start) == geobox.shape:
+        return None
+    return window
+
+
+def pq_window(task, window):
+    """Pixel window of the (padded) PQ tile of a task covering a window of its source tile, plus the dilation."""
+    return pixel_window(task['pq_tile'].geobox, task['source_tile'].geobox[window].extent.boundingbox,
+                        DILATION_RADIUS)
+
+
+def pixel_window(geobox, bounds, halo=0):
+    """Pixel window (row and column slices) of a geobox covering bounds (in its CRS), plus a halo"""
+    inverse = ~geobox.affine
+    corners = [inverse * (x, y) for x in (bounds.left, bounds.right) for y in (bounds.bottom, bounds.top)]
+    cols, rows = zip(*corners)
+    height, width = geobox.shape
+    return (slice(max(math.floor(min(rows)) - halo, 0), min(math.ceil(max(rows)) + halo, height)),
+            slice(max(math.floor(min(cols)) - halo, 0), min(math.ceil(max(cols)) + halo, width)))
+
+
+def data_on_window_edge(source, window, shape):
+    """Whether any band has data on an edge of the window inside the tile (i.e. the data may extend beyond it)"""
+    rows, cols = window
+    edges = []
+    if rows.start > 0:
+        edges.append(dict(y=0))
+    if rows.stop < shape[0]:
+        edges.append(dict(y=-1))
+    if cols.start > 0:
+        edges.append(dict(x=0))
+    if cols.stop < shape[1]:
+        edges.append(dict(x=-1))
+    return any(bool((band.isel(**edge) != band.nodata).any())
+               for band in source.data_vars.values() for edge in edges)
+
+
+def load_inputs(task, load, bands, crop=True):
+    """
+    The source bands and PQ of a task, only on its computation window if `crop` (see computation_window).
+
+    Args:
+        load: loads a Tile, as `load(tile, measurements=None)` (e.g. GridWorkflow.load)
+
+    :return: the source and PQ data, and the window loaded (None for the whole tile)
+    """
+    source_tile, pq_tile = task['source_tile'], task['pq_tile']
+    window = computation_window(task) if crop else None
+    if window is not None:
+        source = load(Tile(source_tile.sources, source_tile.geobox[window]), measurements=bands)
+        if data_on_window_edge(source, window, source_tile.geobox.shape):
+            _LOG.warning('Source data beyond the footprint of %s, loading the whole tile', task.get('file_path'))
+            window = None
+    if window is None:
+        return load(source_tile, measurements=bands), load(pq_tile), None
+    pq = load(Tile(pq_tile.sources, pq_tile.geobox[pq_window(task, window)]))
+    return source, pq, window
+
+
+def compute_tile(source, pq, dsm, geobox, terrain_mode='standard'):
+    """WOfS (int16) of (possibly windowed, see load_inputs) inputs of a single time, filled out to the tile geobox."""
+    result = wofls.woffles(source.isel(time=0), pq.isel(time=0), dsm, terrain_mode=terrain_mode).astype(np.int16)
+    if result.shape != geobox.shape:
+        result = paste_window(result, geobox)
+    return result
+
+
+def paste_window(result, geobox):
+    """A result computed on a window of a tile, filled out to the whole tile with NO_DATA"""
+    coords = {dim: coord.values for dim, coord in geobox.coordinates.items()}
+    return result.reindex(coords, method='nearest', tolerance=abs(geobox.affine.a) / 2, fill_value=NO_DATA)
@@ -0,0 +1,290 @@
+"""
+Indexed task files: a header (version, task count, config) and an offset index of the pickled tasks.
+
+So counting the tasks is O(1), any task can be read by its ordinal, and each MPI rank can read
+just its own contiguous shard (see TaskFile.shard), rather than unpickling the whole file.
+
+Layout (little endian):
+
+    magic (8 bytes) | version (u4) | count (u8) | index offset (u8)
+    pickled config
+    pickled tasks, and (from version 2) the records of their datasets, each before its first task
+    index: u8 offset of each task, and of the end of the last task
+    (from version 2) pickled offsets of the dataset records by id, and their products by name
+
+Task files in the older format (a bare stream of pickles, the config first, as written by
+datacube's task_app.save_tasks) are still read (see TaskFile), by scanning them once.
+
+Tasks are saved compact (see compact_task): their tiles are only referenced (see TileRef), by
+geobox and dataset ids, rather than pickled with every dataset and its metadata document.
+Each dataset (with its lineage) is saved once, by the process generating the tasks (see
+save_tasks), so workers rehydrate the tiles of their tasks from the task file alone (see
+TaskFile.datasets and rehydrate_tasks), without querying the database.
+"""
+import logging
+import os
+import pickle
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy
+import xarray
+from affine import Affine
+from datacube.api.grid_workflow import Tile
+from datacube.model import Dataset
+from datacube.utils.geometry import CRS, GeoBox
+
+_LOG = logging.getLogger(__name__)
+
+MAGIC = b'WOFSTASK'
+VERSION = 2
+_HEADER = struct.Struct('<8sIQQ')
+_OFFSET = numpy.dtype('<u8')
+
+# Datasets fetched at once when saving tasks
+LINEAGE_WORKERS = 4
+
+
+def save_tasks(config, tasks, taskfile, datasets=None):
+    """
+    Write the config and tasks to an indexed task file.
+
+    Like task_app.save_tasks, no file is left if there are no tasks.
+
+    Args:
+        datasets: fetches the datasets (with their lineage) of compact tasks by id, as
+            `datasets(dataset_ids)` returning them by id, to save each of them once
+
+    :return: the number of tasks saved
+    """
+    taskfile = Path(taskfile)
+    partial_file = taskfile.with_name(taskfile.name + '.partial')
+    offsets = []
+    dataset_offsets = {}
+    products = {}
+    with open(partial_file, 'wb') as fout:
+        fout.write(_HEADER.pack(MAGIC, VERSION, 0, 0))
+        pickle.dump(config, fout, pickle.HIGHEST_PROTOCOL)
+        for task in tasks:
+            new_ids = [dataset_id for dataset_id in dict.fromkeys(task_dataset_ids(task))
+                       if dataset_id not in dataset_offsets] if datasets is not None else []
+            if new_ids:
+                for dataset_id, dataset in datasets(new_ids).items():
+                    dataset_offsets[dataset_id] = fout.tell()
+                    products.setdefault(dataset.type.name, dataset.type)
+                    pickle.dump((dataset.type.name, dataset.metadata_doc, dataset.uris), fout,
+                                pickle.HIGHEST_PROTOCOL)
+            offsets.append(fout.tell())
+            pickle.dump(task, fout, pickle.HIGHEST_PROTOCOL)
+        index_offset = fout.tell()
+        offsets.append(index_offset)
+        fout.write(numpy.asarray(offsets, dtype=_OFFSET).tobytes())
+        pickle.dump({'datasets': dataset_offsets, 'products': products}, fout, pickle.HIGHEST_PROTOCOL)
+        fout.seek(0)
+        fout.write(_HEADER.pack(MAGIC, VERSION, len(offsets) - 1, index_offset))
+
+    count = len(offsets) - 1
+    if count == 0:
+        partial_file.unlink()
+        return 0
+    # only complete task files take the name
+    os.replace(partial_file, taskfile)
+    _LOG.info('Saved config and %d tasks to %s', count, taskfile)
+    return count
+
+
+def load_tasks(taskfile):
+    """The config and (a generator of) the tasks of a task file, like task_app.load_tasks."""
+    tasks = TaskFile(taskfile)
+    return tasks.config, iter(tasks)
+
+
+def load_shard(taskfile, shard, shards):
+    """The config and tasks of one of `shards` contiguous shards of a task file (e.g. of an MPI rank)."""
+    tasks = TaskFile(taskfile)
+    return tasks.config, tasks.shard(shard, shards)
+
+
+def shard_range(count, shard, shards):
+    """Ordinals (start, stop) of one of `shards` contiguous shards of `count` tasks, balanced to within one."""
+    return count * shard // shards, count * (shard + 1) // shards
+
+
+class TaskFile:
+    """
+    Random access to the tasks of a task file, in the indexed or older format.
+
+    Only the header and the indexes are read on opening an indexed file. An older file is
+    scanned (every task unpickled) once, to find its tasks.
+    """
+
+    def __init__(self, taskfile):
+        self.path = Path(taskfile)
+        with open(self.path, 'rb') as fin:
+            header = fin.read(_HEADER.size)
+            if len(header) == _HEADER.size and header.startswith(MAGIC):
+                _, self.version, count, index_offset = _HEADER.unpack(header)
+                if self.version > VERSION:
+                    raise ValueError(f'Unsupported task file version {self.version} of {taskfile}')
+                self.config = pickle.load(fin)
+                fin.seek(index_offset)
+                self._offsets = numpy.frombuffer(fin.read((count + 1) * _OFFSET.itemsize), dtype=_OFFSET)
+                saved = pickle.load(fin) if self.version >= 2 else {}
+            else:
+                self.version = 0
+                fin.seek(0)
+                self.config = pickle.load(fin)
+                self._offsets = _scan_offsets(fin)
+                saved = {}
+        self._dataset_offsets = saved.get('datasets', {})
+        self._products = saved.get('products', {})
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, ordinal):
+        if ordinal < 0:
+            ordinal += len(self)
+        if not 0 <= ordinal < len(self):
+            raise IndexError(f'Task {ordinal} of {len(self)} in {self.path}')
+        return next(self.read(ordinal, ordinal + 1))
+
+    def __iter__(self):
+        return self.read(0, len(self))
+
+    def read(self, start, stop):
+        """The tasks with ordinals in [start, stop), read in one contiguous pass."""
+        start, stop = max(start, 0), min(stop, len(self))
+        if start >= stop:
+            return
+        with open(self.path, 'rb') as fin:
+            # past the records of the datasets between them
+            for offset in self._offsets[start:stop]:
+                fin.seek(int(offset))
+                yield pickle.load(fin)
+
+    def shard(self, shard, shards):
+        """The tasks of one of `shards` contiguous shards (see shard_range)."""
+        return self.read(*shard_range(len(self), shard, shards))
+
+    def datasets(self, dataset_ids):
+        """Datasets (with their lineage, as when the tasks were generated) by id, read from the task file."""
+        dataset_ids = {str(dataset_id) for dataset_id in dataset_ids}
+        missing = dataset_ids - set(self._dataset_offsets)
+        if missing:
+            raise KeyError(f'{len(missing)} datasets (e.g. {min(missing)}) are not saved in {self.path}, '
+                           'regenerate it')
+        found = {}
+        with open(self.path, 'rb') as fin:
+            for dataset_id in sorted(dataset_ids, key=self._dataset_offsets.get):
+                fin.seek(self._dataset_offsets[dataset_id])
+                product, metadata_doc, uris = pickle.load(fin)
+                found[dataset_id] = Dataset(self._products[product], metadata_doc, uris=uris)
+        return found
+
+
+def _scan_offsets(fin):
+    offsets = []
+    while True:
+        offset = fin.tell()
+        try:
+            pickle.load(fin)
+        except EOFError:
+            break
+        offsets.append(offset)
+    offsets.append(offset)
+    return numpy.asarray(offsets, dtype=_OFFSET)
+
+
+class TileRef:
+    """
+    Compact reference to a datacube Tile: its geobox, and the ids of its datasets at each time.
+    """
+
+    def __init__(self, geobox, times, dataset_ids, time_attrs=None):
+        self.geobox = geobox
+        self.times = numpy.asarray(times, dtype='datetime64[ns]')
+        self.dataset_ids = [tuple(str(dataset_id) for dataset_id in ids) for ids in dataset_ids]
+        self.time_attrs = dict(time_attrs or {})
+
+    @classmethod
+    def from_tile(cls, tile):
+        return cls(tile.geobox, tile.sources.time.values,
+                   [[dataset.id for dataset in datasets] for datasets in tile.sources.values],
+                   tile.sources.time.attrs)
+
+    @property
+    def ids(self):
+        """All dataset ids of the tile."""
+        return [dataset_id for ids in self.dataset_ids for dataset_id in ids]
+
+    def to_tile(self, datasets):
+        """The Tile, with its datasets looked up by id in `datasets`."""
+        sources = numpy.empty(len(self.times), dtype=object)
+        for i, ids in enumerate(self.dataset_ids):
+            sources[i] = tuple(datasets[dataset_id] for dataset_id in ids)
+        sources = xarray.DataArray(sources, dims=['time'], coords=[self.times])
+        sources.time.attrs.update(self.time_attrs)
+        return Tile(sources, self.geobox)
+
+    def __getstate__(self):
+        geobox = (self.geobox.width, self.geobox.height, tuple(self.geobox.affine)[:6], str(self.geobox.crs))
+        return geobox, self.times.astype('int64'), self.dataset_ids, self.time_attrs
+
+    def __setstate__(self, state):
+        (width, height, affine, crs), times, self.dataset_ids, self.time_attrs = state
+        self.geobox = GeoBox(width, height, Affine(*affine), CRS(crs))
+        self.times = numpy.asarray(times).astype('datetime64[ns]')
+
+    def __repr__(self):
+        return f'TileRef({self.geobox.shape}, {len(self.times)} times, {len(self.ids)} datasets)'
+
+
+def compact_task(task):
+    """A task with its Tiles replaced by TileRefs."""
+    return {key: TileRef.from_tile(value) if isinstance(value, Tile) else value for key, value in task.items()}
+
+
+def task_dataset_ids(task):
+    """Ids of the datasets of the TileRefs of a (compact) task."""
+    return [dataset_id for value in task.values() if isinstance(value, TileRef) for dataset_id in value.ids]
+
+
+def fetch_datasets(index, dataset_ids, workers=LINEAGE_WORKERS):
+    """
+    Datasets (with their lineage) by id, fetched `workers` at a time, for save_tasks.
+
+    One round trip each: `get(include_sources=True)` fetches the whole lineage of a dataset in
+    one (recursive) query, whereas `bulk_get` fetches many datasets in one but without any
+    lineage, which the outputs record in full.
+    """
+    dataset_ids = sorted({str(dataset_id) for dataset_id in dataset_ids})
+    if not dataset_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(dataset_ids))) as pool:
+        return dict(zip(dataset_ids, pool.map(partial(_get_with_lineage, index), dataset_ids)))
+
+
+def _get_with_lineage(index, dataset_id):
+    return index.datasets.get(dataset_id, include_sources=True)
+
+
+def rehydrate_tasks(datasets, tasks):
+    """
+    Tasks with their TileRefs replaced by Tiles, looking up the datasets of all of them together.
+
+    Args:
+        datasets: looks up datasets by id, as `datasets(dataset_ids)` returning them by id
+            (e.g. TaskFile.datasets)
+
+    Tasks that are not compact (e.g. of older task files) are returned as they are.
+    """
+    tasks = list(tasks)
+    dataset_ids = [dataset_id for task in tasks for dataset_id in task_dataset_ids(task)]
+    if not dataset_ids:
+        return tasks
+    datasets = datasets(dataset_ids)
+    return [{key: value.to_tile(datasets) if isinstance(value, TileRef) else value for key, value in task.items()}
+            for task in tasks]
@@ -1,18 +1,49 @@
+import logging
 import math
+from functools import partial
 
 import ephem
 import numpy
 import xarray
+from datacube.api.grid_workflow import GridWorkflow, Tile
 from datacube.utils.geometry import CRS, line
 from pandas import to_datetime
-from scipy import ndimage
+from scipy import ndimage, special
+
+from wofs import metrics
+
+_LOG = logging.getLogger(__name__)
 
 UNKNOWN = -1
 LIT = 255
 SHADED = 0
+# Stands in for UNKNOWN in uint8 shadow masks (pixels neither clearly LIT nor SHADED)
+MASK_UNKNOWN = 1
+
+TERRAIN_MODES = ('standard', 'lean', 'multires')
+# Rows resampled at a time by the lean (and multires) terrain mode
+LEAN_STRIP_ROWS = 256
+# Pixels per block of the DSM, by which the multires terrain mode finds where shadows can reach
+MULTIRES_FACTOR = 4
+
+# Worst case shadow: max prominence (Kosciuszko) at lowest solar declination
+# (min incidence minus slope threshold)
+MAX_RELIEF_M = 2230
+MIN_SUN_ALTITUDE_DEG = 30 - 12
+# Largest padding (CRS units) of the DSM around a tile: the worst case shadow, snapped to the edges
+# of the 25 metre pixels to avoid API questions (2230 metres / math.tan(math.radians(30-12)) // 25 * 25 == 6850)
+MAX_TERRAIN_PADDING = int(MAX_RELIEF_M / math.tan(math.radians(MIN_SUN_ALTITUDE_DEG)) // 25 * 25)
+# Rows of DSM read at a time to find the relief of a tile
+RELIEF_STRIP_ROWS = 512
 
+# Extra height added to shadow casting pixels by the row shading (see _shade_row)
+SHADOW_FUZZ_M = 10.0
 
-def _shade_row(shade_mask, elev_m, sun_alt_deg, pixel_scale_m, no_data, fuzz=0.0):
+# Pixels beyond the shadow reach that still influence the tile (Sobel kernel and shadow dilation)
+TERRAIN_HALO_PIXELS = 1 + 3
+
+
+def _shade_row(shade_mask, elev_m, sun_alt_deg, pixel_scale_m, no_data, fuzz=0.0, unknown=UNKNOWN):
     """
     shade the supplied row of the elevation model
     """
@@ -32,7 +63,7 @@ def _shade_row(shade_mask, elev_m, sun_alt_deg, pixel_scale_m, no_data, fuzz=0.0
             shadow_level = (elev_m[i] + fuzz) - numpy.arange(shade_mask.size - i) * (tan_sun_alt * pixel_scale_m)
             shade_mask[i:][shadow_level > elev_m[i:]] = SHADED
 
-    shade_mask[elev_m == no_data] = UNKNOWN
+    shade_mask[elev_m == no_data] = unknown
 
     return shade_mask
 
@@ -82,8 +113,82 @@ def solar_vector(point, time, crs):
     return x, y, z, sun_az, sun.alt
 
 
+def sun_altitude(point, time, crs):
+    """
+    Solar altitude (in degrees) at a point (2-tuple in the given CRS) and time.
+    """
+    return math.degrees(solar_vector(point, to_datetime(time), crs)[4])
+
+
+def relief(elevation, no_data=-1000):
+    """
+    Vertical range (max minus min) of the valid pixels of an elevation array.
+
+    Returns zero if there are no valid pixels.
+    """
+    elevation = numpy.asarray(elevation)
+    valid = elevation[(elevation != no_data) & numpy.isfinite(elevation)]
+    if valid.size == 0:
+        return 0.0
+    return float(valid.max() - valid.min())
+
+
+def shadow_padding(relief_m, sun_alt_deg, resolution, max_padding=None):
+    """
+    Smallest buffer (in CRS units) around a tile that can contain terrain casting a shadow into it.
+
+    A pillar of height `relief_m` (plus the shading fuzz) casts a shadow of length
+    ``relief / tan(sun altitude)``. The buffer is snapped up to whole pixels, and
+    widened by the halo needed by the slope kernel and the shadow dilation.
+    A sun at or below the horizon (or any buffer beyond `max_padding`) yields `max_padding`.
+    """
+    resolution = abs(resolution)
+    if sun_alt_deg <= 0:
+        if max_padding is None:
+            raise ValueError('Sun is below the horizon and no maximum padding was given')
+        return max_padding
+
+    reach = (relief_m + SHADOW_FUZZ_M) / math.tan(math.radians(sun_alt_deg))
+    padding = (math.ceil(reach / resolution) + TERRAIN_HALO_PIXELS) * resolution
+
+    if max_padding is not None:
+        padding = min(padding, max_padding)
+    return padding
+
+
+def padding_trim(geobox, relief_m, time, max_padding=MAX_TERRAIN_PADDING):
+    """
+    Whole pixels by which a DSM padded by `max_padding` around the geobox can be trimmed on each
+    side, keeping all that can cast a shadow into the geobox at this time (see shadow_padding).
+    """
+    resolution = abs(geobox.affine.a)
+    center = geobox.affine * (geobox.width / 2, geobox.height / 2)
+    padding = shadow_padding(relief_m, sun_altitude(center, time, geobox.crs), resolution, max_padding=max_padding)
+    return max(int((max_padding - padding) // resolution), 0)
+
+
+def tile_relief(dsm_tile, no_data=-1000, resampling='cubic', rows=RELIEF_STRIP_ROWS):
+    """
+    Relief (metres) of a (padded) DSM tile, read at full resolution (and resampled as the tasks load
+    it) `rows` rows at a time.
+
+    Not from a coarse read of its extremes: datacube reads the DSM decimated before resampling it,
+    so the peaks and troughs between the pixels read would be missed, and the padding too small.
+    """
+    extremes = []
+    height = dsm_tile.geobox.height
+    for start in range(0, height, rows):
+        strip = GridWorkflow.load(Tile(dsm_tile.sources, dsm_tile.geobox[start:min(start + rows, height), :]),
+                                  measurements=['elevation'], resampling=resampling)
+        strip = strip.elevation.values
+        valid = strip[(strip != no_data) & numpy.isfinite(strip)]
+        if valid.size:
+            extremes += [valid.min(), valid.max()]
+    return relief(extremes, no_data)
+
+
 # pylint: disable=too-many-locals
-def shadows_and_slope(tile, time, no_data=-1000):
+def shadows_and_slope(tile, time, no_data=-1000, mode='standard'):
     """
     Terrain shadow masking (Greg's implementation) and slope masking.
 
@@ -97,46 +202,317 @@ def shadows_and_slope(tile, time, no_data=-1000):
     (i.e. using a ramp, masks the other pixels shaded by the pillar of that pixel).
     Reprojects shadow mask (and undoes border enlargement associated with the rotation).
 
+    Modes:
+        standard: float32 shadow mask (with UNKNOWN for DSM no data), resampled with cubic splines.
+        lean: bounds peak memory. Casts shadows before finding slopes, works in float32 and in place,
+              resamples in strips, and keeps the shadow mask as uint8 (MASK_UNKNOWN where the
+              standard mask would be neither LIT nor SHADED, so terrain_filter flags are unchanged).
+              Its peak memory is reported to the 'terrain' stage metrics, if traced (see metrics.trace_memory).
+        multires: as lean (and the same shadows), but only ray-traces the blocks of the DSM that a
+              shadow can reach, found from block extremes, see _cast_shadows_multires. Only faster
+              on terrain where shadows can reach little of the tile.
+
     TODO (BL) -- profile, and explore numpy.minimum.accumulate (make-monotonic) style alternative
                  and maybe fewer resamplings (or come up with something better still).
     """
+    if mode not in TERRAIN_MODES:
+        raise ValueError(f'Unknown terrain mode {mode!r}, expected one of {TERRAIN_MODES}')
+    lean = mode in ('lean', 'multires')
 
-    y_size, x_size = tile.elevation.shape
+    with metrics.measure('terrain'):
+        y_size, x_size = tile.elevation.shape
 
-    # row spacing
-    pixel_scale_m = abs(tile.affine.e)
+        # row spacing
+        pixel_scale_m = abs(tile.affine.e)
+
+        x, y = tile.dims.keys()
+        tile_center = (tile[x].values[x_size // 2], tile[y].values[y_size // 2])
+        solar_vec = solar_vector(tile_center, to_datetime(time), tile.crs)
+
+        if lean:
+            elevation = numpy.asarray(tile.elevation.values, dtype=numpy.float32)
+        else:
+            elevation = tile.elevation.values
+
+        cast_shadows = _shadow_caster(elevation, solar_vec, pixel_scale_m, no_data, mode)
+
+        if lean:
+            shadows = cast_shadows(elevation, solar_vec, pixel_scale_m, no_data)
+            slope, sia = _slope_and_incidence(elevation, tile.affine, solar_vec, lean=True)
+        else:
+            slope, sia = _slope_and_incidence(elevation, tile.affine, solar_vec)
+            shadows = cast_shadows(elevation, solar_vec, pixel_scale_m, no_data)
 
-    # gradient and slope
-    xgrad = ndimage.sobel(tile.elevation, axis=1) / abs(8 * tile.affine.a)
-    ygrad = ndimage.sobel(tile.elevation, axis=0) / abs(8 * tile.affine.e)
+    shadows = xarray.DataArray(shadows, coords=tile.elevation.coords)
 
-    # length of the terrain normal vector
-    norm_len = numpy.sqrt((xgrad * xgrad) + (ygrad * ygrad) + 1.0)
-    slope = numpy.degrees(numpy.arccos(1.0 / norm_len))
+    return shadows, slope, sia
+
+
+def shadows_and_slope_series(tile, times, no_data=-1000, mode='standard', trims=None):
+    """
+    Terrain shadow masks, slope and solar incidence angles of one DSM at several times.
+
+    As shadows_and_slope, but the terrain gradients and normals (and so the slope) are derived
+    once, and the solar incidence angles of every time are written to the same buffer.
+
+    Yields (shadows, slope, sia) for each time, where shadows is a DataArray on the DSM with
+    `trims[i]` pixels removed from each edge (e.g. a shorter terrain buffer for a higher sun),
+    and slope and sia are arrays on the whole DSM. The sia buffer is overwritten by the next time.
+    """
+    if mode not in TERRAIN_MODES:
+        raise ValueError(f'Unknown terrain mode {mode!r}, expected one of {TERRAIN_MODES}')
+    lean = mode in ('lean', 'multires')
+    if trims is None:
+        trims = [0] * len(times)
 
+    y_size, x_size = tile.elevation.shape
+    pixel_scale_m = abs(tile.affine.e)
     x, y = tile.dims.keys()
     tile_center = (tile[x].values[x_size // 2], tile[y].values[y_size // 2])
-    solar_vec = solar_vector(tile_center, to_datetime(time), tile.crs)
-    sia = (solar_vec[2] - (xgrad * solar_vec[0]) - (ygrad * solar_vec[1])) / norm_len
-    sia = 90 - numpy.degrees(numpy.arccos(sia))
 
+    if lean:
+        elevation = numpy.asarray(tile.elevation.values, dtype=numpy.float32)
+    else:
+        elevation = tile.elevation.values
+
+    with metrics.measure('terrain_normals'):
+        xgrad, ygrad, norm_len, slope = _terrain_normals(elevation, tile.affine, lean=lean)
+    sia = numpy.empty_like(norm_len)
+    scratch = numpy.empty_like(norm_len)
+
+    for time, trim in zip(times, trims):
+        with metrics.measure('terrain'):
+            # trimming symmetrically keeps the centre pixel, and so the solar vector
+            solar_vec = solar_vector(tile_center, to_datetime(time), tile.crs)
+            trimmed = tile.elevation[trim:y_size - trim, trim:x_size - trim]
+            trimmed_elevation = elevation[trim:y_size - trim, trim:x_size - trim]
+
+            cast_shadows = _shadow_caster(trimmed_elevation, solar_vec, pixel_scale_m, no_data, mode)
+            shadows = cast_shadows(trimmed_elevation, solar_vec, pixel_scale_m, no_data)
+            _incidence(xgrad, ygrad, norm_len, solar_vec, out=sia, scratch=scratch)
+
+        yield xarray.DataArray(shadows, coords=trimmed.coords), slope, sia
+
+
+def _shadow_caster(elevation, solar_vec, pixel_scale_m, no_data, mode):
+    """
+    Shadow casting function of a terrain mode, or _all_lit if the relief cannot cast shadows,
+    called as `cast_shadows(elevation, solar_vec, pixel_scale_m, no_data)`
+    """
+    lean = mode in ('lean', 'multires')
+    if _shadows_possible(elevation, solar_vec, pixel_scale_m, no_data):
+        metrics.count('terrain', 'shadows_traced')
+        if mode == 'multires':
+            return _cast_shadows_multires
+        return partial(_cast_shadows, lean=lean)
+
+    _LOG.debug('Relief cannot cast shadows at sun altitude %.1f degrees, skipping ray tracing',
+               math.degrees(solar_vec[4]))
+    metrics.count('terrain', 'shadows_skipped')
+    return partial(_all_lit, lean=lean)
+
+
+def _shadows_possible(elevation, solar_vec, pixel_scale_m, no_data):
+    """
+    Whether any pixel of the elevation array could be in terrain shadow (cheap, conservative check)
+
+    Shadows (see _shade_row) only begin where a row of the rotated DSM drops by at least
+    tan(sun altitude) per pixel. The rotation resamples with non-negative weights, so a step
+    along the sun direction cannot drop further than the relief, nor further than the largest
+    differences between neighbours along each axis (weighted by the direction components).
+    """
+    if (elevation == no_data).any():
+        # the edges of DSM gaps are shaded
+        return True
+
+    threshold = math.tan(solar_vec[4]) * pixel_scale_m
+    if threshold <= 0:
+        return True
+
+    # maximum relief
+    if float(elevation.max()) - float(elevation.min()) < threshold:
+        return False
+
+    # maximum slope along the sun direction
+    col_step = float(numpy.abs(numpy.diff(elevation, axis=1)).max(initial=0))
+    row_step = float(numpy.abs(numpy.diff(elevation, axis=0)).max(initial=0))
+    steepest = abs(math.sin(solar_vec[3])) * col_step + abs(math.cos(solar_vec[3])) * row_step
+    return steepest >= threshold
+
+
+def _all_lit(elevation, solar_vec, pixel_scale_m, no_data, lean=False):
+    """
+    Shadow mask for terrain that cannot cast shadows
+    """
+    # pylint: disable=unused-argument
+    dtype = numpy.uint8 if lean else numpy.float32
+    return numpy.full(elevation.shape, LIT, dtype=dtype)
+
+
+def _slope_and_incidence(elevation, affine, solar_vec, lean=False):
+    """
+    Slope and solar incidence angle (both in degrees) of each pixel of an elevation array
+    """
+    if not lean:
+        # gradient and slope
+        xgrad = ndimage.sobel(elevation, axis=1) / abs(8 * affine.a)
+        ygrad = ndimage.sobel(elevation, axis=0) / abs(8 * affine.e)
+
+        # length of the terrain normal vector
+        norm_len = numpy.sqrt((xgrad * xgrad) + (ygrad * ygrad) + 1.0)
+        slope = numpy.degrees(numpy.arccos(1.0 / norm_len))
+
+        sia = (solar_vec[2] - (xgrad * solar_vec[0]) - (ygrad * solar_vec[1])) / norm_len
+        sia = 90 - numpy.degrees(numpy.arccos(sia))
+        return slope, sia
+
+    # As above, but in strips of rows (with a halo row for the Sobel kernel), in place
+    slope = numpy.empty(elevation.shape, dtype=numpy.float32)
+    sia = numpy.empty(elevation.shape, dtype=numpy.float32)
+    height = elevation.shape[0]
+    for start in range(0, height, LEAN_STRIP_ROWS):
+        stop = min(start + LEAN_STRIP_ROWS, height)
+        halo_start, halo_stop = max(start - 1, 0), min(stop + 1, height)
+        window = elevation[halo_start:halo_stop]
+        rows = slice(start - halo_start, stop - halo_start)
+
+        xgrad = ndimage.sobel(window, axis=1, output=numpy.float32)[rows]
+        xgrad /= abs(8 * affine.a)
+        ygrad = ndimage.sobel(window, axis=0, output=numpy.float32)[rows]
+        ygrad /= abs(8 * affine.e)
+
+        norm_len = numpy.hypot(xgrad, ygrad, out=slope[start:stop])
+        numpy.square(norm_len, out=norm_len)
+        norm_len += 1.0
+        numpy.sqrt(norm_len, out=norm_len)
+
+        xgrad *= solar_vec[0]
+        ygrad *= solar_vec[1]
+        xgrad += ygrad
+        strip_sia = numpy.subtract(solar_vec[2], xgrad, out=sia[start:stop])
+        strip_sia /= norm_len
+        numpy.arccos(strip_sia, out=strip_sia)
+        numpy.degrees(strip_sia, out=strip_sia)
+        numpy.subtract(90, strip_sia, out=strip_sia)
+
+        strip_slope = numpy.reciprocal(norm_len, out=norm_len)
+        numpy.arccos(strip_slope, out=strip_slope)
+        numpy.degrees(strip_slope, out=strip_slope)
+
+    return slope, sia
+
+
+def _terrain_normals(elevation, affine, lean=False):
+    """
+    Sobel gradients, length of the terrain normal vector, and slope (degrees) of an elevation array
+
+    These do not depend on the sun, so are shared by every time (see _incidence).
+    """
+    if not lean:
+        xgrad = ndimage.sobel(elevation, axis=1) / abs(8 * affine.a)
+        ygrad = ndimage.sobel(elevation, axis=0) / abs(8 * affine.e)
+        norm_len = numpy.sqrt((xgrad * xgrad) + (ygrad * ygrad) + 1.0)
+        slope = numpy.degrees(numpy.arccos(1.0 / norm_len))
+        return xgrad, ygrad, norm_len, slope
+
+    # in strips of rows (with a halo row for the Sobel kernel), as for _slope_and_incidence
+    xgrad = numpy.empty(elevation.shape, dtype=numpy.float32)
+    ygrad = numpy.empty(elevation.shape, dtype=numpy.float32)
+    norm_len = numpy.empty(elevation.shape, dtype=numpy.float32)
+    slope = numpy.empty(elevation.shape, dtype=numpy.float32)
+    height = elevation.shape[0]
+    for start in range(0, height, LEAN_STRIP_ROWS):
+        stop = min(start + LEAN_STRIP_ROWS, height)
+        halo_start, halo_stop = max(start - 1, 0), min(stop + 1, height)
+        window = elevation[halo_start:halo_stop]
+        rows = slice(start - halo_start, stop - halo_start)
+
+        xgrad[start:stop] = ndimage.sobel(window, axis=1, output=numpy.float32)[rows]
+        ygrad[start:stop] = ndimage.sobel(window, axis=0, output=numpy.float32)[rows]
+    xgrad /= abs(8 * affine.a)
+    ygrad /= abs(8 * affine.e)
+
+    numpy.hypot(xgrad, ygrad, out=norm_len)
+    numpy.square(norm_len, out=norm_len)
+    norm_len += 1.0
+    numpy.sqrt(norm_len, out=norm_len)
+
+    numpy.reciprocal(norm_len, out=slope)
+    numpy.arccos(slope, out=slope)
+    numpy.degrees(slope, out=slope)
+    return xgrad, ygrad, norm_len, slope
+
+
+def _incidence(xgrad, ygrad, norm_len, solar_vec, out, scratch):
+    """
+    Solar incidence angle (degrees) of each pixel, written to `out` (using `scratch`)
+    """
+    numpy.multiply(xgrad, solar_vec[0], out=out)
+    numpy.subtract(solar_vec[2], out, out=out)
+    numpy.multiply(ygrad, solar_vec[1], out=scratch)
+    out -= scratch
+    out /= norm_len
+    numpy.arccos(out, out=out)
+    numpy.degrees(out, out=out)
+    numpy.subtract(90, out, out=out)
+    return out
+
+
+def _cast_shadows(elevation, solar_vec, pixel_scale_m, no_data, lean=False):
+    """
+    Shadow mask of an elevation array, ray-traced along rows aligned with the sun
+
+    The lean variant resamples in strips of rows (rather than materialising the whole rotated
+    DSM or float mask), and marks pixels that resample to neither LIT nor SHADED as MASK_UNKNOWN.
+    """
+    y_size, x_size = elevation.shape
     rot_degrees = 90.0 + math.degrees(solar_vec[3])
 
-    buff_elv_array = numpy.pad(tile.elevation.values, 4, mode='edge')
+    buff_elv_array = numpy.pad(elevation, 4, mode='edge')
+
+    if lean:
+        matrix, offset, rotated_shape = _rotation(buff_elv_array.shape, rot_degrees, reshape=True)
+        shadows = numpy.empty(rotated_shape, dtype=numpy.uint8)
+        strip = numpy.empty((LEAN_STRIP_ROWS, rotated_shape[1]), dtype=numpy.float32)
+        for start in range(0, rotated_shape[0], LEAN_STRIP_ROWS):
+            stop = min(start + LEAN_STRIP_ROWS, rotated_shape[0])
+            rows = _rotate_window(buff_elv_array, matrix, offset, (start, 0),
+                                  strip[:stop - start], order=3, cval=no_data)
+            for row in range(stop - start):
+                _shade_row(shadows[start + row], rows[row], solar_vec[4], pixel_scale_m, no_data,
+                           fuzz=SHADOW_FUZZ_M, unknown=MASK_UNKNOWN)
+        del buff_elv_array
+
+        # undo the rotation, only for the pixels of the tile
+        matrix, offset, _ = _rotation(rotated_shape, -rot_degrees, reshape=False)
+        dr = (rotated_shape[0] - y_size) // 2
+        dc = (rotated_shape[1] - x_size) // 2
+        result = numpy.empty((y_size, x_size), dtype=numpy.uint8)
+        strip = numpy.empty((LEAN_STRIP_ROWS, x_size), dtype=numpy.float32)
+        for start in range(0, y_size, LEAN_STRIP_ROWS):
+            stop = min(start + LEAN_STRIP_ROWS, y_size)
+            rows = _rotate_window(shadows, matrix, offset, (dr + start, dc),
+                                  strip[:stop - start], order=3, cval=MASK_UNKNOWN)
+            out = result[start:stop]
+            out.fill(MASK_UNKNOWN)
+            out[rows == LIT] = LIT
+            out[rows == SHADED] = SHADED
+        return result
+
     rotated_elv_array = ndimage.rotate(buff_elv_array,
                                        rot_degrees,
                                        reshape=True,
                                        output=numpy.float32,
                                        cval=no_data,
                                        prefilter=False)
+    del buff_elv_array
 
     # create the shadow mask by ray-tracying along each row
     shadows = numpy.zeros_like(rotated_elv_array)
     for row in range(0, rotated_elv_array.shape[0]):
-        _shade_row(shadows[row], rotated_elv_array[row], solar_vec[4], pixel_scale_m, no_data, fuzz=10.0)
+        _shade_row(shadows[row], rotated_elv_array[row], solar_vec[4], pixel_scale_m, no_data, fuzz=SHADOW_FUZZ_M)
 
     del rotated_elv_array
-    del buff_elv_array
 
     shadows = ndimage.rotate(shadows, -rot_degrees, reshape=False,
                              output=numpy.float32, cval=no_data, prefilter=False)
@@ -144,7 +520,215 @@ def shadows_and_slope(tile, time, no_data=-1000):
     dr = (shadows.shape[0] - y_size) // 2
     dc = (shadows.shape[1] - x_size) // 2
 
-    shadows = shadows[dr:dr + y_size, dc:dc + x_size]
-    shadows = xarray.DataArray(shadows.reshape(tile.elevation.shape), coords=tile.elevation.coords)
+    return shadows[dr:dr + y_size, dc:dc + x_size]
 
-    return shadows, slope, sia
+
+def _cast_shadows_multires(elevation, solar_vec, pixel_scale_m, no_data):
+    """
+    Shadow mask of an elevation array, ray-traced at full resolution only where shadows can reach
+
+    Blocks (of MULTIRES_FACTOR pixels) that no steep enough step of the terrain can shade, by a
+    conservative block-wise horizon (see _shadow_candidates), are lit. Every other block is
+    ray-traced at full resolution, each rotated row from the farthest point that can shade it,
+    so the uint8 mask is that of the lean variant of _cast_shadows. It only saves time on
+    terrain where shadows can reach few blocks (on rugged tiles most of them are traced anyway).
+    """
+    height, width = elevation.shape
+    factor = MULTIRES_FACTOR
+    threshold = math.tan(solar_vec[4]) * pixel_scale_m
+    if threshold <= 0 or min(height, width) < 4 * factor:
+        return _cast_shadows(elevation, solar_vec, pixel_scale_m, no_data, lean=True)
+
+    gaps = elevation == no_data
+
+    # pixels that can begin a shadow (see _shadows_possible)
+    sun_az = solar_vec[3]
+    col_step = numpy.abs(numpy.diff(elevation, axis=1))
+    steepness = numpy.zeros(elevation.shape, dtype=numpy.float32)
+    steepness[:, 1:] = col_step
+    numpy.maximum(steepness[:, :-1], col_step, out=steepness[:, :-1])
+    steepness *= abs(math.sin(sun_az))
+    del col_step
+    row_step = numpy.abs(numpy.diff(elevation, axis=0))
+    row_steepness = numpy.zeros(elevation.shape, dtype=numpy.float32)
+    row_steepness[1:] = row_step
+    numpy.maximum(row_steepness[:-1], row_step, out=row_steepness[:-1])
+    del row_step
+    steepness += abs(math.cos(sun_az)) * row_steepness
+    del row_steepness
+    sources = _blocks(steepness >= threshold, factor).any(axis=(1, 3))
+    del steepness
+
+    # lit wherever no shadow can reach, traced at full resolution wherever one can
+    coarse_band = _shadow_candidates(elevation, sources, solar_vec, pixel_scale_m, no_data)
+    del sources
+
+    reach = math.ceil((relief(elevation, no_data) + SHADOW_FUZZ_M) / threshold) + 1
+    result = numpy.full(elevation.shape, LIT, dtype=numpy.uint8)
+    band = _upsample(coarse_band, factor, elevation.shape)
+    metrics.count('terrain', 'multires_pixels', band.size)
+    metrics.count('terrain', 'multires_traced_pixels', int(band.sum()))
+    if not band.any():
+        return result
+
+    # rotated rows crossing the band, traced from the farthest point that can shade it
+    rot_degrees = 90.0 + math.degrees(solar_vec[3])
+    matrix, offset, rotated_shape = _rotation((height + 8, width + 8), rot_degrees, reshape=True)
+    first, last = _rotated_extents(coarse_band, matrix, offset, rotated_shape)
+    if gaps.any():
+        # resampling next to DSM gaps can lengthen shadows beyond the reach of the relief
+        first[last >= 0] = 0
+    else:
+        first = numpy.maximum(first - reach - 1, 0)
+
+    buff_elv_array = numpy.pad(elevation, 4, mode='edge')
+    shadows = numpy.full(rotated_shape, LIT, dtype=numpy.uint8)
+    for start in range(0, rotated_shape[0], LEAN_STRIP_ROWS):
+        stop = min(start + LEAN_STRIP_ROWS, rotated_shape[0])
+        crossing = numpy.flatnonzero(last[start:stop] >= 0)
+        if crossing.size == 0:
+            continue
+        left = int(first[start:stop][crossing].min())
+        right = int(last[start:stop][crossing].max()) + 1
+        rows = _rotate_window(buff_elv_array, matrix, offset, (start, left),
+                              numpy.empty((stop - start, right - left), dtype=numpy.float32), order=3, cval=no_data)
+        for row in crossing:
+            row_first, row_last = first[start + row], last[start + row] + 1
+            _shade_row(shadows[start + row, row_first:row_last], rows[row, row_first - left:row_last - left],
+                       solar_vec[4], pixel_scale_m, no_data, fuzz=SHADOW_FUZZ_M, unknown=MASK_UNKNOWN)
+    del buff_elv_array
+
+    # undo the rotation, for the band pixels
+    matrix, offset, _ = _rotation(rotated_shape, -rot_degrees, reshape=False)
+    dr = (rotated_shape[0] - height) // 2
+    dc = (rotated_shape[1] - width) // 2
+    for start in range(0, height, LEAN_STRIP_ROWS):
+        stop = min(start + LEAN_STRIP_ROWS, height)
+        columns = numpy.flatnonzero(band[start:stop].any(axis=0))
+        if columns.size == 0:
+            continue
+        left, right = int(columns[0]), int(columns[-1]) + 1
+        rows = _rotate_window(shadows, matrix, offset, (dr + start, dc + left),
+                              numpy.empty((stop - start, right - left), dtype=numpy.float32),
+                              order=3, cval=MASK_UNKNOWN)
+        fine = numpy.full(rows.shape, MASK_UNKNOWN, dtype=numpy.uint8)
+        fine[rows == LIT] = LIT
+        fine[rows == SHADED] = SHADED
+        in_band = band[start:stop, left:right]
+        result[start:stop, left:right][in_band] = fine[in_band]
+    return result
+
+
+def _rotated_extents(blocks, matrix, offset, rotated_shape):
+    """
+    First and last column of each row of a rotated (padded) array near the selected blocks
+
+    Rows without any are marked by a last column of -1. Each block is widened by the
+    padding, the resampling support and the block half-diagonal.
+    """
+    factor = MULTIRES_FACTOR
+    first = numpy.full(rotated_shape[0], rotated_shape[1], dtype=numpy.int64)
+    last = numpy.full(rotated_shape[0], -1, dtype=numpy.int64)
+
+    block_rows, block_cols = numpy.nonzero(blocks)
+    centres = numpy.stack([block_rows, block_cols]) * factor + (4 + (factor - 1) / 2)
+    # rotation matrices are orthonormal, so the inverse transform is the transpose
+    out_rows, out_cols = matrix.T @ (centres - offset[:, None])
+
+    half = factor + 4
+    lo = numpy.clip(numpy.floor(out_cols - half), 0, rotated_shape[1] - 1).astype(numpy.int64)
+    hi = numpy.clip(numpy.ceil(out_cols + half), 0, rotated_shape[1] - 1).astype(numpy.int64)
+    nearest = numpy.round(out_rows).astype(numpy.int64)
+    for shift in range(-half, half + 1):
+        rows = nearest + shift
+        inside = (rows >= 0) & (rows < rotated_shape[0])
+        numpy.minimum.at(first, rows[inside], lo[inside])
+        numpy.maximum.at(last, rows[inside], hi[inside])
+    return first, last
+
+
+def _shadow_candidates(elevation, sources, solar_vec, pixel_scale_m, no_data):
+    """
+    Blocks (of MULTIRES_FACTOR pixels) that a shadow could reach, conservatively
+
+    Along rows of the rotated block grid, the highest point of each block that can begin
+    a shadow (see sources) projects a shadow horizon downsun, which is compared with the lowest
+    point of each block. Block extremes are widened to their neighbours (and the horizon
+    raised by two blocks of descent) to allow for the resampling of the rotation.
+    """
+    factor = MULTIRES_FACTOR
+    far = numpy.float32(1e30)
+
+    valid = numpy.where(elevation == no_data, -far, elevation)
+    casters = _blocks(valid, factor).max(axis=(1, 3))
+    del valid
+    casters[~ndimage.binary_dilation(sources, iterations=1)] = -far
+    casters = ndimage.maximum_filter(casters, size=3)
+    receivers = ndimage.minimum_filter(_blocks(elevation, factor).min(axis=(1, 3)), size=3)
+
+    rot_degrees = 90.0 + math.degrees(solar_vec[3])
+    casters = ndimage.rotate(casters, rot_degrees, reshape=True, order=0, cval=-far)
+    receivers = ndimage.rotate(receivers, rot_degrees, reshape=True, order=0, cval=far)
+
+    # drop of the sun ray over a block
+    descent = math.tan(solar_vec[4]) * pixel_scale_m * factor
+    ramp = numpy.arange(casters.shape[1]) * descent
+    horizon = numpy.maximum.accumulate(casters + ramp, axis=1) - ramp + (SHADOW_FUZZ_M + 2 * descent)
+    candidates = (horizon > receivers).astype(numpy.uint8)
+    del horizon, casters, receivers
+
+    candidates = ndimage.rotate(candidates, -rot_degrees, reshape=False, order=0, cval=0)
+    dr = (candidates.shape[0] - sources.shape[0]) // 2
+    dc = (candidates.shape[1] - sources.shape[1]) // 2
+    candidates = candidates[dr:dr + sources.shape[0], dc:dc + sources.shape[1]].astype(bool)
+    return ndimage.binary_dilation(candidates, iterations=1)
+
+
+def _blocks(array, factor):
+    """
+    View of an array as (rows, factor, cols, factor) blocks, edge padding to whole blocks
+    """
+    height, width = array.shape
+    pad = ((0, -height % factor), (0, -width % factor))
+    if any(after for _, after in pad):
+        array = numpy.pad(array, pad, mode='edge')
+    return array.reshape(array.shape[0] // factor, factor, array.shape[1] // factor, factor)
+
+
+def _upsample(array, factor, shape):
+    """
+    Repeat each pixel of a block-reduced array (see _blocks), cropped to the original shape
+    """
+    upsampled = numpy.repeat(numpy.repeat(array, factor, axis=0), factor, axis=1)
+    return numpy.ascontiguousarray(upsampled[:shape[0], :shape[1]])
+
+
+def _rotation(shape, angle, reshape):
+    """
+    Matrix, offset and output shape of the affine transform applied by ndimage.rotate
+    """
+    cos, sin = special.cosdg(angle), special.sindg(angle)
+    matrix = numpy.array([[cos, sin],
+                          [-sin, cos]])
+
+    in_shape = numpy.asarray(shape)
+    if reshape:
+        height, width = in_shape
+        bounds = matrix @ [[0, 0, height, height],
+                           [0, width, 0, width]]
+        out_shape = (numpy.ptp(bounds, axis=1) + 0.5).astype(int)
+    else:
+        out_shape = in_shape
+
+    offset = (in_shape - 1) / 2 - matrix @ ((out_shape - 1) / 2)
+    return matrix, offset, tuple(int(n) for n in out_shape)
+
+
+def _rotate_window(array, matrix, offset, origin, output, order, cval):
+    """
+    Resample the window (starting at origin, with the shape of output) of a rotated array
+    """
+    window_offset = offset + matrix @ numpy.asarray(origin, dtype=float)
+    ndimage.affine_transform(array, matrix, window_offset, output.shape, output,
+                             order=order, cval=cval, prefilter=False)
+    return output
@@ -1,11 +1,17 @@
 import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Dict
 
+import numpy as np
 import xarray as xr
 from datacube.testutils.io import dc_read
 from datacube.virtual import Transformation, Measurement
 from xarray import Dataset
 
+from wofs import terrain
+from wofs.dsm import dsm_cache, is_mosaic, open_mosaic
+from wofs.filters import terrain_filter_stack
 from wofs.wofls import woffles_ard, woffles_usgs_c2
 
 WOFS_OUTPUT = [{
@@ -65,17 +71,33 @@ class WOfSClassifier(Transformation):
     Terrain buffer is specified in CRS Units (typically meters)
 
     Options include:
-        dsm_path: a URI to a DSM, either S3:// or HTTPS:// work
+        dsm_path: a URI to a DSM, either S3:// or HTTPS:// work, or a local DSM mosaic
+            directory baked on the grid of the data (see wofs.dsm.bake_mosaic)
         c2_scaling: handle the USGS's new scaling values, rescaling to the old way
-        terrain_buffer:
+        terrain_buffer: padding of the DSM around the tile, so shadows cast from outside are found.
+            'adaptive' derives the smallest buffer for each time slice from the relief of the DSM
+            neighbourhood and the sun altitude (see terrain.shadow_padding).
+        terrain_mode: 'standard', 'lean' (bounded memory) or 'multires' (as lean, faster on gentle terrain),
+            see terrain.shadows_and_slope
+        workers: number of time slices classified at once (the terrain masking is split by time
+            slice across them too)
+        worker_pool: 'thread' or 'process', the kind of pool used when workers > 1
     """
 
-    def __init__(self, dsm_path=None, c2_scaling=False, terrain_buffer=0, dsm_no_data=-1000, ignore_dsm_no_data=False):
+    def __init__(self, dsm_path=None, c2_scaling=False, terrain_buffer=0, dsm_no_data=-1000, ignore_dsm_no_data=False,
+                 terrain_mode='standard', workers=1, worker_pool='thread'):
         self.dsm_path = dsm_path
         self.dsm_no_data = dsm_no_data
         self.c2_scaling = c2_scaling
         self.terrain_buffer = terrain_buffer
         self.ignore_dsm_no_data = ignore_dsm_no_data
+        self.terrain_mode = terrain_mode
+        if worker_pool not in ('thread', 'process'):
+            raise ValueError(f"Unknown worker_pool {worker_pool!r}, expected 'thread' or 'process'")
+        if workers < 1:
+            raise ValueError(f'workers must be at least 1, not {workers!r}')
+        self.workers = workers
+        self.worker_pool = worker_pool
         self.output_measurements = {m['name']: Measurement(**m) for m in WOFS_OUTPUT}
         if dsm_path is None:
             _LOG.warning('WARNING: Path or URL to a DSM is not set. Terrain shadow mask will not be calculated.')
@@ -98,41 +120,113 @@ class WOfSClassifier(Transformation):
             data.attrs = orig_attrs
 
         if self.dsm_path is not None:
-            dsm = self._load_dsm(data.geobox.buffered(self.terrain_buffer, self.terrain_buffer))
+            buffers = self._terrain_buffers(data)
+            dsm = self._load_dsm(data.geobox.buffered(max(buffers), max(buffers)))
+            # slopes are shared by the time slices of a chunk, each casts shadows over its own buffer
+            terrain_inputs = (dsm, data[['nbart_blue']].rename({'nbart_blue': 'blue'}),
+                              [_buffer_pixels(max(buffers) - buffer, data.geobox) for buffer in buffers])
         else:
-            dsm = None
-
-        wofs = []
-        for time_idx in range(len(data.time)):
-            if self.c2_scaling:
-                # C2 wofls
-                wofs.append(
-                    woffles_usgs_c2(
-                        data.isel(time=time_idx),
-                        dsm,
-                        dsm_no_data=self.dsm_no_data,
-                        ignore_dsm_no_data=self.ignore_dsm_no_data
-                    ).to_dataset(name='water')
-                )
-            else:
-                wofs.append(
-                    woffles_ard(
-                        data.isel(time=time_idx),
-                        dsm,
-                        dsm_no_data=self.dsm_no_data,
-                        ignore_dsm_no_data=self.ignore_dsm_no_data
-                    ).to_dataset(name='water')
-                )
-
-        wofs = xr.concat(wofs, dim='time')
-        wofs.attrs['crs'] = data.attrs['crs']
+            terrain_inputs = None
+
+        woffles = woffles_usgs_c2 if self.c2_scaling else woffles_ard
+        dims = data.nbart_blue.dims
+        water = np.empty(data.nbart_blue.shape, dtype=np.uint8)
+
+        if self.workers == 1:
+            terrain_flags = _terrain_flags(*terrain_inputs, slice(None), **self._terrain_options()) \
+                if terrain_inputs is not None else None
+            for time_idx in range(len(data.time)):
+                time_terrain = terrain_flags.isel(time=time_idx) if terrain_flags is not None else None
+                water[time_idx] = _woffles_values(woffles, data.isel(time=time_idx), time_terrain)
+        else:
+            executor = ProcessPoolExecutor if self.worker_pool == 'process' else ThreadPoolExecutor
+            with executor(max_workers=self.workers) as pool:
+                # the terrain masking (the costliest part) of contiguous chunks of time slices at once
+                chunks = _time_chunks(len(data.time), self.workers)
+                if terrain_inputs is not None:
+                    terrain_chunks = [pool.submit(_terrain_flags, *terrain_inputs, chunk, **self._terrain_options())
+                                      for chunk in chunks]
+                else:
+                    terrain_chunks = [None] * len(chunks)
+                # bound the slices in flight (each is copied to its worker when using processes)
+                pending = deque()
+                for chunk, terrain_chunk in zip(chunks, terrain_chunks):
+                    terrain_flags = terrain_chunk.result() if terrain_chunk is not None else None
+                    for offset, time_idx in enumerate(range(chunk.start, chunk.stop)):
+                        time_terrain = terrain_flags.isel(time=offset) if terrain_flags is not None else None
+                        pending.append((time_idx, pool.submit(_woffles_values, woffles, data.isel(time=time_idx),
+                                                              time_terrain)))
+                        if len(pending) >= 2 * self.workers:
+                            done_idx, future = pending.popleft()
+                            water[done_idx] = future.result()
+                for done_idx, future in pending:
+                    water[done_idx] = future.result()
+
+        wofs = xr.Dataset(
+            data_vars={'water': (dims, water)},
+            coords={dim: data.coords[dim] for dim in dims if dim in data.coords},
+            attrs={'crs': data.attrs['crs']}
+        )
         return wofs
 
+    def _terrain_options(self):
+        return dict(no_data=self.dsm_no_data, ignore_dsm_no_data=self.ignore_dsm_no_data, mode=self.terrain_mode)
+
+    def _terrain_buffers(self, data):
+        """Terrain buffer (CRS units) for each time slice of the data."""
+        if self.terrain_buffer != 'adaptive':
+            return [self.terrain_buffer] * len(data.time)
+
+        gbox = data.geobox
+        resolution = abs(gbox.affine.a)
+        neighbourhood = gbox.buffered(terrain.MAX_TERRAIN_PADDING, terrain.MAX_TERRAIN_PADDING)
+        # at full resolution (see terrain.tile_relief), the DSM then loaded being a window of it
+        if is_mosaic(self.dsm_path):
+            relief = terrain.relief(open_mosaic(self.dsm_path).read(neighbourhood), self.dsm_no_data)
+        else:
+            relief = terrain.relief(dsm_cache.read(self.dsm_path, neighbourhood, "bilinear", dc_read),
+                                    self.dsm_no_data)
+
+        center = gbox.affine * (gbox.width / 2, gbox.height / 2)
+        buffers = [terrain.shadow_padding(relief,
+                                          terrain.sun_altitude(center, time, gbox.crs),
+                                          resolution,
+                                          max_padding=terrain.MAX_TERRAIN_PADDING // resolution * resolution)
+                   for time in data.time.values]
+        _LOG.info('Adaptive terrain buffers %s for relief of %.0f', buffers, relief)
+        return buffers
+
     def _load_dsm(self, gbox):
+        if is_mosaic(self.dsm_path):
+            # zero-copy window of a baked mosaic on the grid of the data
+            return open_mosaic(self.dsm_path).load(gbox)
+
         # Data variable needs to be named elevation
-        dsm = dc_read(self.dsm_path, gbox=gbox, resampling="bilinear")
+        # (cached, so repeated queries over a tile read the DSM window once)
+        dsm = dsm_cache.read(self.dsm_path, gbox, "bilinear", dc_read)
         return xr.Dataset(
             data_vars={'elevation': (('y', 'x'), dsm)},
             coords=_to_xrds_coords(gbox),
             attrs={'crs': gbox.crs}
         )
+
+
+def _woffles_values(woffles, data, terrain):
+    """Water observations of one time slice, as a (y, x) array."""
+    return woffles(data, None, terrain=terrain).values
+
+
+def _terrain_flags(dsm, blue, trims, chunk, **options):
+    """Terrain flags of a chunk (slice) of the time slices, see filters.terrain_filter_stack."""
+    return terrain_filter_stack(dsm, blue.isel(time=chunk), trims=trims[chunk], **options)
+
+
+def _time_chunks(count, chunks):
+    """At most `chunks` contiguous slices of `count` time slices, balanced to within one."""
+    chunks = max(min(chunks, count), 1)
+    return [slice(count * chunk // chunks, count * (chunk + 1) // chunks) for chunk in range(chunks)]
+
+
+def _buffer_pixels(buffer, gbox):
+    """Number of pixels of a `buffer` (CRS units) on the grid of a geobox."""
+    return max(int(round(buffer / abs(gbox.affine.a))), 0)
@@ -0,0 +1,120 @@
+"""
+Watermark of the input datasets already considered by task generation, for incremental runs.
+
+The watermark records the latest indexed time seen, and the ids of the datasets indexed just
+before it (within OVERLAP, in case their transactions committed after a scan). An
+incremental run scans the input products lightly (ids and times only, see scan), and only
+generates tasks over the acquisition times of datasets indexed since the watermark (see
+time_windows), rather than listing every tile of the archive.
+"""
+import heapq
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from datacube.api.query import Query
+from datacube.model import Range
+
+_LOG = logging.getLogger(__name__)
+
+# Datasets indexed this long before the watermark are still checked against the considered ids
+OVERLAP = timedelta(hours=1)
+# New acquisitions closer than this are generated as one time window
+WINDOW_GAP = timedelta(days=1)
+
+
+class Watermark:
+    """
+    Latest indexed time considered by task generation, and the ids considered near it.
+
+    Args:
+        time_range: the acquisition time range (a Range of datetimes, or None for all of time)
+            the watermark covers: datasets acquired outside it were never scanned
+    """
+
+    def __init__(self, indexed_time=None, considered=(), time_range=None):
+        self.indexed_time = indexed_time
+        self.considered = set(considered)
+        self.time_range = time_range
+
+    @classmethod
+    def load(cls, path, time_range=None):
+        """The watermark saved at a path, or an empty one (over `time_range`) if there is none yet."""
+        path = Path(path)
+        if not path.exists():
+            return cls(time_range=time_range)
+        with open(path) as fin:
+            doc = json.load(fin)
+        saved_range = doc.get('time_range')
+        if saved_range is not None:
+            saved_range = Range(*(datetime.fromisoformat(time) for time in saved_range))
+        return cls(datetime.fromisoformat(doc['indexed_time']), doc['considered'], saved_range)
+
+    def save(self, path):
+        path = Path(path)
+        partial_path = path.with_name(path.name + '.partial')
+        time_range = None
+        if self.time_range is not None:
+            time_range = [self.time_range.begin.isoformat(), self.time_range.end.isoformat()]
+        with open(partial_path, 'w') as fout:
+            json.dump({'indexed_time': self.indexed_time.isoformat(),
+                       'time_range': time_range,
+                       'considered': sorted(self.considered)}, fout, indent=2)
+        os.replace(partial_path, path)
+
+    def consider(self, rows):
+        """
+        The scanned datasets (see scan) indexed since the watermark and not considered before (None
+        if there is no watermark yet, when all are new), and the watermark after considering them all.
+
+        The rows are streamed once: only the new ones, and the ids near the latest indexed time,
+        are kept.
+        """
+        since = self.indexed_time - OVERLAP if self.indexed_time is not None else None
+        new = [] if since is not None else None
+        latest = self.indexed_time
+        recent = []  # heap of (indexed_time, id) within OVERLAP of the latest so far
+        for row in rows:
+            if new is not None and row.indexed_time >= since and str(row.id) not in self.considered:
+                new.append(row)
+            if latest is None or row.indexed_time > latest:
+                latest = row.indexed_time
+            if row.indexed_time >= latest - OVERLAP:
+                heapq.heappush(recent, (row.indexed_time, str(row.id)))
+            while recent and recent[0][0] < latest - OVERLAP:
+                heapq.heappop(recent)
+
+        if not recent:
+            # nothing scanned near (or after) the watermark
+            return new, Watermark(self.indexed_time, self.considered, self.time_range)
+        return new, Watermark(latest, {dataset_id for _, dataset_id in recent}, self.time_range)
+
+
+def scan(index, products, **query):
+    """
+    (id, indexed_time, time) of every dataset of the products matching a query, without their documents.
+
+    The rows are streamed, a product at a time.
+    """
+    scanned = 0
+    for product in products:
+        search_terms = Query(index=index, product=product, **query).search_terms
+        for row in index.datasets.search_returning(('id', 'indexed_time', 'time'), **search_terms):
+            scanned += 1
+            yield row
+    _LOG.info('Scanned %d datasets of %s', scanned, ', '.join(products))
+
+
+def time_windows(rows, gap=WINDOW_GAP):
+    """
+    The acquisition times of scanned datasets, merged into as few time ranges as are `gap` apart.
+    """
+    windows = []
+    for begin, end in sorted((row.time.begin, row.time.end) for row in rows):
+        if windows and begin <= windows[-1].end + gap:
+            windows[-1] = Range(windows[-1].begin, max(end, windows[-1].end))
+        else:
+            windows.append(Range(begin, end))
+    return windows
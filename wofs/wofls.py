@@ -24,7 +24,7 @@ from wofs.constants import NO_DATA
 from wofs.filters import eo_filter, fmask_filter, terrain_filter, c2_filter
 
 
-def woffles(nbar, pq, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False):
+def woffles(nbar, pq, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False, terrain_mode='standard'):
     """Generate a Water Observation Feature Layer from NBAR, PQ and surface elevation inputs."""
 
     water = classifier.classify(nbar.to_array(dim='band')) \
@@ -34,7 +34,8 @@ def woffles(nbar, pq, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False):
             dsm,
             nbar,
             no_data=dsm_no_data,
-            ignore_dsm_no_data=ignore_dsm_no_data)
+            ignore_dsm_no_data=ignore_dsm_no_data,
+            mode=terrain_mode)
 
     _fix_nodata_to_single_value(water)
 
@@ -43,20 +44,26 @@ def woffles(nbar, pq, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False):
     return water
 
 
-def woffles_ard(ard, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False):
-    """Generate a Water Observation Feature Layer from ARD (NBART and FMASK) and surface elevation inputs."""
+def woffles_ard(ard, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False, terrain_mode='standard', terrain=None):
+    """Generate a Water Observation Feature Layer from ARD (NBART and FMASK) and surface elevation inputs.
+
+    Precomputed `terrain` flags (e.g. a time of filters.terrain_filter_stack) are used instead of the dsm.
+    """
     nbar_bands = spectral_bands(ard)
     water = classifier.classify(nbar_bands) \
         | eo_filter(ard) \
         | fmask_filter(ard.fmask)
 
-    if dsm is not None:
+    if terrain is not None:
+        water |= terrain
+    elif dsm is not None:
         # terrain_filter arbitrarily expects a band named 'blue'
         water |= terrain_filter(
             dsm,
             ard.rename({"nbart_blue": "blue"}),
             no_data=dsm_no_data,
-            ignore_dsm_no_data=ignore_dsm_no_data
+            ignore_dsm_no_data=ignore_dsm_no_data,
+            mode=terrain_mode
         )
 
     _fix_nodata_to_single_value(water)
@@ -66,19 +73,25 @@ def woffles_ard(ard, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False):
     return water
 
 
-def woffles_usgs_c2(c2, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False):
-    """Generate a Water Observation Feature Layer from USGS Collection 2 and surface elevation inputs."""
+def woffles_usgs_c2(c2, dsm, dsm_no_data=-1000, ignore_dsm_no_data=False, terrain_mode='standard', terrain=None):
+    """Generate a Water Observation Feature Layer from USGS Collection 2 and surface elevation inputs.
+
+    Precomputed `terrain` flags (e.g. a time of filters.terrain_filter_stack) are used instead of the dsm.
+    """
     nbar_bands = spectral_bands(c2)
     water = classifier.classify(nbar_bands) \
         | eo_filter(c2) \
         | c2_filter(c2.fmask)
-    if dsm is not None:
+    if terrain is not None:
+        water |= terrain
+    elif dsm is not None:
         # terrain_filter arbitrarily expects a band named 'blue'
         water |= terrain_filter(
             dsm,
             c2.rename({"nbart_blue": "blue"}),
             no_data=dsm_no_data,
-            ignore_dsm_no_data=ignore_dsm_no_data
+            ignore_dsm_no_data=ignore_dsm_no_data,
+            mode=terrain_mode
         )
 
     _fix_nodata_to_single_value(water)
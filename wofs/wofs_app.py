@@ -9,15 +9,19 @@ The three entry points are:
 3. datacube-wofs run
 """
 import copy
+import hashlib
 import logging
+import math
 import os
-import pickle
 import signal
 import sys
-from collections import defaultdict
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from datetime import datetime, timezone
-from functools import partial
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial
+from itertools import groupby, islice
 from pathlib import Path
 from time import time as time_now
 from typing import Tuple
@@ -27,18 +31,23 @@ import datacube
 import datacube.model.utils
 import numpy as np
 import xarray
+from affine import Affine
 from datacube.api.grid_workflow import Tile
 from datacube.drivers.netcdf import write_dataset_to_netcdf
-from datacube.index import Index, MissingRecordError
+from datacube.index import Index
 from datacube.model import DatasetType, Range
+from datacube.testutils.io import dc_read
 from datacube.ui import click as ui
 from datacube.ui import task_app
-from datacube.utils.geometry import unary_union, unary_intersection, CRS
+from datacube.utils.geometry import CRS, GeoBox
 from digitalearthau import paths
-from digitalearthau.qsub import with_qsub_runner, TaskRunner
+from digitalearthau.qsub import with_qsub_runner, SerialTaskRunner, TaskRunner
 from digitalearthau.runners.model import TaskDescription
 from pandas import to_datetime
-from wofs import wofls, __version__
+from wofs import (estimate, gqa, indexing, journal, ledger, local_runner, pipeline, scheduler, shm,
+                  source_window, taskfile, terrain, watermark, __version__)
+from wofs.dsm import bake_mosaic, crop, open_mosaic
+from wofs.footprints import Footprints
 
 APP_NAME = 'wofs'
 _LOG = logging.getLogger(__name__)
@@ -47,6 +56,27 @@ _MEASUREMENT_KEYS_TO_COPY = ('zlib', 'complevel', 'shuffle', 'fletcher32', 'cont
 # ROOT_DIR is the current directory of this file.
 ROOT_DIR = Path(__file__).absolute().parent.parent
 
+# Inputs needed from EO data
+SOURCE_BANDS = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']
+
+# Most tasks of a cell processed together, sharing one load of the padded DSM of the cell
+CELL_BATCH_SIZE = 32
+
+# Seconds spent indexing the datasets still queued on SIGTERM, before giving up (PBS follows with SIGKILL)
+SIGTERM_INDEXING_SECONDS = 10
+
+# Task generation queries the index for each input source and time window of this many days,
+# this many queries at a time
+QUERY_WINDOW_DAYS = 365
+QUERY_WORKERS = 4
+
+# Worker processes loading (and as many writing) task data in shared memory (see run-local)
+IO_WORKERS = 2
+
+# Padded DSM of the cell batch last loaded by this process (see _load_cell_dsm)
+_CELL_DSM = {}
+_CELL_DSM_LOCK = threading.Lock()
+
 INPUT_SOURCES = [{'nbart': 'ls5_nbart_albers',
                   'pq': 'ls5_pq_legacy_scene',
                   'sensor_name': 'TM',
@@ -199,12 +229,17 @@ def _group_tiles_by_cells(tile_index_list, cell_index_list):
 
 
 # pylint: disable=too-many-locals
-def _generate_tasks(index, config, time, extent=None):
+def _generate_tasks(index, config, time, extent=None, query_workers=QUERY_WORKERS,
+                    query_window_days=QUERY_WINDOW_DAYS, windows=None):
     """
     Yield tasks (loadables (nbart,ps,dsm) + output targets), for dispatch to workers.
 
     This function is the equivalent of an SQL join query,
     and is required as a workaround for datacube API abstraction layering.
+
+    The index is queried for each input source and time window concurrently (see _queried_windows),
+    and the tasks of each window yielded in turn. The time windows can be given (e.g. those with
+    new datasets, see wofs.watermark), rather than split from the time range.
     """
     extent = extent if extent is not None else {}
     product = config['wofs_dataset_type']
@@ -212,55 +247,153 @@ def _generate_tasks(index, config, time, extent=None):
     assert product.grid_spec.crs == CRS('EPSG:3577')
     assert all((abs(r) == 25) for r in product.grid_spec.resolution)  # ensure approx. 25 metre raster
     pq_padding = [3 * 25] * 2  # for 3 pixel cloud dilation
-    terrain_padding = [6850] * 2
-    # Worst case shadow: max prominence (Kosciuszko) at lowest solar declination (min incidence minus slope threshold)
-    # with snapping to pixel edges to avoid API questions
-    # e.g. 2230 metres / math.tan(math.radians(30-12)) // 25 * 25 == 6850
+    # worst case shadow (see terrain.MAX_TERRAIN_PADDING), unless disabled trimmed for each task to what the
+    # relief of the cell and the sun altitude require
+    terrain_padding = [terrain.MAX_TERRAIN_PADDING] * 2
+    adaptive_padding = config.get('adaptive_terrain_padding', True)
 
     gw = datacube.api.GridWorkflow(index, grid_spec=product.grid_spec)  # GridSpec from product definition
+    # dataset extents are reprojected once, and the DSM footprint of each cell fused once
+    footprints = Footprints(product.grid_spec.crs)
+    reliefs = {}
+    gqa_limit = config.get('gqa_max_iterative_mean_xy', gqa.MAX_ITERATIVE_MEAN_XY) \
+        if config.get('gqa_filter', True) else None
+    gqa_scenes = gqa_excluded = 0
+
+    if windows is None:
+        windows = _time_windows(index, time, query_window_days)
+    with ThreadPoolExecutor(max_workers=query_workers) as pool:
+        dsm_query = pool.submit(gw.list_cells, product='dsm1sv10', tile_buffer=terrain_padding, **extent)
+        queried = _queried_windows(pool, gw, product, windows, extent, pq_padding, ahead=query_workers,
+                                   gqa_limit=gqa_limit)
+        dsm_loadables = dsm_query.result()
+
+        if dsm_loadables:
+            _LOG.info('Found %d dsm loadables', len(dsm_loadables))
+        else:
+            _LOG.warning('No dsm1sv10 product in the database')
+
+        for window, wofls_loadables, sources in queried:
+            for input_source, nbart_loadables, pq_loadables, poor_gqa in sources:
+                _LOG.info('Found %d nbart loadables for %r input source', len(nbart_loadables), input_source['nbart'])
+                _LOG.info('Found %d pq  loadables for %r input source', len(pq_loadables), input_source['pq'])
+
+                # only valid where EO, PQ and DSM are *all* available (and WOFL isn't yet)
+                tile_index_set = (set(nbart_loadables) & set(pq_loadables)) - set(wofls_loadables)
+                if poor_gqa:
+                    # nor from a level 1 scene of poor geometric accuracy
+                    excluded = gqa.acquired_tiles(tile_index_set, poor_gqa)
+                    tile_index_set -= excluded
+                    gqa_scenes += len(poor_gqa)
+                    gqa_excluded += len(excluded)
+                    _LOG.info('Found %d %r scenes of poor GQA, excluding %d tiles', len(poor_gqa),
+                              input_source['source_product'], len(excluded))
+                key_map = _group_tiles_by_cells(tile_index_set, dsm_loadables)
+
+                _LOG.info('Found %d items for %r input source', len(list(key_map.keys())),
+                          input_source['source_product'])
+
+                # Cell index is X,Y, tile_index is X,Y,T
+                for cell_index, tile_indexes in key_map.items():
+                    geobox = gw.grid_spec.tile_geobox(cell_index)
+                    # lineage is fetched by the workers, when the (compact) tasks are rehydrated
+                    dsm_tile = dsm_loadables[cell_index]
+                    if adaptive_padding and cell_index not in reliefs:
+                        reliefs[cell_index] = terrain.tile_relief(dsm_tile)
+                    relief = reliefs.get(cell_index)
+                    for tile_index in tile_indexes:
+                        nbart_tile = nbart_loadables.pop(tile_index)
+                        pq_tile = pq_loadables.pop(tile_index)
+                        valid_region = _find_valid_data_region(geobox, nbart_tile, pq_tile, dsm_tile,
+                                                               footprints=footprints,
+                                                               keys=[None, None, ('dsm', cell_index)])
+                        if not valid_region.is_empty:
+                            if relief is not None:
+                                task_dsm_tile = _trim_terrain_padding(dsm_tile, geobox, relief, tile_index[2],
+                                                                      max_padding=terrain_padding[0])
+                            else:
+                                task_dsm_tile = dsm_tile
+                            yield dict(source_tile=nbart_tile,
+                                       pq_tile=pq_tile,
+                                       dsm_tile=task_dsm_tile,
+                                       file_path=_get_filename(config, *tile_index),
+                                       tile_index=tile_index,
+                                       extra_global_attributes=dict(platform=input_source['platform_name'],
+                                                                    instrument=input_source['sensor_name']),
+                                       valid_region=valid_region)
+
+    _LOG.info('Reprojected %d dataset extents', footprints.reprojected)
+    if gqa_limit is not None:
+        _LOG.info('Excluded %d tiles of %d scenes with GQA iterative mean residual of %s or more',
+                  gqa_excluded, gqa_scenes, gqa_limit)
+
+
+def _time_windows(index, time, window_days):
+    """
+    Split the time range of a query into consecutive windows of `window_days` days (inclusive ranges that
+    do not overlap). All of time is split over the time bounds of the input source products.
+    """
+    if time is None:
+        bounds = [index.datasets.get_product_time_bounds(input_source['nbart']) for input_source in INPUT_SOURCES]
+        bounds = [bound for bound in bounds if bound is not None and bound[0] is not None]
+        if not bounds:
+            return [None]
+        time = Range(min(bound[0] for bound in bounds), max(bound[1] for bound in bounds))
+
+    start, end = time
+    step = timedelta(days=window_days)
+    windows = []
+    while start + step <= end:
+        windows.append(Range(start, start + step - timedelta(microseconds=1)))
+        start += step
+    windows.append(Range(start, end))
+    return windows
+
+
+def _queried_windows(pool, gw, product, windows, extent, pq_padding, ahead, gqa_limit=None):
+    """
+    Yield (window, wofls loadables, [(input source, nbart loadables, pq loadables, poor GQA times)]) of each
+    time window in turn, where the poor GQA times are those of the level 1 scenes failing `gqa_limit`
+    (see wofs.gqa), or None if not filtering.
 
-    wofls_loadables = gw.list_tiles(product=product.name, time=time, **extent)
-    dsm_loadables = gw.list_cells(product='dsm1sv10', tile_buffer=terrain_padding, **extent)
+    The queries of each input source and window run on the `pool`, at most `ahead` windows ahead
+    of the window being yielded, so the results held in memory stay bounded.
+    """
+    def submit(window):
+        wofls = pool.submit(gw.list_tiles, product=product.name, time=window, **extent)
+        sources = [(input_source,
+                    pool.submit(gw.list_tiles, product=input_source['nbart'], time=window, **extent),
+                    pool.submit(gw.list_tiles, product=input_source['pq'], time=window, tile_buffer=pq_padding,
+                                **extent),
+                    pool.submit(gqa.poor_gqa_times, gw.index, input_source['source_product'], window, extent, gqa_limit)
+                    if gqa_limit is not None else None)
+                   for input_source in INPUT_SOURCES]
+        return window, wofls, sources
+
+    windows = iter(windows)
+    pending = deque(submit(window) for window in islice(windows, max(ahead, 1)))
+    while pending:
+        window, wofls, sources = pending.popleft()
+        for next_window in islice(windows, 1):
+            pending.append(submit(next_window))
+        _LOG.info('Generating tasks of %s', window)
+        yield window, wofls.result(), [(input_source, nbart.result(), pq.result(),
+                                        gqa.result() if gqa is not None else None)
+                                       for input_source, nbart, pq, gqa in sources]
+
+
+def _trim_terrain_padding(dsm_tile, geobox, relief, time, max_padding):
+    """
+    Shrink the padding of a DSM tile to what can cast a shadow into the (unpadded) geobox at this time
+    """
+    trim = terrain.padding_trim(geobox, relief, time, max_padding=max_padding)
+    if trim <= 0:
+        return dsm_tile
+    return Tile(dsm_tile.sources, dsm_tile.geobox[trim:-trim, trim:-trim])
 
-    if dsm_loadables:
-        _LOG.info('Found %d dsm loadables', len(dsm_loadables))
-    else:
-        _LOG.warning('No dsm1sv10 product in the database')
-
-    for input_source in INPUT_SOURCES:
-        gqa_filter = dict(product=input_source['source_product'], time=time, gqa_iterative_mean_xy=(0, 1))
-        nbart_loadables = gw.list_tiles(product=input_source['nbart'], time=time, **extent)
-        pq_loadables = gw.list_tiles(product=input_source['pq'], time=time, tile_buffer=pq_padding, **extent)
-
-        _LOG.info('Found %d nbart loadables for %r input source', len(nbart_loadables), input_source['nbart'])
-        _LOG.info('Found %d pq  loadables for %r input source', len(pq_loadables), input_source['pq'])
-
-        # only valid where EO, PQ and DSM are *all* available (and WOFL isn't yet)
-        tile_index_set = (set(nbart_loadables) & set(pq_loadables)) - set(wofls_loadables)
-        key_map = _group_tiles_by_cells(tile_index_set, dsm_loadables)
-
-        _LOG.info('Found %d items for %r input source', len(list(key_map.keys())), input_source['source_product'])
-
-        # Cell index is X,Y, tile_index is X,Y,T
-        for cell_index, tile_indexes in key_map.items():
-            geobox = gw.grid_spec.tile_geobox(cell_index)
-            dsm_tile = gw.update_tile_lineage(dsm_loadables[cell_index])
-            for tile_index in tile_indexes:
-                nbart_tile = gw.update_tile_lineage(nbart_loadables.pop(tile_index))
-                pq_tile = gw.update_tile_lineage(pq_loadables.pop(tile_index))
-                valid_region = _find_valid_data_region(geobox, nbart_tile, pq_tile, dsm_tile)
-                if not valid_region.is_empty:
-                    yield dict(source_tile=nbart_tile,
-                               pq_tile=pq_tile,
-                               dsm_tile=dsm_tile,
-                               file_path=_get_filename(config, *tile_index),
-                               tile_index=tile_index,
-                               extra_global_attributes=dict(platform=input_source['platform_name'],
-                                                            instrument=input_source['sensor_name']),
-                               valid_region=valid_region)
-
-
-def _make_wofs_tasks(index, config, year=None, **kwargs):
+
+def _make_wofs_tasks(index, config, year=None, query_workers=QUERY_WORKERS, query_window_days=QUERY_WINDOW_DAYS,
+                     windows=None, **kwargs):
     """
     Generate an iterable of 'tasks', matching the provided filter parameters.
     Tasks can be generated for:
@@ -270,12 +403,7 @@ def _make_wofs_tasks(index, config, year=None, **kwargs):
     Tasks can also be restricted to a given spatial region, specified in `kwargs['x']` and `kwargs['y']` in `EPSG:3577`.
     """
     # TODO: Filter query to valid options
-    if isinstance(year, int):
-        query_time = Range(datetime(year=year, month=1, day=1), datetime(year=year + 1, month=1, day=1))
-    elif isinstance(year, tuple):
-        query_time = Range(datetime(year=year[0], month=1, day=1), datetime(year=year[1] + 1, month=1, day=1))
-    else:
-        query_time = year
+    query_time = _query_time(year)
 
     extent = {}
     if 'x' in kwargs and kwargs['x']:
@@ -283,10 +411,52 @@ def _make_wofs_tasks(index, config, year=None, **kwargs):
         extent['x'] = kwargs['x']
         extent['y'] = kwargs['y']
 
-    tasks = _generate_tasks(index, config, time=query_time, extent=extent)
+    tasks = _generate_tasks(index, config, time=query_time, extent=extent, query_workers=query_workers,
+                            query_window_days=query_window_days, windows=windows)
     return tasks
 
 
+def _query_time(year):
+    """
+    Time range of a year, or a range of years
+    """
+    if isinstance(year, int):
+        return Range(datetime(year=year, month=1, day=1), datetime(year=year + 1, month=1, day=1))
+    if isinstance(year, tuple):
+        return Range(datetime(year=year[0], month=1, day=1), datetime(year=year[1] + 1, month=1, day=1))
+    return year
+
+
+def _new_data_windows(index, time_range, watermark_path):
+    """
+    Time windows with input datasets indexed since the watermark (None if there is none yet), and
+    the advanced watermark (to save once the tasks are).
+
+    A watermark only covers the time range (--year) it was made with, so no other can be used with it.
+    """
+    query_time = _query_time(time_range)
+    mark = watermark.Watermark.load(watermark_path, time_range=query_time)
+    if mark.time_range != query_time:
+        raise click.UsageError(f'The watermark at {watermark_path} covers {_describe_time(mark.time_range)}, '
+                               f'not {_describe_time(query_time)}: use its --year, or another watermark')
+    products = [input_source[name] for input_source in INPUT_SOURCES for name in ('nbart', 'pq')]
+    rows = watermark.scan(index, products, **({'time': query_time} if query_time is not None else {}))
+    new, advanced = mark.consider(rows)
+    if new is None:
+        _LOG.info('No watermark at %s yet, generating tasks over the whole time range', watermark_path)
+        return None, advanced
+
+    windows = watermark.time_windows(new)
+    _LOG.info('%d datasets indexed since %s, in %d time windows', len(new), mark.indexed_time, len(windows))
+    return windows, advanced
+
+
+def _describe_time(time_range):
+    if time_range is None:
+        return 'all of time'
+    return f'{time_range.begin:%Y-%m-%d} to {time_range.end:%Y-%m-%d}'
+
+
 def _get_app_metadata(config):
     """
     Get WOfS app metadata
@@ -304,18 +474,17 @@ def _get_app_metadata(config):
     return doc
 
 
-def _find_valid_data_region(geobox, *sources_list):
+def _find_valid_data_region(geobox, *sources_list, footprints=None, keys=None):
     """
     Find the valid data region
+
+    Pass `footprints` (in the CRS of the output tile geobox) to reuse reprojected extents across
+    calls, and `keys` to cache the fused footprint of a tile (see wofs.footprints).
     """
-    # perform work in CRS of the output tile geobox
-    unfused = [[dataset.extent.to_crs(geobox.crs) for dataset in tile.sources.item()]
-               for tile in sources_list]
-    # fuse the dataset extents within each source tile
-    # pylint: disable=map-builtin-not-iterating
-    tiles_extents = map(unary_union, unfused)
+    if footprints is None:
+        footprints = Footprints(geobox.crs)
     # find where (within the output tile) that all prerequisite inputs available
-    return unary_intersection([geobox.extent] + list(tiles_extents))
+    return footprints.valid_region(geobox, sources_list, keys=keys)
     # downstream should check if this is empty..
 
 
@@ -338,31 +507,144 @@ def _do_wofs_task(config, task):
     :return: Dataset objects representing the generated data that can be added to the index
     :rtype: list(datacube.model.Dataset)
     """
-    # datacube.api.Tile source_tile: NBAR Tile
-    source_tile: Tile = task['source_tile']
-
-    # datacube.api.Tile pq_tile: Pixel quality Tile
-    pq_tile: Tile = task['pq_tile']
+    inputs = _load_wofs_inputs(config, task)
+    output = _compute_wofs(config, task, inputs)
+    return _write_wofs_output(config, task, output)
 
-    # datacube.api.Tile dsm_tile: Digital Surface Model Tile
-    dsm_tile: Tile = task['dsm_tile']
 
+def _load_wofs_inputs(config, task):
+    """
+    Load the source, pq and dsm data of a task (the first stage of _do_wofs_task).
+    """
     # Path file_path: output file destination
     file_path = Path(task['file_path'])  # Path file_path: output file destination
 
-    product = config['wofs_dataset_type']
-
     if file_path.exists():
         _LOG.warning('Output file already exists %r', str(file_path))
 
     # load data
-    bands = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2']  # inputs needed from EO data)
-    source = datacube.api.GridWorkflow.load(source_tile, measurements=bands)
-    pq = datacube.api.GridWorkflow.load(pq_tile)
-    dsm = datacube.api.GridWorkflow.load(dsm_tile, resampling='cubic')
+    # only the window of the tile with source data (unless disabled), see wofs.source_window
+    source, pq, _ = source_window.load_inputs(task, datacube.api.GridWorkflow.load, SOURCE_BANDS,
+                                              crop=config.get('crop_to_source_footprint', True))
+    return {'source': source, 'pq': pq, 'dsm': _load_dsm(config, task)}
 
-    # Core computation
-    result = wofls.woffles(*(x.isel(time=0) for x in [source, pq, dsm])).astype(np.int16)
+
+def _load_dsm(config, task):
+    """
+    Load the (whole, padded) DSM of a task, as the shadows (and the sun position) depend on its extent.
+    """
+    dsm_tile: Tile = task['dsm_tile']
+    if config.get('dsm_mosaic'):
+        # zero-copy window of a local mosaic baked on the tile grid (lineage is still the dsm_tile)
+        dsm = open_mosaic(config['dsm_mosaic']).load(dsm_tile.geobox)
+    elif task.get('cell_dsm_tile') is not None:
+        # cropped from the padded DSM of the cell batch, loaded once for all of its tasks
+        cell_dsm_tile = task['cell_dsm_tile']
+        dsm = crop(_load_cell_dsm(cell_dsm_tile), cell_dsm_tile.geobox, dsm_tile.geobox)
+    else:
+        dsm = datacube.api.GridWorkflow.load(dsm_tile, resampling='cubic').isel(time=0)
+    return dsm
+
+
+def _load_cell_dsm(dsm_tile):
+    """
+    Padded DSM of a cell batch (see _cell_batches), loaded and resampled once for its consecutive tasks
+    """
+    key = (tuple(dsm_tile.geobox.affine)[:6], dsm_tile.geobox.shape,
+           tuple(str(dataset.id) for datasets in dsm_tile.sources.values for dataset in datasets))
+    with _CELL_DSM_LOCK:
+        if key not in _CELL_DSM:
+            _CELL_DSM.clear()
+            _CELL_DSM[key] = datacube.api.GridWorkflow.load(dsm_tile, resampling='cubic').isel(time=0)
+        return _CELL_DSM[key]
+
+
+def _cell_batches(tasks, batch_size=CELL_BATCH_SIZE):
+    """
+    Group consecutive tasks of a cell, in batches of at most `batch_size` tasks that share one load of
+    the padded DSM. Tasks are read as a stream: task files list the tasks of a cell together, for each
+    time window and input source (see _generate_tasks), so batches never span more than that.
+
+    Each task is tagged with the DSM tile of its batch (`cell_dsm_tile`): the largest DSM tile of the
+    batch, within which the (trimmed, see _trim_terrain_padding) DSM tiles of the others lie.
+    """
+    for _, cell_tasks in groupby(tasks, key=lambda task: tuple(task['tile_index'][:2])):
+        while True:
+            batch = list(islice(cell_tasks, batch_size))
+            if not batch:
+                break
+            dsm_tile = max((task['dsm_tile'] for task in batch),
+                           key=lambda tile: tile.geobox.width * tile.geobox.height)
+            yield [dict(task, cell_dsm_tile=dsm_tile) for task in batch]
+
+
+def _do_wofs_batch(config, input_filename, batch):
+    """
+    Process a batch of tasks of one cell (see _cell_batches), rehydrating their tiles first (from the
+    datasets saved in the task file).
+
+    :return: the (task summary, datasets, error) of each task, where the summary is what the
+        journal needs of the task
+    """
+    batch = taskfile.rehydrate_tasks(_task_file(input_filename).datasets, batch)
+    results = []
+    for task in batch:
+        summary = {'tile_index': task['tile_index'], 'file_path': task['file_path']}
+        try:
+            results.append((summary, _do_wofs_task(config, task), None))
+        except Exception as error:  # pylint: disable=broad-except
+            _LOG.exception('Unable to process %s', task['file_path'])
+            results.append((summary, None, repr(error)))
+    return results
+
+
+@lru_cache(maxsize=1)
+def _task_file(input_filename):
+    """The task file of this process, its header and indexes read once (see taskfile.TaskFile)"""
+    return taskfile.TaskFile(input_filename)
+
+
+def _rehydrated_tasks(datasets, tasks, chunk_size=CELL_BATCH_SIZE):
+    """Tasks with their tiles rehydrated (see taskfile.rehydrate_tasks), a chunk of tasks at a time"""
+    chunk = []
+    for task in tasks:
+        chunk.append(task)
+        if len(chunk) == chunk_size:
+            yield from taskfile.rehydrate_tasks(datasets, chunk)
+            chunk = []
+    yield from taskfile.rehydrate_tasks(datasets, chunk)
+
+
+def _process_batch(process_func, run_journal, results):
+    """Index (or log) the datasets of a processed batch (see _do_wofs_batch)."""
+    for task, datasets, error in results:
+        if error is not None:
+            _forget_task(run_journal, task)
+            continue
+        try:
+            _finish_task(process_func, run_journal, task, datasets)
+            _LOG.info('Successfully processed %s', task['file_path'])
+        except Exception:  # pylint: disable=broad-except
+            _LOG.exception('Unable to index %s', task['file_path'])
+            _forget_task(run_journal, task)
+
+
+def _compute_wofs(config, task, inputs):
+    """
+    Run the WOFS algorithm and attach metadata (the second stage of _do_wofs_task).
+
+    :return: the output Dataset and its indexable record
+    """
+    source_tile: Tile = task['source_tile']
+    pq_tile: Tile = task['pq_tile']
+    dsm_tile: Tile = task['dsm_tile']
+    file_path = Path(task['file_path'])
+    product = config['wofs_dataset_type']
+    source = inputs['source']
+
+    # Core computation, on the window with source data (see wofs.source_window)
+    result = source_window.compute_tile(source, inputs['pq'], inputs['dsm'], source_tile.geobox,
+                                        terrain_mode=config.get('terrain_mode', 'standard'))
 
     # Convert 2D DataArray to 3D DataSet
     result = xarray.concat([result], dim=source.time).to_dataset(name='water')
@@ -405,30 +687,112 @@ def _do_wofs_task(config, task):
     # copy metadata record into xarray
     result['dataset'] = _docvariable(new_record, result.time)
 
+    return result, new_record
+
+
+def _write_wofs_output(config, task, output):
+    """
+    Compress and write the output of a task to NetCDF (the last stage of _do_wofs_task).
+
+    :return: Dataset objects representing the generated data that can be added to the index
+    """
+    result, new_record = output
     global_attributes = config['global_attributes'].copy()
     global_attributes.update(task['extra_global_attributes'])
 
     # write output
-    write_dataset_to_netcdf(result, file_path,
+    write_dataset_to_netcdf(result, Path(task['file_path']),
                             global_attributes=global_attributes,
                             variable_params=config['variable_params'])
     return [new_record]
 
 
-def _index_datasets(index: Index, results):
+def _run_pipelined(config, tasks, process_func, prefetch, memory_cap_mb, run_journal=None):
     """
-    Index newly created WOfS datasets
+    Process tasks with loading, computing and writing of consecutive tasks overlapped (see wofs.pipeline).
     """
-    for dataset in results:
+    max_bytes = memory_cap_mb * 2 ** 20 if memory_cap_mb else None
+    results = pipeline.run_pipeline(tasks,
+                                    partial(_load_wofs_inputs, config),
+                                    partial(_compute_wofs, config),
+                                    partial(_write_wofs_output, config),
+                                    prefetch=prefetch, max_bytes=max_bytes)
+    for task, datasets, error in results:
+        if error is not None:
+            _LOG.error('Unable to process %s', task['file_path'], exc_info=error)
+            _forget_task(run_journal, task)
+            continue
         try:
-            index.datasets.add(dataset,
-                               with_lineage=False,
-                               sources_policy='skip')
-            _LOG.info('Dataset %s added: %r', dataset.id, dataset)
-        except (ValueError, MissingRecordError) as err:
-            _LOG.error('Failed to add %r dataset: Error (%s)',
-                       dataset,
-                       err)
+            _finish_task(process_func, run_journal, task, datasets)
+            _LOG.info('Successfully processed %s', task['file_path'])
+        except Exception:  # pylint: disable=broad-except
+            _LOG.exception('Unable to process %s', task['file_path'])
+            _forget_task(run_journal, task)
+
+
+def _open_journal(input_filename, enabled, skip_indexing, part=None):
+    """The completion journal of a task file (see wofs.journal), or None if disabled."""
+    if not enabled:
+        return None
+    # without indexing, a written output is as complete as the run gets
+    return journal.Journal(journal.journal_path(input_filename), part=part, require_indexed=not skip_indexing)
+
+
+def _finish_task(process_func, run_journal, task, datasets):
+    """Index (or log) the datasets of a task, recording it as complete once they are."""
+    if isinstance(process_func, indexing.BatchIndexer):
+        # journaled by the indexing thread, once the datasets are in the index
+        process_func.add(datasets, done=partial(_task_indexed, run_journal, task))
+        return
+    process_func(datasets)
+    if run_journal is not None:
+        run_journal.record(task, task['file_path'], indexed=False)
+
+
+def _task_indexed(run_journal, task, errors):
+    if errors:
+        _LOG.error('Unable to index %s', task['file_path'])
+        _forget_task(run_journal, task)
+    elif run_journal is not None:
+        run_journal.record(task, task['file_path'], indexed=True)
+
+
+def _forget_task(run_journal, task):
+    if run_journal is not None:
+        run_journal.forget(task)
+
+
+def _pending_batches(run_journal, batches):
+    """The batches without their tasks completed in earlier runs (see wofs.journal)."""
+    for batch in batches:
+        batch = [task for task in batch if not run_journal.is_complete(task)]
+        if batch:
+            yield batch
+
+
+def _tracked_batches(run_journal, batches):
+    """The batches, their tasks noted as in flight as each batch is taken."""
+    if run_journal is None:
+        yield from batches
+        return
+    for batch in batches:
+        yield list(run_journal.track(batch))
+
+
+def _dataset_processor(index: Index, skip_indexing, index_batch_size):
+    """
+    What to do with newly created WOfS datasets: index them in batches on a background
+    thread (see wofs.indexing), or only log them.
+    """
+    if skip_indexing:
+        return _skip_indexing_and_only_log
+    return indexing.BatchIndexer(index, batch_size=index_batch_size)
+
+
+def _close_processor(process_func):
+    """Flush the datasets still queued for indexing."""
+    if isinstance(process_func, indexing.BatchIndexer):
+        process_func.close()
 
 
 def _skip_indexing_and_only_log(results):
@@ -438,12 +802,38 @@ def _skip_indexing_and_only_log(results):
         _LOG.info('Dataset %s created at %s but not indexed', dataset.id, dataset.uris)
 
 
+class Terminated(SystemExit):
+    """Raised in the main thread on SIGTERM (see handle_sigterm), exiting with 128 + the signal number."""
+
+
+# Set on SIGTERM, for the run to shut down accordingly (see _shut_down)
+_terminated = threading.Event()
+
+
 def handle_sigterm(signum, frame):
-    # TODO: I expect SIGTERM will be received shortly before PBS SIGKILL's the job.
-    # We could use this to print out the current progress of the job if it's incomplete
-    # Or perhaps even make it resumable.
-    pid = os.getpid()
-    _LOG.error(f'WOfS App PID: {pid}. Received SIGTERM')
+    # SIGTERM is received shortly before PBS SIGKILL's the job. Only note it, and unwind out of
+    # whatever the main thread is waiting on: the run shuts down in its own loop (see _shut_down),
+    # not in the signal handler.
+    _terminated.set()
+    raise Terminated(128 + signum)
+
+
+def _shut_down(process_func, run_journal):
+    """
+    End a run: index the datasets still queued and close the journal.
+
+    If terminated (see handle_sigterm), completed tasks are already in the journal, so index (and
+    journal) those still queued within SIGTERM_INDEXING_SECONDS, and record the ones in flight:
+    rerunning resumes from there.
+    """
+    if _terminated.is_set():
+        _LOG.error('WOfS App PID: %d. Received SIGTERM', os.getpid())
+        indexing.close_all(timeout=SIGTERM_INDEXING_SECONDS)
+        journal.interrupt_all()
+    else:
+        _close_processor(process_func)
+    if run_journal is not None:
+        run_journal.close()
 
 
 @click.group(help='Datacube WOfS')
@@ -501,14 +891,26 @@ def ensure_products(index, app_config, dry_run):
               required=True,
               type=click.Path(exists=True, readable=True, writable=False, dir_okay=False))
 @click.option('--output-filename',
-              help='Filename to write the list of tasks to.',
-              required=True,
+              help='Filename to write the list of tasks to (required unless estimating).',
               type=click.Path(exists=False, writable=True, dir_okay=False))
 @click.option('--year', 'time_range',
               type=int,
               help='Limit the process to a particular year, or "-" separated range of years.')
 @click.option('--dry-run', is_flag=True, default=False,
               help='Check product definition without modifying the database')
+@click.option('--query-workers', type=int, default=QUERY_WORKERS, show_default=True,
+              help='Index queries run at once')
+@click.option('--query-window', 'query_window_days', type=int, default=QUERY_WINDOW_DAYS, show_default=True,
+              help='Days of each time window the index is queried for')
+@click.option('--watermark', 'watermark_path', type=click.Path(dir_okay=False, writable=True),
+              help='Only generate tasks for input datasets indexed since the watermark in this file, '
+                   'and advance it (the first run generates every task, and creates it for its --year)')
+@click.option('--estimate', 'estimate_only', is_flag=True, default=False,
+              help='Report the expected cost and footprint of the tasks, rather than saving them '
+                   '(nothing is written, neither the product, the task file nor the watermark)')
+@click.option('--cpu-seconds-per-megapixel', type=float, default=estimate.CPU_SECONDS_PER_MEGAPIXEL,
+              show_default=True,
+              help='Calibration of the estimate: CPU seconds per weighted megapixel of a past run')
 @ui.verbose_option
 @ui.log_queries_option
 @ui.pass_index(app_name=APP_NAME)
@@ -516,61 +918,165 @@ def generate(index: Index,
              app_config: str,
              output_filename: str,
              dry_run: bool,
-             time_range: Tuple[datetime, datetime]):
+             time_range: Tuple[datetime, datetime],
+             query_workers: int,
+             query_window_days: int,
+             watermark_path: str,
+             estimate_only: bool,
+             cpu_seconds_per_megapixel: float):
     """
     Generate Tasks into file and Queue PBS job to process them
 
     By default, also ensures the Output Product is present in the database.
 
     --dry-run will still generate a tasks file, but not add the output product to the database.
+
+    --estimate streams through the same task generation, reporting the expected cost of the tasks
+    (see wofs.estimate) instead of saving them, to size an allocation before running.
     """
+    if output_filename is None and not estimate_only:
+        raise click.UsageError('--output-filename is required (unless estimating)')
+
     app_config_file = Path(app_config).resolve()
     app_config = paths.read_document(app_config_file)
 
-    wofs_config = _make_wofs_config(index, app_config, dry_run)
+    wofs_config = _make_wofs_config(index, app_config, dry_run or estimate_only)
 
     # Patch in config file location, for recording in dataset metadata
     wofs_config['app_config_file'] = app_config_file
 
-    wofs_tasks = _make_wofs_tasks(index, wofs_config, time_range)
-    num_tasks_saved = task_app.save_tasks(
+    windows = None
+    if watermark_path is not None:
+        windows, advanced = _new_data_windows(index, time_range, watermark_path)
+
+    wofs_tasks = _make_wofs_tasks(index, wofs_config, time_range, query_workers=query_workers,
+                                  query_window_days=query_window_days, windows=windows)
+    if estimate_only:
+        _estimate_tasks(wofs_config, wofs_tasks, cpu_seconds_per_megapixel)
+        return
+
+    # tiles are saved as references (dataset ids), with each dataset (and its lineage) fetched and saved
+    # once, for the workers to rehydrate them without querying the index
+    num_tasks_saved = taskfile.save_tasks(
         wofs_config,
-        wofs_tasks,
-        output_filename
+        (taskfile.compact_task(task) for task in wofs_tasks),
+        output_filename,
+        datasets=partial(taskfile.fetch_datasets, index)
     )
     _LOG.info('Found %d tasks', num_tasks_saved)
 
+    if watermark_path is not None:
+        # only once the tasks are saved, so a failed run considers the same datasets again
+        advanced.save(watermark_path)
+
+
+def _estimate_tasks(config, tasks, cpu_seconds_per_megapixel):
+    """Report the expected cost and footprint of tasks (see wofs.estimate), as they are generated"""
+    output_bytes = sum(np.dtype(measurement['dtype']).itemsize
+                       for measurement in config['product_definition']['measurements'])
+    tally = estimate.Estimate(output_bytes=output_bytes, crop=config.get('crop_to_source_footprint', True))
+    for task in tasks:
+        tally.add(task)
+    for line in tally.report(cpu_seconds_per_megapixel):
+        click.echo(line)
+
+
+@cli.command(name='bake-dsm', help='Bake a DSM into a local memory-mapped mosaic on the processing grid')
+@click.option('--dsm-path', required=True, help='Path or URL of the DSM raster')
+@click.option('--crs', default='EPSG:3577', show_default=True, help='CRS of the processing grid')
+@click.option('--resolution', type=float, default=25, show_default=True, help='Pixel size (CRS units)')
+@click.option('--bounds', type=float, nargs=4, required=True,
+              help='left bottom right top of the mosaic (CRS units, snapped out to the grid)')
+@click.option('--resampling', default='cubic', show_default=True,
+              help='Resampling of the DSM onto the grid (wofs run loads the DSM with cubic)')
+@click.option('--no-data', type=float, default=-1000, show_default=True, help='NoDATA value of the DSM')
+@click.argument('output_dir', type=click.Path(file_okay=False, writable=True))
+def bake_dsm(dsm_path, crs, resolution, bounds, resampling, no_data, output_dir):
+    """
+    Bake a DSM into a local mosaic, for the `dsm_mosaic` config option (or as a `dsm_path` of
+    the virtual product), so each task slices its DSM window from a memory map.
+    """
+    left, bottom, right, top = (math.floor(bounds[0] / resolution) * resolution,
+                                math.floor(bounds[1] / resolution) * resolution,
+                                math.ceil(bounds[2] / resolution) * resolution,
+                                math.ceil(bounds[3] / resolution) * resolution)
+    geobox = GeoBox(int(round((right - left) / resolution)), int(round((top - bottom) / resolution)),
+                    Affine(resolution, 0, left, 0, -resolution, top), CRS(crs))
+
+    def reader(gbox, resampling):
+        return dc_read(dsm_path, gbox=gbox, resampling=resampling)
+
+    mosaic = bake_mosaic(output_dir, geobox, reader, resampling=resampling, no_data=no_data)
+    click.echo(f'Baked {mosaic.geobox.shape} DSM mosaic into {output_dir}')
+
 
 @cli.command(help="Display information about a tasks file")
 @click.argument('task_file')
 def inspect_taskfile(task_file):
-    with open(task_file, 'rb') as fin:
-        config = pickle.load(fin)
-        print('CONFIGURATION')
-        print(config)
-        print('\nFIRST TASK')
-        task1 = pickle.load(fin)
-        print(task1)
-        i = 1
-        while True:
-            try:
-                _ = pickle.load(fin)
-                i += 1
-            except EOFError:
-                break
-        print(f'{i} tasks in total')
+    tasks = taskfile.TaskFile(task_file)
+    print(f'VERSION {tasks.version}')
+    print('CONFIGURATION')
+    print(tasks.config)
+    print('\nFIRST TASK')
+    print(tasks[0])
+    print(f'{len(tasks)} tasks in total')
 
 
 @cli.command(help='Check for existing outputs')
 @click.option('--input-filename', required=True,
               help='A Tasks File to process',
               type=click.Path(exists=True, readable=True, writable=False, dir_okay=False))
-def check_existing(input_filename: str):
-    config, tasks = task_app.load_tasks(input_filename)
+@click.option('--workers', type=int, default=ledger.LIST_WORKERS, show_default=True,
+              help='Output directories listed at once')
+@click.option('--write-ledger', is_flag=True, default=False,
+              help='Record the tasks with existing and missing outputs next to the task file, '
+                   'for `run --ledger` (or run-mpi, run-local) to skip the existing')
+def check_existing(input_filename: str, workers: int, write_ledger: bool):
+    """
+    Like task_app.check_existing_files, but listing each output directory once, several at a time
+    (see wofs.ledger), rather than stat'ing every output path in turn.
+    """
+    config, tasks = taskfile.load_tasks(input_filename)
 
     _LOG.info('Checking for existing output files.')
     # tile_index is X, Y, T
-    task_app.check_existing_files(_get_filename(config, *task['tile_index']) for task in tasks)
+    paths = [_get_filename(config, *task['tile_index']) for task in tasks]
+    exists = ledger.existing_paths(paths, workers=workers)
+
+    click.echo("Files to be created:")
+    for path, flag in zip(paths, exists):
+        click.echo(f"{path}{' - ALREADY EXISTS' if flag else ''}")
+    existing_files = [path for path, flag in zip(paths, exists) if flag]
+
+    if existing_files and click.confirm(f"There were {len(existing_files)} existing files found "
+                                        "that are not indexed. Delete those files now?"):
+        for file_path in existing_files:
+            file_path.unlink()
+        exists = [False] * len(paths)
+
+    click.echo(f"{len(paths)} tasks files to be created ({len(paths) - len(existing_files)} "
+               f"valid files, {len(existing_files)} existing paths)")
+
+    if write_ledger:
+        outputs = ledger.Ledger.from_flags(exists, ledger.task_file_fingerprint(input_filename))
+        outputs.save(ledger.ledger_path(input_filename))
+        _LOG.info('Recorded %d existing and %d missing outputs in %s', len(outputs.existing),
+                  len(outputs.missing), ledger.ledger_path(input_filename))
+
+
+def _ledger_pending(input_filename, tasks, start=0):
+    """
+    The tasks of a task file (from ordinal `start`, e.g. of a shard) without existing outputs, per its
+    ledger (see check_existing).
+    """
+    path = ledger.ledger_path(input_filename)
+    if not path.exists():
+        raise click.UsageError(f'No ledger at {path}, run check-existing --write-ledger first')
+    outputs = ledger.Ledger.load(path)
+    if not outputs.matches(input_filename):
+        raise click.UsageError(f'The ledger at {path} is not of this task file (as it is now), '
+                               'run check-existing --write-ledger again')
+    return outputs.pending(tasks, start)
 
 
 def _prepend_path_to_tasks(prepath, tasks):
@@ -597,6 +1103,19 @@ def _prepend_path_to_tasks(prepath, tasks):
 @click.option('--redirect-outputs',
               help='Store output files in a different directory (for testing, prepended to task defined output)',
               type=click.Path(exists=True, dir_okay=True, file_okay=False, writable=True))
+@click.option('--prefetch', type=int, default=0, show_default=True,
+              help='Pipeline the tasks in this process, loading the inputs of this many tasks ahead while '
+                   'computing and writing (0 processes each task in turn). Only with the serial runner')
+@click.option('--memory-cap', 'memory_cap_mb', type=int, default=None,
+              help='Cap (MiB) on loaded inputs in flight when pipelining')
+@click.option('--cell-batch-size', type=int, default=CELL_BATCH_SIZE, show_default=True,
+              help='Most tasks of a cell processed together, loading the padded DSM of the cell once')
+@click.option('--journal/--no-journal', 'use_journal', default=True, show_default=True,
+              help='Record completed tasks next to the task file, and skip those already recorded')
+@click.option('--index-batch-size', type=int, default=indexing.BATCH_SIZE, show_default=True,
+              help='Most new datasets added to the index per transaction')
+@click.option('--ledger', 'use_ledger', is_flag=True, default=False,
+              help='Skip the tasks whose outputs existed when `check-existing --write-ledger` last checked')
 @with_qsub_runner()
 @ui.verbose_option
 @ui.pass_index(app_name=APP_NAME)
@@ -605,13 +1124,27 @@ def run(index,
         runner: TaskRunner,
         skip_indexing: bool,
         redirect_outputs: str,
+        prefetch: int,
+        memory_cap_mb: int,
+        cell_batch_size: int,
+        use_journal: bool,
+        index_batch_size: int,
+        use_ledger: bool,
         **kwargs):
     """
     Process WOfS tasks from a task file.
     """
-    config, tasks = task_app.load_tasks(input_filename)
+    if prefetch > 0 and not isinstance(runner, SerialTaskRunner):
+        # pipelined within this process, the runner would not dispatch anything
+        raise click.UsageError('--prefetch pipelines the tasks in this process, so needs the serial runner '
+                               f'(not {type(runner).__name__})')
+
+    config, tasks = taskfile.load_tasks(input_filename)
     work_dir = Path(input_filename).parent
 
+    if use_ledger:
+        tasks = _ledger_pending(input_filename, tasks)
+
     if redirect_outputs is not None:
         tasks = _prepend_path_to_tasks(redirect_outputs, tasks)
 
@@ -627,17 +1160,27 @@ def run(index,
     )
 
     _LOG.info('Starting WOfS processing...')
-    task_func = partial(_do_wofs_task, config)
-    if skip_indexing:
-        process_func = _skip_indexing_and_only_log
-    else:
-        process_func = partial(_index_datasets, index)
+    process_func = _dataset_processor(index, skip_indexing, index_batch_size)
+
+    run_journal = _open_journal(input_filename, use_journal, skip_indexing)
+    if run_journal is not None:
+        tasks = run_journal.pending(tasks)
+    # dispatched by cell, so the padded DSM of a cell is loaded once per batch
+    batches = _tracked_batches(run_journal, _cell_batches(tasks, cell_batch_size))
 
     try:
-        runner(task_desc, tasks, task_func, process_func)
+        if prefetch > 0:
+            # pipelined within this process, rather than dispatched by the runner
+            datasets = _task_file(input_filename).datasets
+            _run_pipelined(config, (task for batch in batches for task in taskfile.rehydrate_tasks(datasets, batch)),
+                           process_func, prefetch, memory_cap_mb, run_journal)
+        else:
+            runner(task_desc, batches, partial(_do_wofs_batch, config, input_filename),
+                   partial(_process_batch, process_func, run_journal))
         _LOG.info("Runner finished normally, triggering shutdown.")
     finally:
         runner.stop()
+        _shut_down(process_func, run_journal)
 
     # TODO: Check for failures and return error state
     sys.exit(0)
@@ -655,18 +1198,48 @@ def run(index,
                    'prepended to task defined output)',
               type=click.Path(exists=True, dir_okay=True, file_okay=False,
                               writable=True))
+@click.option('--prefetch', type=int, default=0, show_default=True,
+              help='Pipeline the tasks, loading the inputs of this many tasks ahead while computing and '
+                   'writing (0 processes each task in turn)')
+@click.option('--memory-cap', 'memory_cap_mb', type=int, default=None,
+              help='Cap (MiB) on loaded inputs in flight when pipelining')
+@click.option('--schedule', type=click.Choice(['round-robin', 'dynamic', 'shard']), default='round-robin',
+              show_default=True,
+              help='Hand every nth task to each rank, hand out tasks to ranks on request (rank 0 coordinates), '
+                   'or a contiguous shard of the task file to each rank (read by that rank only)')
+@click.option('--batch-size', type=int, default=1, show_default=True,
+              help='Most cell batches handed to a rank at once by the dynamic schedule')
+@click.option('--cell-batch-size', type=int, default=CELL_BATCH_SIZE, show_default=True,
+              help='Most tasks of a cell processed together, loading the padded DSM of the cell once')
+@click.option('--journal/--no-journal', 'use_journal', default=True, show_default=True,
+              help='Record completed tasks next to the task file, and skip those already recorded')
+@click.option('--index-batch-size', type=int, default=indexing.BATCH_SIZE, show_default=True,
+              help='Most new datasets added to the index per transaction')
+@click.option('--ledger', 'use_ledger', is_flag=True, default=False,
+              help='Skip the tasks whose outputs existed when `check-existing --write-ledger` last checked')
 @ui.verbose_option
 @ui.pass_index(app_name=APP_NAME)
 def mpi_run(index,
             input_filename: str,
             skip_indexing: bool,
             redirect_outputs: str,
+            prefetch: int,
+            memory_cap_mb: int,
+            schedule: str,
+            batch_size: int,
+            cell_batch_size: int,
+            use_journal: bool,
+            index_batch_size: int,
+            use_ledger: bool,
             **kwargs):
     """Process generated task file.
 
-    Iterate over the file list and assign MPI worker for processing. Split the
-    input file by the number of workers, each MPI worker completes every nth
-    task. Also, detect and fail early if not using full resources in an MPI job.
+    Iterate over the file list and assign MPI worker for processing. By default each MPI
+    worker reads the input file and completes every nth task. With the dynamic schedule,
+    rank 0 reads the tasks and hands them out (costliest first) as the ranks ask for them
+    (see wofs.scheduler). With the shard schedule, each MPI worker reads only its contiguous
+    shard of the input file (see wofs.taskfile). Also, detect and fail early if not using full
+    resources in an MPI job.
 
     Before using this command, execute the following:
       $ module use /g/data/v10/public/modules/modulefiles/
@@ -674,25 +1247,265 @@ def mpi_run(index,
       $ module load openmpi
 
     """
-    config, tasks = task_app.load_tasks(input_filename)
+    from mpi4py import MPI
+    if schedule == 'shard':
+        # each rank reads only its own contiguous shard of the task file, opened once (see _task_file)
+        shard_file = _task_file(input_filename)
+        config, tasks = shard_file.config, shard_file.shard(MPI.COMM_WORLD.rank, MPI.COMM_WORLD.size)
+        start, _ = taskfile.shard_range(len(shard_file), MPI.COMM_WORLD.rank, MPI.COMM_WORLD.size)
+    else:
+        config, tasks = taskfile.load_tasks(input_filename)
+        start = 0
+
+    if use_ledger:
+        tasks = _ledger_pending(input_filename, tasks, start)
 
     if redirect_outputs is not None:
         tasks = _prepend_path_to_tasks(redirect_outputs, tasks)
 
     _LOG.info('Starting WOfS processing...')
-    if skip_indexing:
-        process_func = _skip_indexing_and_only_log
+    process_func = _dataset_processor(index, skip_indexing, index_batch_size)
+
+    # each rank appends to its own part of the journal
+    run_journal = _open_journal(input_filename, use_journal, skip_indexing, part=MPI.COMM_WORLD.rank)
+    # ranks are handed batches of tasks by cell, loading the padded DSM of a cell once per batch
+    if schedule == 'dynamic':
+        # only the coordinator reads the tasks, skipping those complete
+        if run_journal is not None:
+            tasks = run_journal.pending(tasks)
+        batches = _scheduled_by_mpi(_cell_batches(tasks, cell_batch_size), batch_size)
     else:
-        process_func = partial(_index_datasets, index)
+        if schedule == 'round-robin':
+            # every rank takes its nth of the batches of the whole task file first, so ranks agree on their shares
+            batches = _nth_by_mpi(_cell_batches(tasks, cell_batch_size))
+        else:
+            batches = _cell_batches(tasks, cell_batch_size)
+        if run_journal is not None:
+            batches = _pending_batches(run_journal, batches)
+    batches = _tracked_batches(run_journal, batches)
 
-    for task in _nth_by_mpi(tasks):
-        try:
-            dataset = _do_wofs_task(config, task)
-            process_func(dataset)
+    try:
+        if prefetch > 0:
+            datasets = _task_file(input_filename).datasets
+            _run_pipelined(config, (task for batch in batches for task in taskfile.rehydrate_tasks(datasets, batch)),
+                           process_func, prefetch, memory_cap_mb, run_journal)
+            return
+
+        for batch in batches:
+            _process_batch(process_func, run_journal, _do_wofs_batch(config, input_filename, batch))
+    finally:
+        _shut_down(process_func, run_journal)
+
+
+@cli.command(name='run-local', help='Run using a pool of local processes (without PBS or MPI)')
+@click.option('--input-filename', required=True,
+              help='A Tasks File to process',
+              type=click.Path(exists=True, readable=True, writable=False, dir_okay=False))
+@click.option('--skip-indexing', is_flag=True, default=False,
+              help="Generate output files but don't record to a database index")
+@click.option('--redirect-outputs',
+              help='Store output files in a different directory (for testing, prepended to task defined output)',
+              type=click.Path(exists=True, dir_okay=True, file_okay=False, writable=True))
+@click.option('--workers', type=int, default=os.cpu_count(), show_default=True,
+              help='Number of worker processes')
+@click.option('--max-in-flight', type=int, default=None,
+              help='Most tasks taken from the task file but not yet finished (default twice the workers)')
+@click.option('--tasks-per-worker', type=int, default=None,
+              help='Replace each worker process after this many tasks, to contain memory growth')
+@click.option('--task-timeout', type=float, default=None,
+              help='Seconds a task may run (from when its worker starts it) before its worker is killed '
+                   'and the task counted as failed')
+@click.option('--shared-memory', is_flag=True, default=False,
+              help='Load inputs and write outputs on separate I/O workers, handing arrays to and from the '
+                   'workers in shared memory')
+@click.option('--io-workers', type=int, default=IO_WORKERS, show_default=True,
+              help='Number of worker processes loading (and as many writing) with --shared-memory')
+@click.option('--journal/--no-journal', 'use_journal', default=True, show_default=True,
+              help='Record completed tasks next to the task file, and skip those already recorded')
+@click.option('--index-batch-size', type=int, default=indexing.BATCH_SIZE, show_default=True,
+              help='Most new datasets added to the index per transaction')
+@click.option('--ledger', 'use_ledger', is_flag=True, default=False,
+              help='Skip the tasks whose outputs existed when `check-existing --write-ledger` last checked')
+@ui.verbose_option
+@ui.pass_index(app_name=APP_NAME)
+def run_local(index,
+              input_filename: str,
+              skip_indexing: bool,
+              redirect_outputs: str,
+              workers: int,
+              max_in_flight: int,
+              tasks_per_worker: int,
+              task_timeout: float,
+              shared_memory: bool,
+              io_workers: int,
+              use_journal: bool,
+              index_batch_size: int,
+              use_ledger: bool,
+              **kwargs):
+    """
+    Process WOfS tasks from a task file on this machine.
 
-            _LOG.info('Successfully processed', task)
-        except Exception:
-            _LOG.exception('Unable to process', task)
+    Workers only compute and write outputs, this process indexes them all.
+    """
+    config, tasks = taskfile.load_tasks(input_filename)
+
+    if use_ledger:
+        tasks = _ledger_pending(input_filename, tasks)
+
+    if redirect_outputs is not None:
+        tasks = _prepend_path_to_tasks(redirect_outputs, tasks)
+
+    _LOG.info('Starting WOfS processing with %d workers...', workers)
+    process_func = _dataset_processor(index, skip_indexing, index_batch_size)
+
+    run_journal = _open_journal(input_filename, use_journal, skip_indexing)
+    if run_journal is not None:
+        tasks = run_journal.track(run_journal.pending(tasks))
+    # this process reads the datasets of the tasks from the task file, a chunk at a time
+    tasks = _rehydrated_tasks(_task_file(input_filename).datasets, tasks)
+
+    failures = 0
+    try:
+        with shm.SharedArrayPool(run_id=_shared_memory_run_id(input_filename)) as arrays:
+            if shared_memory:
+                # I/O workers load into shared memory and write, workers compute in place
+                results = _shared_memory_results(config, tasks, arrays, workers, io_workers,
+                                                 max_in_flight=max_in_flight,
+                                                 tasks_per_worker=tasks_per_worker,
+                                                 task_timeout=task_timeout)
+            else:
+                results = local_runner.run_tasks(tasks, partial(_do_wofs_task, config), workers,
+                                                 max_in_flight=max_in_flight,
+                                                 tasks_per_worker=tasks_per_worker,
+                                                 task_timeout=task_timeout)
+            for task, datasets, error in results:
+                if error is not None:
+                    failures += 1
+                    _LOG.error('Unable to process %s: %s', task['file_path'], error)
+                    _forget_task(run_journal, task)
+                    continue
+                try:
+                    _finish_task(process_func, run_journal, task, datasets)
+                    _LOG.info('Successfully processed %s', task['file_path'])
+                except Exception:  # pylint: disable=broad-except
+                    failures += 1
+                    _LOG.exception('Unable to index %s', task['file_path'])
+                    _forget_task(run_journal, task)
+    finally:
+        _shut_down(process_func, run_journal)
+    if isinstance(process_func, indexing.BatchIndexer):
+        failures += len(process_func.failed)
+
+    if failures:
+        _LOG.error('%d tasks failed', failures)
+        sys.exit(1)
+
+
+def _shared_memory_run_id(input_filename):
+    """Names the shared memory of runs of a task file (see shm.SharedArrayPool)."""
+    return hashlib.sha1(str(Path(input_filename).resolve()).encode()).hexdigest()[:12]
+
+
+def _shared_memory_results(config, tasks, arrays, workers, io_workers, **kwargs):
+    """
+    Run tasks on local workers, with their inputs and outputs in shared memory (see wofs.shm).
+
+    This process allocates the arrays of each task, `io_workers` processes load the inputs straight into
+    them, `workers` processes compute from them in place into a shared output, and `io_workers` more
+    processes write the outputs from it. Each stage runs on a local_runner, so a worker that dies or
+    times out fails its task (and is gone, so the arrays of the task are released).
+
+    Yields (task, datasets, error) like local_runner.run_tasks.
+    """
+    failed = []
+
+    def allocated():
+        for task in tasks:
+            try:
+                yield task, _shared_arrays(config, task, arrays)
+            except Exception as error:  # pylint: disable=broad-except
+                failed.append((task, None, error))
+
+    def passed(results):
+        """Items of the tasks that succeeded in a stage (others are released, and failed)"""
+        for (task, references, *_), outcome, error in results:
+            if error is None:
+                yield task, references, outcome
+            else:
+                _release_shared(arrays, references)
+                failed.append((task, None, error))
+
+    loaded = passed(local_runner.run_tasks(allocated(), partial(_load_wofs_shared, config), io_workers, **kwargs))
+    computed = passed(local_runner.run_tasks(loaded, partial(_compute_wofs_shared, config), workers, **kwargs))
+    written = local_runner.run_tasks(computed, partial(_write_wofs_shared, config), io_workers, **kwargs)
+    for (task, references, _), datasets, error in written:
+        yield from failed
+        failed.clear()
+        _release_shared(arrays, references)
+        yield task, datasets, error
+    yield from failed
+
+
+def _shared_arrays(config, task, arrays):
+    """
+    Shared arrays of the inputs of a task (the whole tiles, as the window is only settled as it is loaded,
+    see source_window.load_inputs) and of its output.
+    """
+    references = {'source': shm.tile_arrays(arrays, task['source_tile'], SOURCE_BANDS),
+                  'pq': shm.tile_arrays(arrays, task['pq_tile'])}
+    if not config.get('dsm_mosaic'):
+        references['dsm'] = shm.tile_arrays(arrays, task['dsm_tile'])
+    references['output'] = arrays.allocate(task['source_tile'].shape, np.int16)[1]
+    return references
+
+
+def _release_shared(arrays, references):
+    arrays.release(references['output'], *(reference for name, tile_arrays in references.items()
+                                           if name != 'output' for reference in tile_arrays.values()))
+
+
+def _load_wofs_shared(config, item):
+    """
+    Load the inputs of a task (in an I/O worker) straight into their shared arrays.
+
+    :return: the shared datasets (see shm.attach_dataset) of the inputs
+    """
+    task, references = item
+    shared = {}
+
+    def load(tile, measurements=None):
+        name = 'source' if tile.sources is task['source_tile'].sources else 'pq'
+        shared[name] = shm.load_tile(tile, references[name])
+        return shm.attach_dataset(shared[name])
+
+    source_window.load_inputs(task, load, SOURCE_BANDS, crop=config.get('crop_to_source_footprint', True))
+    if 'dsm' in references:
+        # cubic, like GridWorkflow.load of the DSM (see _load_dsm)
+        shared['dsm'] = shm.load_tile(task['dsm_tile'], references['dsm'], resampling='cubic')
+    return shared
+
+
+def _compute_wofs_shared(config, item):
+    """
+    Compute a task (in a worker) from inputs in shared memory, writing the water band to its shared output.
+
+    :return: the output Dataset without its water band, the (dims, attrs) of the water band, and the record
+    """
+    task, references, shared = item
+    inputs = {name: shm.attach_dataset(dataset) for name, dataset in shared.items()}
+    # a mosaic is mapped by each worker itself
+    inputs['dsm'] = inputs['dsm'].isel(time=0) if 'dsm' in inputs else _load_dsm(config, task)
+    result, new_record = _compute_wofs(config, task, inputs)
+    shm.attach(references['output'])[...] = result.water.values
+    return result.drop_vars('water'), (result.water.dims, result.water.attrs), new_record
+
+
+def _write_wofs_shared(config, item):
+    """Write the output of a task (in an I/O worker) from its shared water band."""
+    task, references, (result, water, new_record) = item
+    result = xarray.Dataset({'water': (water[0], shm.attach(references['output']), water[1]), **result.data_vars},
+                            coords=result.coords, attrs=result.attrs)
+    return _write_wofs_output(config, task, (result, new_record))
 
 
 def _mpi_init():
@@ -712,6 +1525,37 @@ def _mpi_init():
     return job_rank, job_size
 
 
+def _scheduled_by_mpi(batches, batch_size):
+    """
+    Task batches of this MPI rank, handed out dynamically (see wofs.scheduler)
+
+    Rank 0 reads and coordinates the batches, in a thread while it processes its share like
+    any other rank. Unless MPI supports that (MPI_THREAD_MULTIPLE), it only coordinates.
+    """
+    from mpi4py import MPI
+    comm = MPI.COMM_WORLD
+    if comm.size == 1:
+        yield from batches
+        return
+
+    if comm.rank != 0:
+        yield from scheduler.assigned_tasks(scheduler.MPIWorkerChannel(comm))
+        return
+
+    if MPI.Query_thread() < MPI.THREAD_MULTIPLE:
+        _LOG.warning('MPI is not thread safe, rank 0 only coordinates')
+        scheduler.coordinate(batches, scheduler.MPICoordinatorChannel(comm), comm.size - 1,
+                             batch_size=batch_size, cost=scheduler.batch_cost)
+        return
+
+    coordinator = threading.Thread(target=scheduler.coordinate, name='wofs-coordinator',
+                                   args=(batches, scheduler.MPICoordinatorChannel(comm), comm.size),
+                                   kwargs=dict(batch_size=batch_size, cost=scheduler.batch_cost), daemon=True)
+    coordinator.start()
+    yield from scheduler.assigned_tasks(scheduler.MPIWorkerChannel(comm))
+    coordinator.join()
+
+
 def _nth_by_mpi(iterator):
     """
     Split an iterator across MPI processes